@@ -5,6 +5,7 @@ import re
 import subprocess
 import json
 import os
+import platform
 import sys
 import tempfile
 import time
@@ -12,11 +13,12 @@ from glob import glob
 import logging
 import logging.handlers
 import shutil
+import signal
 from datetime import datetime, timedelta
+from contextlib import contextmanager
 from io import open
 import argparse
-from MythTV import Recorded, Program, MythDB, VideoGrabber, Job, findfile
-from MythTV.ttvdb import tvdb_api, tvdb_exceptions
+import atexit
 
 
 class DictToNamespace(dict):
@@ -43,7 +45,27 @@ config_dict = {'file': {'fileformat': 'mp4', 'logdir': '/',
                         'usecommflag': 0, 'tvdirstruct': 'folders',
                         'mvdirstruct': 'none', 'commethod': 'remove',
                         'includesub': 0, 'export': 1, 'exporttype': 'kodi',
-                        'episodetitle': 1, 'allowsearch': 0
+                        'episodetitle': 1, 'allowsearch': 0,
+                        'autopause': 0, 'tempplacement': 'fallback',
+                        'dropcache': 1, 'metrics': 1, 'promfile': '',
+                        'jobtype': 256, 'queuepolicy': 'sjf',
+                        'queueaging': 1, 'priorityrules': [],
+                        'dedupe': 1, 'retryparallel': 2, 'retrymax': 20,
+                        'renditions': [],
+                        'tiered': 0, 'tiercodec': 'libx264',
+                        'tierpreset': 'veryfast', 'tierwindow': [1, 6],
+                        'crfsearch': 0, 'crftarget': 'ssim',
+                        'ssimfloor': 0.97, 'bppbudget': 0.08,
+                        'crfcandidates': [18, 20, 22, 24, 26, 28],
+                        'crfsamples': 4, 'crfsamplelength': 4,
+                        'verify': 1, 'verifysamples': 4, 'verifyssim': 0.6,
+                        'commdetect': 0, 'logoarea': 'iw/4:ih/4:iw*3/4:0',
+                        'adindex': 0, 'adindexsize': 5000, 'previews': 0,
+                        'previewinterval': 10, 'previewwidth': 320,
+                        'loudnorm': 0, 'loudnesstarget': -23,
+                        'truepeak': -1, 'splitepisodes': 0,
+                        'cluster': 0, 'leasetime': 300,
+                        'clusteraffinity': 600, 'checkpointdays': 7
                         },
                'video': {'codechd': 'libx264', 'codecsd': 'libx264',
                          'presethd': 'medium', 'presetsd': 'medium',
@@ -56,7 +78,22 @@ config_dict = {'file': {'fileformat': 'mp4', 'logdir': '/',
                          }
                }
 conf_path = os.path.dirname(os.path.abspath(__file__))
-config_file = '{}/conf.json'.format(conf_path)
+# job history, export index and queues, next to the script unless
+#  TRANSCODE_STATE_DIR is set
+state_path = os.environ.get('TRANSCODE_STATE_DIR', conf_path)
+capabilities_file = '{}/capabilities.json'.format(conf_path)
+host_profile_file = '{}/host_profile.json'.format(conf_path)
+job_history_file = '{}/history.sqlite'.format(state_path)
+export_index_file = '{}/exports.sqlite'.format(state_path)
+retry_queue_file = '{}/retry.sqlite'.format(state_path)
+tier_backlog_file = '{}/tiers.sqlite'.format(state_path)
+ad_index_file = '{}/adindex.sqlite'.format(state_path)
+presets = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium',
+           'slow', 'slower', 'veryslow'
+           ]
+config_file = os.environ.get('TRANSCODE_CONFIG',
+                             '{}/conf.json'.format(conf_path)
+                             )
 
 
 class ConfigSetup:
@@ -82,6 +119,16 @@ class ConfigSetup:
         # Set config dict to values in config file
         with open(configuration_file, 'rb') as conf_read:
             config.update(json.load(conf_read))
+        # Fill entries missing from older configuration files with defaults
+        for section, items in defaults.items():
+            if section not in config:
+                config[section] = {}
+            for k, v in items.items():
+                if k not in config[section]:
+                    logging.debug('Missing entry in configuration file: {} '
+                                  'using default: {}'.format(k, v)
+                                  )
+                    config[section][k] = v
 
         if config.keys() == defaults.keys():
             for section, items in config.items():
@@ -91,8 +138,10 @@ class ConfigSetup:
                         if k in ['exportdir', 'fallbackdir']:
                             if not v.endswith('/'):
                                 v = '{}/'.format(v)
+                        if k == 'renditions':
+                            v = name_renditions(v)
                         k = str(k)
-                        if not isinstance(v, (int, float)):
+                        if not isinstance(v, (int, float, list, dict)):
                             v = str(v)
                             items.update({str(k): str(v)})
                             config_out[str(section)].update({str(k): str(v)})
@@ -117,7 +166,29 @@ class ConfigSetup:
             setattr(self, k, DictToNamespace(v))
 
 
-settings = ConfigSetup(config_file, defaults=config_dict)
+def name_renditions(renditions):
+    """
+    Return renditions with a unique name for each, naming a rendition
+    without one by its height, e.g. 480p, or its position in the list
+    """
+    named = []
+    names = set()
+    for index, rendition in enumerate(renditions, 1):
+        rendition = dict(rendition)
+        name = rendition.get('name')
+        if not name:
+            if rendition.get('height'):
+                name = '{}p'.format(rendition['height'])
+            else:
+                name = 'rendition{}'.format(index)
+            if name in names:
+                name = '{}-{}'.format(name, index)
+            logging.debug('Rendition {} has no name using: {}'
+                          .format(index, name))
+        names.add(name)
+        rendition['name'] = str(name)
+        named.append(rendition)
+    return named
 
 
 def write_check(path):
@@ -139,46 +210,107 @@ def write_check(path):
         return True
 
 
-# *** logging setup ***
-logdir = settings.file.logdir
-if logdir is '/':
-    logdir = settings.file.logdir
-logfile = '{}/transcode.log'.format(logdir)
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-lf = logging.Formatter('%(asctime)s:%(levelname)s:%(message)s')
-# setup console logging
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-ch.setFormatter(lf)
-logger.addHandler(ch)
-# Setup file logging
-try:
-    if not os.path.isdir(logdir):
-        os.makedirs(logdir)
-    if write_check(logdir):
-        fh = logging.handlers.TimedRotatingFileHandler(
-            filename=logfile, when='W0', interval=1, backupCount=10)
-        fh.setLevel(logging.DEBUG)
-        fh.setFormatter(lf)
-        logger.addHandler(fh)
-    if not write_check(logdir):
+def setup_logging(logdir):
+    """Configure console and weekly rotating file logging in logdir"""
+    logfile = '{}/transcode.log'.format(logdir)
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    lf = logging.Formatter('%(asctime)s:%(levelname)s:%(message)s')
+    # setup console logging
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    ch.setFormatter(lf)
+    logger.addHandler(ch)
+    # Setup file logging
+    try:
+        if not os.path.isdir(logdir):
+            os.makedirs(logdir)
+        if write_check(logdir):
+            fh = logging.handlers.TimedRotatingFileHandler(
+                filename=logfile, when='W0', interval=1, backupCount=10)
+            fh.setLevel(logging.DEBUG)
+            fh.setFormatter(lf)
+            logger.addHandler(fh)
+        else:
+            logging.error('logfile not accessible:{}'.format(logdir))
+    except Exception as e:
         logging.error('logfile not accessible:{}'.format(logdir))
-except Exception as e:
-    logging.error('logfile not accessible:{}'.format(logdir))
-    logging.error(e)
-    sys.exit(1)
-# *** logging setup end ***
+        logging.error(e)
+        sys.exit(1)
+
+
+class AppContext(object):
+    """
+    Application state initialised on first use. Importing the module has no
+    side effects, the configuration file is read, the database connected
+    and executables located only when first needed
+    """
+    def __init__(self, configuration_file=config_file, defaults=config_dict):
+        self.configuration_file = configuration_file
+        self.defaults = defaults
+        self._settings = None
+        self._db = None
+        self._programs = {}
+
+    @property
+    def settings(self):
+        """ConfigSetup instance loaded from the configuration file"""
+        if self._settings is None:
+            self._settings = ConfigSetup(self.configuration_file,
+                                         defaults=self.defaults
+                                         )
+        return self._settings
+
+    @property
+    def db(self):
+        """MythDB connection"""
+        if self._db is None:
+            from MythTV import MythDB
+            try:
+                self._db = MythDB()
+            except Exception as e:
+                logging.error(e)
+                sys.exit(1)
+        return self._db
+
+    def program(self, program, alt_program=None):
+        """
+        Path of program or alt_program. Paths are cached in the capability
+        cache and only searched for again if the cached path is not
+        executable
+        """
+        if program not in self._programs:
+            cache = load_capability_cache()
+            path = cache['programs'].get(program)
+            if not path or not os.access(path, os.X_OK):
+                path = program_check(program, alt_program)
+                cache['programs'][program] = path
+                save_capability_cache(cache)
+            self._programs[program] = path
+        return self._programs[program]
+
+    def capabilities(self):
+        """Capabilities of the ffmpeg binary in use"""
+        return ffmpeg_capabilities(self.ffmpeg)
+
+    @property
+    def ffmpeg(self):
+        return self.program('ffmpeg', 'mythffmpeg')
+
+    @property
+    def ffprobe(self):
+        return self.program('ffprobe', 'mythffprobe')
+
+    def setup_logging(self):
+        """Configure logging to the configured log directory"""
+        setup_logging(self.settings.file.logdir)
+
+
+app = AppContext()
 
 # Global job for status output
 job = None
 
-try:
-    db = MythDB()
-except Exception as e:
-    logging.error(e)
-    sys.exit(1)
-
 
 def program_check(program, alt_program=None):
     """
@@ -201,6 +333,1350 @@ def program_check(program, alt_program=None):
             raise LookupError('Unable to find {}'.format(program))
 
 
+def load_capability_cache(cache_file=None):
+    """Load the capability cache returning an empty cache on any error"""
+    if not cache_file:
+        cache_file = capabilities_file
+    cache = {'ffmpeg': {}, 'programs': {}}
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'r') as cf:
+                cache.update(json.load(cf))
+        except (IOError, ValueError) as e:
+            logging.debug('Ignoring capability cache: {}'.format(e))
+    return cache
+
+
+def save_capability_cache(cache, cache_file=None):
+    """Atomically write the capability cache"""
+    if not cache_file:
+        cache_file = capabilities_file
+    temp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    try:
+        with open(temp_file, 'w') as cf:
+            cf.write(u'{}'.format(json.dumps(cache, sort_keys=True)))
+        os.rename(temp_file, cache_file)
+    except (IOError, OSError) as e:
+        logging.debug('Unable to write capability cache: {}'.format(e))
+
+
+def ffmpeg_capabilities(ffmpeg, cache_file=None):
+    """
+    Return a dict of the encoders, filters and muxers available in ffmpeg
+    and the features enabled in its build configuration. Results are cached
+    keyed by the binary's path, size and modification time so ffmpeg is only
+    run again when the binary changes
+    """
+    path = os.path.realpath(ffmpeg)
+    st = os.stat(path)
+    # the last field is the version of the listing parser, so entries
+    #  parsed by an older version are replaced
+    key = '{}:{}:{}:2'.format(path, st.st_size, int(st.st_mtime))
+    cache = load_capability_cache(cache_file)
+    if key in cache['ffmpeg']:
+        return cache['ffmpeg'][key]
+
+    def listing(option, flags):
+        """
+        List names from ffmpeg option output with flags matching regex.
+        After a separator line of dashes the flags are the fixed width
+        columns above it, as they may contain spaces, e.g. ' E d' for a
+        device muxer in ffmpeg 6.1
+        """
+        output = subprocess.check_output([ffmpeg, '-hide_banner', option])
+        names = []
+        columns = None
+        for line in output.decode('UTF-8', 'replace').split('\n'):
+            if line.strip() and not line.strip('- '):
+                start = len(line) - len(line.lstrip())
+                columns = (start, start + len(line.strip()))
+                continue
+            if columns:
+                line_flags = line[columns[0]:columns[1]]
+                fields = line[columns[1]:].split()
+            else:
+                fields = line.split()
+                line_flags = fields.pop(0) if fields else ''
+            if fields and fields[0] != '=' and re.match(flags, line_flags):
+                names.append(fields[0])
+        return names
+
+    version = subprocess.check_output([ffmpeg, '-hide_banner', '-version'])
+    version = version.decode('UTF-8', 'replace')
+    features = []
+    for line in version.split('\n'):
+        if line.startswith('configuration:'):
+            features = [item[len('--enable-'):] for item in line.split()
+                        if item.startswith('--enable-')
+                        ]
+    capabilities = {'version': version.split('\n')[0],
+                    'encoders': listing('-encoders',
+                                        r'^[VAS][F.][S.][X.][B.][D.]$'),
+                    'filters': listing('-filters', r'^[T.][S.][C.]?$'),
+                    'muxers': listing('-muxers', r'^[D. ]E'),
+                    'features': features
+                    }
+    # Drop entries for older versions of the same binary
+    for old_key in list(cache['ffmpeg'].keys()):
+        if old_key.split(':')[0] == path:
+            cache['ffmpeg'].pop(old_key)
+    cache['ffmpeg'][key] = capabilities
+    save_capability_cache(cache, cache_file)
+    return capabilities
+
+
+def validate_profile(settings, capabilities):
+    """
+    Check the configured encoders, filters and output format against ffmpeg
+    capabilities. returns a list of problems, empty if the profile is valid
+    """
+    problems = []
+    encoders = capabilities['encoders']
+    for definition in ('hd', 'sd'):
+        video_codec = settings.video['codec{}'.format(definition)]
+        if video_codec not in encoders:
+            problems.append('{} video encoder not available: {}'
+                            .format(definition.upper(), video_codec))
+        audio_codec = settings.audio['codec{}'.format(definition)]
+        if audio_codec != 'copy' and audio_codec not in encoders:
+            problems.append('{} audio encoder not available: {}'
+                            .format(definition.upper(), audio_codec))
+        deinterlacer = settings.video['deinterlace{}'.format(definition)]
+        if deinterlacer != 'none' and (deinterlacer
+                                       not in capabilities['filters']):
+            problems.append('{} deinterlacer not available: {}'
+                            .format(definition.upper(), deinterlacer))
+    muxers = {'mp4': 'mp4', 'mkv': 'matroska', 'ts': 'mpegts'}
+    fileformat = settings.file.fileformat
+    if settings.file.commethod == 'only-cut':
+        fileformat = 'ts'
+    if muxers.get(fileformat, fileformat) not in capabilities['muxers']:
+        problems.append('Output format not available: {}'.format(fileformat))
+    if settings.file.adindex and 'chromaprint' not in capabilities['muxers']:
+        problems.append('Commercial index requires FFmpeg with chromaprint')
+    if settings.file.includesub and settings.file.commethod != 'only-cut':
+        subtitle_codec = {'mp4': 'mov_text', 'mkv': 'srt'}.get(fileformat)
+        if subtitle_codec and subtitle_codec not in encoders:
+            problems.append('Subtitle encoder not available: {}'
+                            .format(subtitle_codec))
+    return problems
+
+
+def load_host_profile(profile_file=None):
+    """Load the calibration results for this host"""
+    if not profile_file:
+        profile_file = host_profile_file
+    profile = {'results': []}
+    if os.path.isfile(profile_file):
+        try:
+            with open(profile_file, 'r') as pf:
+                profile.update(json.load(pf))
+        except (IOError, ValueError) as e:
+            logging.debug('Ignoring host profile: {}'.format(e))
+    return profile
+
+
+def calibrated_speed(profile, codec, preset, crf, definition,
+                     interlaced=None):
+    """
+    Return the calibrated (fps, bits per pixel) for an encoder setting
+    using the result with the closest crf, preferring results with the same
+    interlacing. returns None if the setting has not been calibrated
+    """
+    matches = [result for result in profile['results']
+               if result['codec'] == codec and result['preset'] == preset
+               and result['definition'] == definition
+               ]
+    if interlaced is not None:
+        same_scan = [result for result in matches
+                     if result['interlaced'] == interlaced
+                     ]
+        if same_scan:
+            matches = same_scan
+    if not matches:
+        return None
+    best = min(matches, key=lambda result: abs(result['crf'] - crf))
+    return best['fps'], best['bpp']
+
+
+def calibrate(settings, presets_list=None, crf_list=None, sample_length=10,
+              source=None, profile_file=None):
+    """
+    Measure encode speed and bits per pixel for each available video
+    encoder, preset and crf on short SD and HD, interlaced and progressive
+    sample windows. Samples are cut from source when given, otherwise
+    generated. Results are saved to the host profile
+    """
+    if not profile_file:
+        profile_file = host_profile_file
+    ffmpeg = app.ffmpeg
+    capabilities = ffmpeg_capabilities(ffmpeg)
+    codecs = [codec for codec in ('libx264', 'libx265')
+              if codec in capabilities['encoders']
+              ]
+    if not presets_list:
+        presets_list = presets
+    temp_dir = tempfile.mkdtemp(prefix='calibrate-')
+    results = []
+    try:
+        samples = []
+        for definition, width, height in (('sd', 720, 480),
+                                          ('hd', 1920, 1080)):
+            for interlaced in (True, False):
+                sample = os.path.join(temp_dir, '{}-{}.ts'.format(
+                    definition, ('i' if interlaced else 'p')))
+                if source:
+                    offset = int(AVInfo(source).duration / 3)
+                    command = [ffmpeg, '-y', '-v', 'error', '-ss',
+                               str(offset), '-i', source, '-t',
+                               str(sample_length), '-map', '0:v:0',
+                               '-vf', 'scale={}:{}'.format(width, height),
+                               '-c:v', 'mpeg2video', '-q:v', '2'
+                               ]
+                else:
+                    rate = '60000/1001' if interlaced else '30000/1001'
+                    command = [ffmpeg, '-y', '-v', 'error', '-f', 'lavfi',
+                               '-i', 'testsrc2=size={}x{}:rate={},'
+                               'noise=alls=12:allf=t'
+                               .format(width, height, rate),
+                               '-t', str(sample_length),
+                               '-c:v', 'mpeg2video', '-q:v', '2'
+                               ]
+                    if interlaced:
+                        command.extend(['-vf', 'tinterlace=interleave_top'])
+                if interlaced:
+                    command.extend(['-flags', '+ilme+ildct', '-top', '1'])
+                command.extend(['-f', 'mpegts', sample])
+                subprocess.check_call(command)
+                samples.append((definition, interlaced, sample))
+        for definition, interlaced, sample in samples:
+            sample_info = AVInfo(sample)
+            frames = sample_info.duration * sample_info.video.frame_rate
+            pixels = sample_info.video.width * sample_info.video.height
+            deinterlace_method = settings.video['deinterlace{}'
+                                                .format(definition)]
+            if crf_list:
+                crfs = crf_list
+            else:
+                crfs = [settings.video['crf{}'.format(definition)]]
+            for codec in codecs:
+                for preset in presets_list:
+                    for crf in crfs:
+                        output = os.path.join(temp_dir, 'out.mkv')
+                        command = [ffmpeg, '-y', '-v', 'error', '-i', sample,
+                                   '-map', '0:v:0'
+                                   ]
+                        if interlaced and deinterlace_method != 'none':
+                            command.extend(['-filter:v', '{}=0:-1:1'
+                                            .format(deinterlace_method)])
+                        command.extend(['-c:v', codec, '-preset:v', preset,
+                                        '-crf:v', str(crf), output
+                                        ])
+                        start = time.time()
+                        subprocess.check_call(command)
+                        elapsed = time.time() - start
+                        bpp = (os.path.getsize(output) * 8) / (pixels * frames)
+                        result = {'codec': codec, 'preset': preset,
+                                  'crf': crf, 'definition': definition,
+                                  'interlaced': interlaced,
+                                  'fps': frames / elapsed, 'bpp': bpp
+                                  }
+                        logging.info('Calibrated {codec} {preset} crf {crf} '
+                                     '{definition} interlaced={interlaced}: '
+                                     '{fps:.1f}fps {bpp:.4f}bpp'
+                                     .format(**result))
+                        results.append(result)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    profile = load_host_profile(profile_file)
+    measured = [(result['codec'], result['preset'], result['crf'],
+                 result['definition'], result['interlaced'])
+                for result in results
+                ]
+    profile['results'] = [result for result in profile['results']
+                          if (result['codec'], result['preset'],
+                              result['crf'], result['definition'],
+                              result['interlaced']) not in measured
+                          ] + results
+    profile['host'] = platform.node()
+    profile['updated'] = time.time()
+    profile['ffmpeg'] = capabilities['version']
+    temp_file = '{}.tmp'.format(profile_file)
+    with open(temp_file, 'w') as pf:
+        pf.write(u'{}'.format(json.dumps(profile, indent=2, sort_keys=True)))
+    os.rename(temp_file, profile_file)
+    return results
+
+
+def crf_search(input_file, av_info, kept_ranges, settings, codec, preset,
+               deinterlacer=None, temp_dir=None):
+    """
+    Choose a crf for input_file by encoding settings.file.crfsamples
+    windows of crfsamplelength seconds spread over kept_ranges at each of
+    settings.file.crfcandidates, one crf per process in parallel.
+    With crftarget bpp the lowest crf within bppbudget bits per pixel is
+    chosen, with ssim the highest crf with an SSIM of at least ssimfloor.
+    returns the chosen crf, None if the recording is too short to sample
+    """
+    ffmpeg = app.ffmpeg
+    candidates = sorted(settings.file.crfcandidates)
+    sample_length = settings.file.crfsamplelength
+    kept_duration = sum(end - start for start, end in kept_ranges)
+    if kept_duration < sample_length:
+        return None
+    work_dir = tempfile.mkdtemp(prefix='crfsearch-', dir=temp_dir)
+    try:
+        # Copy each window once so every crf is measured on the same frames
+        clips = []
+        count = settings.file.crfsamples
+        for sample in range(count):
+            position = kept_duration * (sample + 0.5) / count
+            for start, end in kept_ranges:
+                if position < end - start:
+                    offset = start + max(min(position,
+                                             end - start - sample_length), 0)
+                    break
+                position = position - (end - start)
+            clip = os.path.join(work_dir, 'clip{}.ts'.format(sample))
+            subprocess.check_call([ffmpeg, '-y', '-v', 'error', '-ss',
+                                   str(offset), '-i', input_file, '-t',
+                                   str(sample_length), '-map', '0:v:0', '-c',
+                                   'copy', '-f', 'mpegts', clip
+                                   ])
+            clips.append(clip)
+        pixels = av_info.video.width * av_info.video.height
+
+        def measure(crf):
+            """Return (bpp, mean ssim) of the clips encoded at crf"""
+            bits = 0
+            frames = 0
+            ssim = []
+            for clip in clips:
+                output = '{}.{}.mkv'.format(clip, crf)
+                command = [ffmpeg, '-y', '-v', 'error', '-i', clip,
+                           '-map', '0:v:0'
+                           ]
+                if deinterlacer:
+                    command.extend(['-filter:v', deinterlacer])
+                command.extend(['-c:v', codec, '-preset:v', preset,
+                                '-crf:v', str(crf), output
+                                ])
+                subprocess.check_call(command)
+                bits = bits + os.path.getsize(output) * 8
+                frames = (frames + AVInfo(output).duration
+                          * av_info.video.frame_rate)
+                reference = '[1:v]{}[ref]'.format(deinterlacer or 'null')
+                result = subprocess.check_output(
+                    [ffmpeg, '-nostats', '-i', output, '-i', clip,
+                     '-lavfi', '{};[0:v][ref]ssim'.format(reference),
+                     '-f', 'null', '-'], stderr=subprocess.STDOUT,
+                    universal_newlines=True
+                )
+                match = re.search(r'SSIM .*All:([\d.]+)', result)
+                if match:
+                    ssim.append(float(match.group(1)))
+            bpp = bits / (pixels * frames) if frames else 0
+            return bpp, (sum(ssim) / len(ssim)) if ssim else 0
+
+        tasks = [(crf, BackgroundTask(measure, crf)) for crf in candidates]
+        results = [(crf, task.result()) for crf, task in tasks]
+    finally:
+        shutil.rmtree(work_dir)
+    for crf, (bpp, ssim) in results:
+        logging.info('CRF search: crf {} {:.4f}bpp SSIM {:.4f}'
+                     .format(crf, bpp, ssim))
+    if settings.file.crftarget == 'ssim':
+        meeting = [crf for crf, (bpp, ssim) in results
+                   if ssim >= settings.file.ssimfloor]
+        return max(meeting) if meeting else candidates[0]
+    meeting = [crf for crf, (bpp, ssim) in results
+               if bpp <= settings.file.bppbudget]
+    return min(meeting) if meeting else candidates[-1]
+
+
+def verify_output(output_file, input_file, kept_ranges, audio_streams,
+                  settings, deinterlacer=None):
+    """
+    Check output_file against the source: its duration against the kept
+    duration, its video and audio_streams audio streams, and
+    settings.file.verifysamples short windows decoded without errors and
+    SSIM compared with the matching source windows in parallel.
+    returns a list of problems, empty if the output is sound
+    """
+    ffmpeg = app.ffmpeg
+    problems = []
+    kept_duration = sum(end - start for start, end in kept_ranges)
+    try:
+        output_info = AVInfo(output_file)
+    except Exception as e:
+        return ['Unable to probe output: {}'.format(e)]
+    duration = float(output_info.duration)
+    if abs(duration - kept_duration) > max(5, kept_duration * 0.02):
+        problems.append('Output duration {:.1f}s expected {:.1f}s'
+                        .format(duration, kept_duration))
+    if not output_info.video:
+        problems.append('Output has no video stream')
+        return problems
+    if len(output_info.audio) != audio_streams:
+        problems.append('Output has {} audio streams expected {}'
+                        .format(len(output_info.audio), audio_streams))
+    sample_length = 2
+    count = settings.file.verifysamples
+    # (output, source) start times of each window
+    windows = []
+    for sample in range(count):
+        out_position = min(duration, kept_duration) * (sample + 0.5) / count
+        position = out_position
+        source_position = None
+        for start, end in kept_ranges:
+            if position < end - start:
+                source_position = start + position
+                break
+            position = position - (end - start)
+        if source_position is not None:
+            windows.append((out_position, source_position))
+
+    def check_window(out_position, source_position):
+        """Return (decode errors, ssim) of a window"""
+        errors = subprocess.Popen(
+            [ffmpeg, '-v', 'error', '-ss', str(out_position), '-i',
+             output_file, '-t', str(sample_length), '-f', 'null', '-'],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True
+        ).communicate()[0].strip()
+        reference = '[1:v:0]{}scale={}:{}[ref]'.format(
+            '{},'.format(deinterlacer) if deinterlacer else '',
+            output_info.video.width, output_info.video.height)
+        result = subprocess.Popen(
+            [ffmpeg, '-nostats', '-ss', str(out_position), '-t',
+             str(sample_length), '-i', output_file, '-ss',
+             str(source_position), '-t', str(sample_length), '-i',
+             input_file, '-lavfi', '{};[0:v:0][ref]ssim'.format(reference),
+             '-f', 'null', '-'],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True
+        ).communicate()[0]
+        match = re.search(r'SSIM .*All:([\d.]+)', result)
+        return errors, float(match.group(1)) if match else None
+
+    tasks = [(window, BackgroundTask(check_window, *window))
+             for window in windows]
+    for (out_position, source_position), task in tasks:
+        errors, ssim = task.result()
+        if errors:
+            problems.append('Decode errors at {:.0f}s: {}'
+                            .format(out_position, errors.splitlines()[0]))
+        if ssim is None:
+            problems.append('Unable to compare output at {:.0f}s'
+                            .format(out_position))
+        elif ssim < settings.file.verifyssim:
+            problems.append('Output at {:.0f}s does not match source, '
+                            'SSIM {:.3f}'.format(out_position, ssim))
+        else:
+            logging.debug('Verified output at {:.0f}s SSIM {:.3f}'
+                          .format(out_position, ssim))
+    return problems
+
+
+def clone_file(source, destination):
+    """
+    Create destination as a copy of source using a copy-on-write reflink
+    where the filesystem supports it, then a hardlink, falling back to a
+    full copy. A hardlinked copy is only safe as long as source is replaced
+    rather than written in place. returns the method used
+    """
+    import fcntl
+    # FICLONE ioctl request from linux/fs.h
+    ficlone = 0x40049409
+    try:
+        with open(source, 'rb') as src:
+            with open(destination, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), ficlone, src.fileno())
+        return 'reflink'
+    except (IOError, OSError) as e:
+        logging.debug('Reflink unavailable: {}'.format(e))
+        if os.path.isfile(destination):
+            os.remove(destination)
+    try:
+        os.link(source, destination)
+        return 'hardlink'
+    except OSError as e:
+        logging.debug('Hardlink unavailable: {}'.format(e))
+    shutil.copyfile(source, destination)
+    return 'copy'
+
+
+class CachePolicy:
+    """
+    Page cache hints for large sequential reads and writes. Files are read
+    with sequential readahead and pages of files that are fully consumed or
+    verified are dropped so transcoding does not evict the backend's
+    working set. With enabled False only the buffered copy and hash are used
+    """
+    # posix_fadvise advice values (linux)
+    SEQUENTIAL = 2
+    WILLNEED = 3
+    DONTNEED = 4
+    # copy and hash buffer size, a multiple of the page size
+    buffer_size = 8 * 1024 * 1024
+    # written bytes to accumulate before syncing and dropping
+    sync_size = 64 * 1024 * 1024
+    _libc = None
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def fadvise(self, fd, advice, offset=0, length=0):
+        """Apply posix_fadvise advice to an open file descriptor"""
+        if not self.enabled:
+            return
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, offset, length, advice)
+                return
+            import ctypes
+            import ctypes.util
+            if CachePolicy._libc is None:
+                CachePolicy._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                                use_errno=True
+                                                )
+            CachePolicy._libc.posix_fadvise(fd, ctypes.c_int64(offset),
+                                            ctypes.c_int64(length), advice
+                                            )
+        except (AttributeError, OSError) as e:
+            logging.debug('posix_fadvise unavailable: {}'.format(e))
+            self.enabled = False
+
+    def drop(self, path, offset=0, length=0, sync=False):
+        """Drop cached pages of path, flushing written data first if sync"""
+        if not self.enabled or not os.path.isfile(path):
+            return
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if sync:
+                os.fdatasync(fd)
+            self.fadvise(fd, self.DONTNEED, offset, length)
+        finally:
+            os.close(fd)
+
+    def sha1(self, path):
+        """Return the sha1 hash of path, dropping pages as they are read"""
+        import hashlib
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            self.fadvise(f.fileno(), self.SEQUENTIAL)
+            offset = 0
+            while True:
+                data = f.read(self.buffer_size)
+                if not data:
+                    break
+                sha1.update(data)
+                self.bytes_read = self.bytes_read + len(data)
+                self.fadvise(f.fileno(), self.DONTNEED, offset, len(data))
+                offset = offset + len(data)
+        return sha1.hexdigest()
+
+    def copy(self, source, destination):
+        """
+        Copy source to destination using large buffers, dropping copied
+        pages behind the copy. returns the sha1 hash of the copied data
+        """
+        import hashlib
+        sha1 = hashlib.sha1()
+        with open(source, 'rb') as src:
+            with open(destination, 'wb') as dst:
+                self.fadvise(src.fileno(), self.SEQUENTIAL)
+                offset = 0
+                synced = 0
+                while True:
+                    data = src.read(self.buffer_size)
+                    if not data:
+                        break
+                    sha1.update(data)
+                    dst.write(data)
+                    self.bytes_read = self.bytes_read + len(data)
+                    self.bytes_written = self.bytes_written + len(data)
+                    self.fadvise(src.fileno(), self.DONTNEED, offset,
+                                 len(data)
+                                 )
+                    offset = offset + len(data)
+                    if self.enabled and offset - synced >= self.sync_size:
+                        dst.flush()
+                        os.fdatasync(dst.fileno())
+                        self.fadvise(dst.fileno(), self.DONTNEED, synced,
+                                     offset - synced
+                                     )
+                        synced = offset
+                dst.flush()
+                if self.enabled:
+                    os.fdatasync(dst.fileno())
+                    self.fadvise(dst.fileno(), self.DONTNEED)
+        return sha1.hexdigest()
+
+
+class DropBehind:
+    """
+    Drop cached pages behind a child process reading sources and writing
+    outputs. sources are dropped up to the fraction of the job completed
+    and outputs, which may be glob patterns, up to their current size.
+    A lag of recently used data is kept cached. Only the recording and
+    final outputs are given, intermediate files are read again soon
+    """
+    interval = 10
+    lag = 64 * 1024 * 1024
+
+    def __init__(self, policy, sources=None, outputs=None):
+        self.policy = policy
+        self.sources = sources or []
+        self.outputs = outputs or []
+        self.last_update = time.time()
+        for source in self.sources:
+            if os.path.isfile(source):
+                fd = os.open(source, os.O_RDONLY)
+                try:
+                    self.policy.fadvise(fd, self.policy.SEQUENTIAL)
+                    # start readahead of the first part of the file
+                    self.policy.fadvise(fd, self.policy.WILLNEED, 0, self.lag)
+                finally:
+                    os.close(fd)
+
+    def update(self, fraction, force=False):
+        """Drop pages behind the child given the fraction complete"""
+        if not self.policy.enabled:
+            return
+        if not force and time.time() - self.last_update < self.interval:
+            return
+        self.last_update = time.time()
+        for source in self.sources:
+            if os.path.isfile(source):
+                consumed = int(os.path.getsize(source) * fraction) - self.lag
+                if consumed > 0:
+                    self.policy.drop(source, 0, consumed)
+        for pattern in self.outputs:
+            for output in glob(pattern):
+                written = os.path.getsize(output) - self.lag
+                if written > 0:
+                    self.policy.drop(output, 0, written, sync=True)
+
+    def finish(self):
+        """Drop all remaining pages once the child has finished"""
+        self.lag = 0
+        self.update(1, force=True)
+
+
+def poll_child(process, metrics=None, name=None):
+    """
+    Check if process has finished, reaping it with os.wait4 so its resource
+    usage can be added to metrics under name. returns the return code or
+    None while the process is running
+    """
+    if process.returncode is not None:
+        return process.returncode
+    pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+    if pid == 0:
+        return None
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    if metrics:
+        metrics.add_child(name, rusage)
+    return process.returncode
+
+
+class JobMetrics:
+    """
+    Per-job record of phase wall times, child process resource usage,
+    bytes read and written and encode speed. Written as a json line and
+    optionally a Prometheus textfile collector file
+    """
+    def __init__(self, jobid=None, chanid=None, starttime=None):
+        self.record = {'jobid': jobid, 'chanid': chanid,
+                       'starttime': str(starttime), 'started': time.time(),
+                       'status': 'failed', 'phases': {}, 'children': [],
+                       'bytes_read': 0, 'bytes_written': 0
+                       }
+        self.child_start = {}
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager adding the wall time of the block to name"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            phases = self.record['phases']
+            phases[name] = phases.get(name, 0) + time.time() - start
+
+    def start_child(self, name):
+        """Note the start time of a child process"""
+        self.child_start[name] = time.time()
+
+    def add_child(self, name, rusage, frames=0):
+        """Add the resource usage of a finished child process"""
+        wall_time = time.time() - self.child_start.pop(name, time.time())
+        child = {'name': name, 'wall_time': wall_time,
+                 'user_time': rusage.ru_utime, 'system_time': rusage.ru_stime,
+                 # ru_maxrss is in kilobytes on linux
+                 'max_rss': rusage.ru_maxrss * 1024,
+                 'bytes_read': rusage.ru_inblock * 512,
+                 'bytes_written': rusage.ru_oublock * 512,
+                 'frames': frames, 'fps': 0
+                 }
+        self.record['children'].append(child)
+        self.add_io(child['bytes_read'], child['bytes_written'])
+
+    def set_frames(self, name, frames, active_time):
+        """Record frames processed and fps of the last child named name"""
+        for child in reversed(self.record['children']):
+            if child['name'] == name:
+                child['frames'] = frames
+                if active_time > 0:
+                    child['fps'] = frames / active_time
+                break
+
+    def add_io(self, read=0, written=0):
+        """Add bytes read and written to the job totals"""
+        self.record['bytes_read'] = self.record['bytes_read'] + read
+        self.record['bytes_written'] = self.record['bytes_written'] + written
+
+    def write(self, jsonl_file, textfile=None):
+        """Append the record to jsonl_file and write the textfile"""
+        self.record['wall_time'] = time.time() - self.record['started']
+        try:
+            with open(jsonl_file, 'a') as jf:
+                jf.write(u'{}\n'.format(json.dumps(self.record,
+                                                   sort_keys=True)))
+        except IOError as e:
+            logging.error('Unable to write metrics: {}'.format(e))
+        if textfile:
+            self.write_textfile(textfile)
+
+    def write_textfile(self, textfile):
+        """
+        Write the record as a Prometheus textfile collector file. Series
+        are labelled with the job, child series also with the position of
+        the child as several children share a name
+        """
+        record = self.record
+        job = 'jobid="{}",chanid="{}",starttime="{}"'.format(
+            record['jobid'] or '', record['chanid'] or '',
+            record['starttime'])
+        lines = ['# TYPE transcode_job_seconds gauge',
+                 'transcode_job_seconds{{{},status="{}"}} {:.3f}'
+                 .format(job, record['status'], record['wall_time']),
+                 '# TYPE transcode_job_timestamp_seconds gauge',
+                 'transcode_job_timestamp_seconds{{{}}} {:.0f}'
+                 .format(job, record['started']),
+                 '# TYPE transcode_job_bytes_read gauge',
+                 'transcode_job_bytes_read{{{}}} {}'
+                 .format(job, record['bytes_read']),
+                 '# TYPE transcode_job_bytes_written gauge',
+                 'transcode_job_bytes_written{{{}}} {}'
+                 .format(job, record['bytes_written']),
+                 '# TYPE transcode_phase_seconds gauge'
+                 ]
+        for name, seconds in sorted(record['phases'].items()):
+            lines.append('transcode_phase_seconds{{{},phase="{}"}} {:.3f}'
+                         .format(job, name, seconds))
+        children = ['{},child="{}",index="{}"'.format(job, child['name'],
+                                                      index)
+                    for index, child in enumerate(record['children'])]
+        lines.append('# TYPE transcode_child_cpu_seconds gauge')
+        for labels, child in zip(children, record['children']):
+            lines.append('transcode_child_cpu_seconds{{{}}} {:.3f}'
+                         .format(labels, child['user_time']
+                                 + child['system_time']))
+        lines.append('# TYPE transcode_child_max_rss_bytes gauge')
+        for labels, child in zip(children, record['children']):
+            lines.append('transcode_child_max_rss_bytes{{{}}} {}'
+                         .format(labels, child['max_rss']))
+        lines.append('# TYPE transcode_child_fps gauge')
+        for labels, child in zip(children, record['children']):
+            lines.append('transcode_child_fps{{{}}} {:.2f}'
+                         .format(labels, child['fps']))
+        temp_file = '{}.tmp'.format(textfile)
+        try:
+            with open(temp_file, 'w') as tf:
+                tf.write(u'{}\n'.format('\n'.join(lines)))
+            os.rename(temp_file, textfile)
+        except (IOError, OSError) as e:
+            logging.error('Unable to write metrics textfile: {}'.format(e))
+
+
+def job_profile(av_info, metadata, settings):
+    """
+    Return a dict describing a job for the history database: the encoding
+    profile in use and the characteristics of the source
+    """
+    hd = av_info.video.height >= 720 and av_info.video.width >= 1280
+    definition = 'hd' if hd else 'sd'
+    return {'commethod': settings.file.commethod,
+            'definition': definition,
+            'codec': settings.video['codec{}'.format(definition)],
+            'preset': settings.video['preset{}'.format(definition)],
+            'crf': settings.video['crf{}'.format(definition)],
+            'export': int(bool(settings.file.export)),
+            'width': av_info.video.width, 'height': av_info.video.height,
+            'frame_rate': av_info.video.frame_rate,
+            'duration': float(av_info.duration),
+            'kept_duration': get_kept_duration(av_info, metadata, settings)
+            }
+
+
+class JobHistory:
+    """
+    SQLite history of finished jobs used to predict job and phase durations
+    from similar past jobs and to report encoding capacity
+    """
+    # number of recent similar jobs used for predictions
+    sample_size = 20
+
+    def __init__(self, history_file=None):
+        import sqlite3
+        if not history_file:
+            history_file = job_history_file
+        self.connection = sqlite3.connect(history_file, timeout=30)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS jobs (finished REAL, host TEXT, '
+            'status TEXT, commethod TEXT, definition TEXT, codec TEXT, '
+            'preset TEXT, crf INTEGER, export INTEGER, width INTEGER, '
+            'height INTEGER, frame_rate REAL, interlaced INTEGER, '
+            'duration REAL, kept_duration REAL, source_size INTEGER, '
+            'output_size INTEGER, wall_time REAL, cpu_time REAL, '
+            'encode_fps REAL, phases TEXT)'
+        )
+        self.connection.commit()
+
+    def add(self, profile, metrics, source_size=0, output_size=0,
+            interlaced=None):
+        """Store a finished job described by profile and its JobMetrics"""
+        record = metrics.record
+        cpu_time = sum(child['user_time'] + child['system_time']
+                       for child in record['children'])
+        # frames over active time of every encode, segmented and rendition
+        #  encodes run several, NULL if no encode reported progress
+        encodes = [child for child in record['children']
+                   if child['name'] == 'Encoding' and child['fps'] > 0]
+        encode_fps = None
+        if encodes:
+            encode_fps = (sum(child['frames'] for child in encodes)
+                          / sum(child['frames'] / child['fps']
+                                for child in encodes))
+        with self.connection:
+            self.connection.execute(
+                'INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '
+                '?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (time.time(), platform.node(), record['status'],
+                 profile['commethod'], profile['definition'],
+                 profile['codec'], profile['preset'], profile['crf'],
+                 profile['export'], profile['width'], profile['height'],
+                 profile['frame_rate'], interlaced, profile['duration'],
+                 profile['kept_duration'], source_size, output_size,
+                 time.time() - record['started'], cpu_time, encode_fps,
+                 json.dumps(record['phases'])
+                 )
+            )
+
+    def similar(self, profile):
+        """
+        Return recent finished jobs similar to profile, widening the match
+        from the full encoding profile to only the commercial method
+        """
+        criteria = [('commethod', 'definition', 'codec', 'preset', 'export'),
+                    ('commethod', 'definition', 'codec'),
+                    ('commethod', 'definition'),
+                    ('commethod',)
+                    ]
+        for columns in criteria:
+            query = ('SELECT duration, wall_time, cpu_time, phases FROM jobs '
+                     'WHERE status = ? AND duration > 0 AND {} '
+                     'ORDER BY finished DESC LIMIT ?'
+                     .format(' AND '.join('{} = ?'.format(column)
+                                          for column in columns))
+                     )
+            arguments = (['finished'] + [profile[column] for column in columns]
+                         + [self.sample_size])
+            rows = self.connection.execute(query, arguments).fetchall()
+            if rows:
+                return rows
+        return []
+
+    def predict(self, profile):
+        """
+        Predict wall time per phase in seconds for profile using the median
+        time per second of source of similar jobs. returns a dict of phase:
+        seconds, empty without history
+        """
+        rows = self.similar(profile)
+        rates = {}
+        for duration, wall_time, cpu_time, phases in rows:
+            for phase, seconds in json.loads(phases).items():
+                rates.setdefault(phase, []).append(seconds / duration)
+        prediction = {}
+        for phase, values in rates.items():
+            values.sort()
+            prediction[phase] = (values[len(values) // 2]
+                                 * profile['duration'])
+        return prediction
+
+    def cpu_ratio(self):
+        """Average cpu seconds used per wall second by recent jobs"""
+        row = self.connection.execute(
+            'SELECT SUM(cpu_time), SUM(wall_time) FROM (SELECT cpu_time, '
+            'wall_time FROM jobs WHERE status = ? ORDER BY finished DESC '
+            'LIMIT 100)', ('finished',)
+        ).fetchone()
+        if row and row[1]:
+            return row[0] / row[1]
+        return None
+
+
+class JobEta:
+    """
+    Whole job ETA from predicted phase durations, refined with the progress
+    of the running phase and smoothed with an exponentially weighted moving
+    average
+    """
+    alpha = 0.2
+
+    def __init__(self, prediction, metrics):
+        self.prediction = prediction
+        self.metrics = metrics
+        self.smoothed = None
+        self.phase = None
+        self.phase_start = time.time()
+
+    def remaining(self, phase=None, phase_remaining=None):
+        """
+        Seconds remaining for the job. phase is the running phase and
+        phase_remaining its measured remaining time if known.
+        returns None without a prediction
+        """
+        if not self.prediction:
+            return phase_remaining
+        if phase != self.phase:
+            self.phase = phase
+            self.phase_start = time.time()
+        done = self.metrics.record['phases']
+        future = sum(seconds for name, seconds in self.prediction.items()
+                     if name not in done and name != phase)
+        if phase_remaining is None:
+            # count down the predicted time of the running phase
+            phase_remaining = max(self.prediction.get(phase, 0)
+                                  - (time.time() - self.phase_start), 0)
+        estimate = future + phase_remaining
+        if self.smoothed is None:
+            self.smoothed = estimate
+        else:
+            self.smoothed = (self.alpha * estimate
+                             + (1 - self.alpha) * self.smoothed)
+        return self.smoothed
+
+    def string(self, phase=None, phase_remaining=None):
+        """Remaining time formatted for job status"""
+        remaining = self.remaining(phase, phase_remaining)
+        if remaining is None:
+            return 'Unknown'
+        return time.strftime('%H:%M:%S', time.gmtime(remaining))
+
+
+def capacity_report(history, window=8):
+    """
+    Print the predicted encoding backlog of this host's queued transcode
+    jobs against the cores available, each job sized from its recording as
+    the queue orders them. window is the nightly encoding window in hours
+    """
+    import multiprocessing
+    cores = multiprocessing.cpu_count()
+    settings = app.settings
+    host_profile = load_host_profile()
+    backlog = 0
+    count = 0
+    for entry in queued_jobs(settings):
+        try:
+            backlog = backlog + job_cost(entry, settings, history,
+                                         host_profile)
+        except Exception as e:
+            logging.debug('Skipping queued job {}: {}'
+                          .format(entry['jobid'], e))
+            continue
+        count = count + 1
+    cpu_ratio = history.cpu_ratio() or cores
+    cpu_hours = backlog * cpu_ratio / 3600
+    print('Queued jobs: {}'.format(count))
+    print('Predicted backlog: {:.1f} hours run one at a time'
+          .format(backlog / 3600))
+    print('Average cores used per job: {:.1f} of {}'.format(cpu_ratio, cores))
+    print('CPU hours required: {:.1f}'.format(cpu_hours))
+    print('Hours to clear using all cores: {:.1f}'.format(cpu_hours / cores))
+    print('Cores needed to clear in {} hours: {:.1f}'
+          .format(window, cpu_hours / window))
+
+
+def queued_jobs(settings):
+    """
+    Return a list of dicts describing queued transcode jobs for this host
+    with their recording's title, recording group and source file. With
+    cluster the jobs of every host whose recording can be read from this
+    host are listed, local is set for recordings made by this host
+    """
+    from MythTV import Recorded, findfile
+    hostname = app.db.gethostname()
+    with app.db as cursor:
+        if settings.file.cluster:
+            cursor.execute('SELECT id, chanid, starttime, inserttime '
+                           'FROM jobqueue WHERE type = %s AND status = 1',
+                           (settings.file.jobtype,)
+                           )
+        else:
+            cursor.execute('SELECT id, chanid, starttime, inserttime '
+                           'FROM jobqueue WHERE type = %s AND status = 1 AND '
+                           '(hostname = %s OR hostname = %s)',
+                           (settings.file.jobtype, '', hostname)
+                           )
+        rows = cursor.fetchall()
+    entries = []
+    for jobid, chanid, starttime, inserttime in rows:
+        try:
+            rec = Recorded((chanid, starttime), db=app.db)
+            sg = findfile('/{}'.format(rec.basename), rec.storagegroup,
+                          db=app.db
+                          )
+            input_file = os.path.join(sg.dirname, rec.basename)
+        except Exception as e:
+            # recordings on another host's storage are expected to be
+            #  unreachable in a cluster
+            if settings.file.cluster:
+                logging.debug('Recording of job {} not reachable: {}'
+                              .format(jobid, e))
+            else:
+                logging.warning('Unable to find recording for job {}: {}'
+                                .format(jobid, e))
+            continue
+        entries.append({'jobid': jobid, 'chanid': chanid,
+                        'starttime': starttime, 'inserttime': inserttime,
+                        'title': u'{}'.format(rec.title),
+                        'recgroup': u'{}'.format(rec.recgroup),
+                        'cutlist': bool(rec.cutlist),
+                        'input_file': input_file,
+                        'local': rec.hostname == hostname
+                        })
+    return entries
+
+
+def job_cost(entry, settings, history, host_profile=None):
+    """
+    Estimate the seconds needed to process a queued job from its duration,
+    resolution and commercial method using the job history, falling back
+    to the encoding speed calibrated on this host, then to the source
+    duration scaled by resolution
+    """
+    av_info = AVInfo(entry['input_file'])
+    hd = av_info.video.height >= 720 and av_info.video.width >= 1280
+    definition = 'hd' if hd else 'sd'
+    profile = {'commethod': settings.file.commethod,
+               'definition': definition,
+               'codec': settings.video['codec{}'.format(definition)],
+               'preset': settings.video['preset{}'.format(definition)],
+               'export': int(bool(settings.file.export)),
+               'duration': float(av_info.duration)
+               }
+    prediction = history.predict(profile)
+    if prediction:
+        return sum(prediction.values())
+    if settings.file.commethod != 'only-cut':
+        if host_profile is None:
+            host_profile = load_host_profile()
+        calibration = calibrated_speed(
+            host_profile, profile['codec'], profile['preset'],
+            settings.video['crf{}'.format(definition)], definition)
+        if calibration:
+            return (float(av_info.duration) * av_info.video.frame_rate
+                    / calibration[0])
+    pixels = av_info.video.width * av_info.video.height
+    cost = float(av_info.duration) * pixels / (720 * 480)
+    if settings.file.commethod == 'only-cut':
+        cost = cost / 20
+    return cost
+
+
+def job_priority(entry, rules):
+    """
+    Priority of a queued job from a list of rule dicts with match
+    (title or recgroup), pattern (regular expression) and priority.
+    The first matching rule is used, unmatched jobs have priority 0
+    """
+    for rule in rules:
+        value = entry.get(rule['match'], u'')
+        if re.search(rule['pattern'], value, re.IGNORECASE):
+            return rule['priority']
+    return 0
+
+
+def order_queue(entries, settings, history, now=None):
+    """
+    Order queued jobs by the configured queue policy.
+    fifo: queue order
+    sjf: shortest estimated job first
+    priority: by priority rule then shortest job first
+    sjf and priority order by the estimated seconds less a credit of
+    queueaging seconds per second waited, so long jobs are not starved,
+    and with priority an hour per priority point
+    """
+    policy = settings.file.queuepolicy
+    if policy == 'fifo':
+        return sorted(entries, key=lambda entry: entry['inserttime'])
+    if not now:
+        now = datetime.utcnow()
+    host_profile = load_host_profile()
+    for entry in entries:
+        if 'cost' not in entry:
+            try:
+                entry['cost'] = job_cost(entry, settings, history,
+                                         host_profile=host_profile)
+            except Exception as e:
+                logging.warning('Unable to estimate job {}: {}'
+                                .format(entry['jobid'], e))
+                entry['cost'] = float('inf')
+        priority = 0
+        if policy == 'priority':
+            priority = job_priority(entry, settings.file.priorityrules)
+        waited = (now - entry['inserttime']).total_seconds()
+        entry['priority'] = priority
+        entry['score'] = (entry['cost'] - waited * settings.file.queueaging
+                          - priority * 3600)
+    return sorted(entries, key=lambda entry: entry['score'])
+
+
+def claim_job(jobid):
+    """
+    Mark a queued job as starting on this host. returns False if another
+    host or the backend started it first
+    """
+    with app.db as cursor:
+        claimed = cursor.execute('UPDATE jobqueue SET status = 3, '
+                                 'hostname = %s, statustime = UTC_TIMESTAMP() '
+                                 'WHERE id = %s AND status = 1',
+                                 (app.db.gethostname(), jobid)
+                                 )
+    return bool(claimed)
+
+
+class JobLeases:
+    """
+    Leases on claimed jobs in the transcode_lease table of the MythTV
+    database, shared by the workers of a cluster of hosts. The queue
+    worker claiming a job leases it to its host, the process running the
+    job renews the lease as its heartbeat. The jobs of leases left to
+    expire, by a host or job process that died, are queued again for any
+    worker
+    """
+    # jobqueue status of jobs a worker is running: starting, running and
+    #  paused
+    active = (3, 4, 6)
+
+    def __init__(self, lease_time=300):
+        self.lease_time = lease_time
+        self.worker = '{}:{}'.format(app.db.gethostname(), os.getpid())
+        self.renewed = 0
+
+    @staticmethod
+    def drop_table():
+        """Remove the lease table from the MythTV database"""
+        with app.db as cursor:
+            cursor.execute('DROP TABLE IF EXISTS transcode_lease')
+
+    def create_table(self):
+        """Create the lease table if it does not exist"""
+        with app.db as cursor:
+            cursor.execute('CREATE TABLE IF NOT EXISTS transcode_lease ('
+                           'jobid INT UNSIGNED NOT NULL PRIMARY KEY, '
+                           'hostname VARCHAR(64) NOT NULL, '
+                           'worker VARCHAR(128) NOT NULL, '
+                           'heartbeat DATETIME NOT NULL, '
+                           'expires DATETIME NOT NULL, KEY (expires))'
+                           )
+
+    def claim(self, jobid):
+        """
+        Mark a queued job as starting on this host and lease it to this
+        worker. returns False if another worker started it first
+        """
+        if not claim_job(jobid):
+            return False
+        with app.db as cursor:
+            cursor.execute('REPLACE INTO transcode_lease (jobid, hostname, '
+                           'worker, heartbeat, expires) VALUES (%s, %s, %s, '
+                           'UTC_TIMESTAMP(), UTC_TIMESTAMP() + INTERVAL %s '
+                           'SECOND)',
+                           (jobid, app.db.gethostname(), self.worker,
+                            self.lease_time)
+                           )
+        return True
+
+    def renew(self, jobid, force=False):
+        """
+        Heartbeat of the process running jobid, extending the lease of
+        this host. Runs at most three times per lease time unless force.
+        returns False if this host no longer holds the lease
+        """
+        if not force and time.time() - self.renewed < self.lease_time / 3:
+            return True
+        with app.db as cursor:
+            cursor.execute('UPDATE transcode_lease SET '
+                           'heartbeat = UTC_TIMESTAMP(), '
+                           'expires = UTC_TIMESTAMP() + INTERVAL %s SECOND '
+                           'WHERE jobid = %s AND hostname = %s',
+                           (self.lease_time, jobid, app.db.gethostname())
+                           )
+            cursor.execute('SELECT COUNT(*) FROM transcode_lease '
+                           'WHERE jobid = %s AND hostname = %s',
+                           (jobid, app.db.gethostname())
+                           )
+            row = cursor.fetchone()
+        self.renewed = time.time()
+        return bool(row and row[0])
+
+    def release(self, jobid, returncode=0):
+        """
+        Remove the lease of a finished job. A job that exited with an
+        error without updating its status is marked as errored
+        """
+        with app.db as cursor:
+            released = cursor.execute('DELETE FROM transcode_lease '
+                                      'WHERE jobid = %s AND worker = %s',
+                                      (jobid, self.worker)
+                                      )
+            if released and returncode:
+                cursor.execute('UPDATE jobqueue SET status = 304, '
+                               'comment = %s WHERE id = %s AND status IN '
+                               '({})'.format(', '.join(
+                                   str(status) for status in self.active)),
+                               ('Worker exited with code {}'
+                                .format(returncode), jobid)
+                               )
+
+    def expire(self):
+        """
+        Queue the jobs of expired leases again and remove the leases.
+        returns the number of jobs queued again
+        """
+        with app.db as cursor:
+            requeued = cursor.execute(
+                'UPDATE jobqueue, transcode_lease SET jobqueue.status = 1, '
+                'jobqueue.hostname = %s, jobqueue.comment = CONCAT('
+                '%s, transcode_lease.worker) '
+                'WHERE jobqueue.id = transcode_lease.jobid AND '
+                'transcode_lease.expires < UTC_TIMESTAMP() AND '
+                'jobqueue.status IN ({})'.format(', '.join(
+                    str(status) for status in self.active)),
+                ('', 'Queued again, lease expired on ')
+            )
+            cursor.execute('DELETE FROM transcode_lease '
+                           'WHERE expires < UTC_TIMESTAMP()'
+                           )
+            # leases of jobs deleted from the queue
+            cursor.execute('DELETE transcode_lease FROM transcode_lease '
+                           'LEFT JOIN jobqueue ON jobqueue.id = '
+                           'transcode_lease.jobid WHERE jobqueue.id IS NULL'
+                           )
+        if requeued:
+            logging.warning('Queued {} jobs of expired leases again'
+                            .format(requeued))
+        return requeued
+
+
+def backend_job_hosts(settings):
+    """
+    Hosts whose backend is allowed to start the configured user job
+    itself, racing the queue worker for the queued jobs
+    """
+    user_job = {256: 1, 512: 2, 1024: 3, 2048: 4}.get(settings.file.jobtype)
+    if not user_job:
+        return []
+    with app.db as cursor:
+        cursor.execute('SELECT hostname FROM settings WHERE value = %s '
+                       'AND data = %s',
+                       ('JobAllowUserJob{}'.format(user_job), '1')
+                       )
+        rows = cursor.fetchall()
+    return [row[0] for row in rows]
+
+
+def run_queue(settings, parallel=1, daemon=False, poll_interval=60):
+    """
+    Run queued transcode jobs in queue policy order, up to parallel at a
+    time. The queue is re-ordered each time a job is started so newly
+    queued recordings are considered. With daemon the queue is polled
+    until stopped, otherwise returns once the queue is empty.
+    With cluster jobs are leased through the database, a recording made
+    by another host is only started once it waited clusteraffinity
+    seconds for a worker on that host
+    """
+    hosts = backend_job_hosts(settings)
+    if hosts:
+        logging.warning('The backend of {} also starts the queued jobs, '
+                        'disallow the user job for these hosts in '
+                        'mythtv-setup for the queue order to be kept'
+                        .format(', '.join(hosts)))
+    history = JobHistory()
+    running = []
+    costs = {}
+    leases = None
+    if settings.file.cluster:
+        leases = JobLeases(settings.file.leasetime)
+        leases.create_table()
+    while True:
+        if leases:
+            for process in running:
+                if process.poll() is not None:
+                    leases.release(process.jobid, process.returncode)
+        running = [process for process in running if process.poll() is None]
+        if leases:
+            leases.expire()
+        if len(running) < parallel:
+            entries = queued_jobs(settings)
+            for entry in entries:
+                if entry['jobid'] in costs:
+                    entry['cost'] = costs[entry['jobid']]
+            entries = order_queue(entries, settings, history)
+            started = False
+            now = datetime.utcnow()
+            for entry in entries:
+                costs[entry['jobid']] = entry.get('cost')
+                if leases:
+                    # leave the recordings of other hosts to their own
+                    #  workers first so sources are read locally
+                    waited = (now - entry['inserttime']).total_seconds()
+                    if (not entry['local']
+                            and waited < settings.file.clusteraffinity):
+                        continue
+                    if not leases.claim(entry['jobid']):
+                        continue
+                elif not claim_job(entry['jobid']):
+                    continue
+                logging.info('Starting job {} {} estimated {:.0f}s'
+                             .format(entry['jobid'], entry['title'],
+                                     entry.get('cost', 0)))
+                process = subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__), '--jobid',
+                     str(entry['jobid'])]
+                )
+                process.jobid = entry['jobid']
+                running.append(process)
+                started = True
+                break
+            if started:
+                continue
+            if not running and not daemon:
+                break
+        time.sleep(poll_interval if not running else 5)
+
+
 def get_free_space(path):
     """Get available space in path"""
     st = os.statvfs(path)
@@ -214,14 +1690,13 @@ class AVInfo(dict):
     self.video dict a list of self.audio.stream dicts,
     and self.duration as float
     """
-    ffprobe = program_check('ffprobe', 'mythffprobe')
 
     def __init__(self=None, input_file=None, **kwargs):
         super(AVInfo, self).__init__(**kwargs)
         self.audio = None
         self.duration = None
         self.video = None
-        command = [self.ffprobe, '-v', '-8', '-show_entries',
+        command = [app.ffprobe, '-v', '-8', '-show_entries',
                    'stream=codec_type,index,codec_name,channels,width,'
                    'height,r_frame_rate:stream_tags=language:'
                    'format=duration', '-of', 'csv=nk=0:p=0', input_file
@@ -303,6 +1778,645 @@ def remove_temp(tmpdir):
         logging.error(e)
 
 
+def checkpoint_key(input_file, settings, metadata):
+    """
+    Identify the work of a job: the source file and every setting or cut
+    list that changes the outputs of a pipeline stage
+    """
+    import hashlib
+    stat = os.stat(input_file)
+    identity = {'input_file': input_file, 'size': stat.st_size,
+                'mtime': stat.st_mtime, 'file': settings.file,
+                'video': settings.video, 'audio': settings.audio,
+                'cutlists': metadata.cutlists if metadata else None
+                }
+    return hashlib.sha1(json.dumps(identity, sort_keys=True, default=str)
+                        .encode('UTF-8')).hexdigest()
+
+
+def find_checkpoint(candidates, input_file, max_age=0):
+    """
+    Return the directory from candidates holding a checkpointed temporary
+    directory for input_file, None if there is none. Checkpointed
+    directories of other recordings not changed for max_age seconds are
+    removed, 0 keeps them
+    """
+    name = os.path.basename(input_file).rsplit('.')[0]
+    if max_age:
+        remove_stale_checkpoints(candidates, max_age, keep=name)
+    for path in candidates:
+        if os.path.isfile(os.path.join(path, name, Checkpoint.manifest_name)):
+            return path
+    return None
+
+
+def remove_stale_checkpoints(candidates, max_age, keep=None):
+    """
+    Remove the checkpointed temporary directories in candidates, left by
+    failed jobs, whose files were not changed for max_age seconds. The
+    directory named keep is left for the job resuming from it
+    """
+    now = time.time()
+    for path in candidates:
+        if not os.path.isdir(path):
+            continue
+        for name in os.listdir(path):
+            temp_dir = os.path.join(path, name)
+            if name == keep or not os.path.isfile(
+                    os.path.join(temp_dir, Checkpoint.manifest_name)):
+                continue
+            try:
+                changed = max(os.path.getmtime(os.path.join(temp_dir, item))
+                              for item in os.listdir(temp_dir))
+            except OSError:
+                continue
+            if now - changed > max_age:
+                logging.info('Removing stale checkpoint {}'.format(temp_dir))
+                remove_temp(temp_dir)
+
+
+class Checkpoint:
+    """
+    Manifest of the completed pipeline stages of a job kept in its
+    temporary directory. Each stage records its output files with size
+    and modification time so a rerun after a crash or reboot can reuse
+    stages whose outputs are unchanged, and optionally results of the
+    stage to restore. Stages are ordered, rerunning a stage discards the
+    stages completed after it
+    """
+    manifest_name = 'checkpoint.json'
+
+    def __init__(self, temp_dir, key):
+        self.manifest_file = os.path.join(temp_dir, self.manifest_name)
+        self.key = key
+        self.stages = []
+        self.resumable = False
+        try:
+            with open(self.manifest_file, 'r') as mf:
+                manifest = json.load(mf)
+            if manifest.get('key') == key:
+                self.stages = manifest['stages']
+                self.resumable = True
+            else:
+                logging.info('Checkpoint is for different settings or source')
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def _write(self):
+        temp_file = '{}.tmp'.format(self.manifest_file)
+        with open(temp_file, 'w') as mf:
+            mf.write(u'{}'.format(json.dumps({'key': self.key,
+                                               'stages': self.stages
+                                               })))
+        os.rename(temp_file, self.manifest_file)
+
+    def _index(self, stage):
+        for index, entry in enumerate(self.stages):
+            if entry['name'] == stage:
+                return index
+        return None
+
+    def done(self, stage):
+        """True if stage completed and its outputs are unchanged"""
+        index = self._index(stage)
+        if index is None:
+            return False
+        for path, item in self.stages[index]['outputs'].items():
+            if (not os.path.isfile(path)
+                    or os.path.getsize(path) != item['size']
+                    or os.path.getmtime(path) != item.get('mtime')):
+                logging.warning('Checkpoint output changed or missing: {}'
+                                .format(path))
+                self.start(stage)
+                return False
+        logging.info('Reusing completed stage: {}'.format(stage))
+        return True
+
+    def data(self, stage):
+        """Results recorded with a completed stage"""
+        index = self._index(stage)
+        if index is None:
+            return {}
+        return self.stages[index].get('data', {})
+
+    def outputs(self, stage):
+        """Sorted output files of a completed stage"""
+        index = self._index(stage)
+        if index is None:
+            return []
+        return sorted(self.stages[index]['outputs'].keys())
+
+    def start(self, stage):
+        """Discard stage and the stages completed after it"""
+        index = self._index(stage)
+        if index is not None:
+            del self.stages[index:]
+            self._write()
+
+    def complete(self, stage, outputs, data=None):
+        """
+        Record stage as completed with its output files and a dict of
+        results data
+        """
+        self.start(stage)
+        self.stages.append(
+            {'name': stage, 'finished': time.time(),
+             'outputs': dict((path, {'size': os.path.getsize(path),
+                                     'mtime': os.path.getmtime(path)})
+                             for path in outputs),
+             'data': data or {}
+             })
+        self._write()
+
+
+class JobControl:
+    """
+    Supervise a running child process on behalf of the MythTV job queue.
+    Honours pause, resume and stop commands set on the job by the frontend
+    and optionally pauses the child while the backend is recording or
+    playing back, or outside window hours. self.paused_time holds the
+    total seconds spent paused. With cluster the job's lease is renewed, the job is abandoned if the
+    lease was lost to another host
+    """
+    # jobqueue cmds values
+    JOB_RUN = 0x0000
+    JOB_PAUSE = 0x0001
+    JOB_RESUME = 0x0002
+    JOB_STOP = 0x0004
+    # inuseprograms usage considered to be backend load, filetransfer is
+    #  a recording streamed to a remote frontend
+    load_usage = ('player', 'pipplayer', 'pbpplayer', 'filetransfer',
+                  'recorder')
+    # seconds between database checks
+    poll_interval = 5
+    # JobControl of the running encoder, stopped on SIGTERM
+    current = None
+
+    def __init__(self, job=None, db=None, auto_pause=False, temp_dir=None,
+                 window=None):
+        self.job = job
+        if not db and (job or auto_pause):
+            db = app.db
+        self.db = db
+        self.auto_pause = auto_pause
+        self.window = window
+        self.temp_dir = temp_dir
+        self.paused_time = 0
+        self.last_poll = 0
+        self.process = None
+        self.lease = None
+        if job and app.settings.file.cluster:
+            self.lease = JobLeases(app.settings.file.leasetime)
+            # jobs started without a queue worker have no lease
+            if not self.lease.renew(job.id, force=True):
+                self.lease = None
+        if temp_dir:
+            JobControl.current = self
+
+    @staticmethod
+    def terminated(signum, frame):
+        """
+        SIGTERM handler of a job process: stop the running FFmpeg process
+        and remove the temporary files. A leased job is left to be queued
+        again when its lease expires, other jobs are aborted
+        """
+        logging.warning('Terminated')
+        control = JobControl.current
+        if control:
+            control.abandon(control.process)
+            if control.job and not control.lease:
+                control.job.update({'status': control.job.ABORTED,
+                                    'comment': 'Terminated'
+                                    }
+                                   )
+        sys.exit(1)
+
+    def renew_lease(self, process=None):
+        """
+        Renew the job's lease, abandoning the job and exiting if another
+        host took it over
+        """
+        if self.lease and not self.lease.renew(self.job.id):
+            logging.error('Lease of job {} lost to another host'
+                          .format(self.job.id))
+            self.abandon(process)
+            sys.exit(1)
+
+    def job_command(self):
+        """Return the current cmds value of the job from the database"""
+        if not self.job:
+            return self.JOB_RUN
+        try:
+            with self.db as cursor:
+                cursor.execute('SELECT cmds FROM jobqueue WHERE id=%s',
+                               (self.job.id,)
+                               )
+                row = cursor.fetchone()
+        except Exception as e:
+            logging.error('Unable to read job command: {}'.format(e))
+            return self.JOB_RUN
+        if row:
+            return int(row[0])
+        return self.JOB_RUN
+
+    def clear_command(self):
+        """Acknowledge a handled job command"""
+        try:
+            with self.db as cursor:
+                cursor.execute('UPDATE jobqueue SET cmds=%s WHERE id=%s',
+                               (self.JOB_RUN, self.job.id)
+                               )
+        except Exception as e:
+            logging.error('Unable to clear job command: {}'.format(e))
+
+    def backend_busy(self):
+        """Check if the backend reports active playback or recording"""
+        if not self.auto_pause or not self.db:
+            return False
+        usage = ','.join(['%s'] * len(self.load_usage))
+        try:
+            with self.db as cursor:
+                cursor.execute('SELECT COUNT(*) FROM inuseprograms '
+                               'WHERE recusage IN ({}) AND lastupdatetime > '
+                               'UTC_TIMESTAMP() - INTERVAL 1 HOUR'
+                               .format(usage), self.load_usage
+                               )
+                row = cursor.fetchone()
+        except Exception as e:
+            logging.error('Unable to read backend load: {}'.format(e))
+            return False
+        return bool(row and row[0])
+
+    def abandon(self, process):
+        """Terminate process and remove temporary files"""
+        if process and process.poll() is None:
+            try:
+                os.kill(process.pid, signal.SIGCONT)
+            except OSError:
+                pass
+            process.terminate()
+            process.wait()
+        if self.temp_dir:
+            remove_temp(self.temp_dir)
+
+    def stop(self, process):
+        """Terminate process, remove temporary files and end the job"""
+        logging.warning('Stop requested terminating process')
+        self.abandon(process)
+        if self.job:
+            self.clear_command()
+            self.job.update({'status': self.job.ABORTED,
+                             'comment': 'Stopped by user'
+                             }
+                            )
+        sys.exit(1)
+
+    def check(self, process, prefix='Encoding'):
+        """
+        Poll job command and backend load, blocking while the job is
+        paused. Returns seconds spent paused during this call
+        """
+        self.process = process
+        now = time.time()
+        if now - self.last_poll < self.poll_interval:
+            return 0
+        self.last_poll = now
+        self.renew_lease(process)
+        command = self.job_command()
+        if command & self.JOB_STOP:
+            self.stop(process)
+        pause_reason = None
+        if command & self.JOB_PAUSE:
+            pause_reason = 'Paused by user'
+        elif self.backend_busy():
+            pause_reason = 'Paused while backend is busy'
+        elif self.window and not in_window(self.window):
+            pause_reason = 'Paused outside the window hours'
+        if not pause_reason:
+            return 0
+
+        logging.info('{}: {}'.format(prefix, pause_reason))
+        pause_start = time.time()
+        os.kill(process.pid, signal.SIGSTOP)
+        if self.job:
+            self.job.update({'status': self.job.PAUSED,
+                             'comment': '{}: {}'.format(prefix, pause_reason)
+                             }
+                            )
+        while True:
+            time.sleep(self.poll_interval)
+            self.renew_lease(process)
+            command = self.job_command()
+            if command & self.JOB_STOP:
+                self.stop(process)
+            if command & self.JOB_RESUME:
+                break
+            if command & self.JOB_PAUSE:
+                continue
+            if self.window and not in_window(self.window):
+                continue
+            if not self.backend_busy():
+                break
+        os.kill(process.pid, signal.SIGCONT)
+        if self.job and command != self.JOB_RUN:
+            self.clear_command()
+        paused = time.time() - pause_start
+        self.paused_time = self.paused_time + paused
+        logging.info('{}: Resumed after {}'.format(
+            prefix, time.strftime('%H:%M:%S', time.gmtime(paused))))
+        if self.job:
+            self.job.update({'status': self.job.RUNNING,
+                             'comment': '{}: Resumed'.format(prefix)
+                             }
+                            )
+        self.last_poll = time.time()
+        return paused
+
+
+def cut_list_selection(metadata, settings):
+    """
+    Return the list of (start, end) frames to remove using the cut-list
+    or, when allowed, the commercial detection skip-list
+    """
+    if metadata.cutlists.cut_list:
+        return metadata.cutlists.cut_list
+    if metadata.cutlists.skip_list and settings.file.usecommflag:
+        return metadata.cutlists.skip_list
+    return []
+
+
+def get_kept_duration(av_info, metadata, settings):
+    """Duration in seconds remaining after the selected cuts are removed"""
+    duration = float(av_info.duration)
+    kept_duration = duration
+    cut_list = cut_list_selection(metadata, settings)
+    if cut_list and duration > 0:
+        for start, end in frames_to_time(cut_list, av_info.video.frame_rate):
+            kept_duration = kept_duration - (min(end, duration) - start)
+        kept_duration = max(kept_duration, 0)
+    return kept_duration
+
+
+def get_kept_ranges(av_info, metadata, settings):
+    """
+    List of (start, end) seconds of the source kept in the output, the
+    whole recording unless commercials are removed
+    """
+    duration = float(av_info.duration)
+    if settings.file.commethod not in ('remove', 'only-cut'):
+        return [(0, duration)]
+    kept = []
+    position = 0
+    cut_list = cut_list_selection(metadata, settings)
+    for start, end in sorted(frames_to_time(cut_list,
+                                            av_info.video.frame_rate)):
+        if start > position:
+            kept.append((position, min(start, duration)))
+        position = max(position, end)
+    if position < duration:
+        kept.append((position, duration))
+    return kept
+
+
+def estimate_space(input_file, av_info, metadata, settings):
+    """
+    Estimate the peak temporary and output storage in bytes required to
+    process input_file with the configured commercial method.
+    returns a tuple of (temp bytes, output bytes)
+    """
+    source_size = os.path.getsize(input_file)
+    duration = float(av_info.duration)
+    kept_duration = get_kept_duration(av_info, metadata, settings)
+    if duration > 0:
+        bitrate = source_size / duration
+    else:
+        bitrate = 0
+    kept_size = int(bitrate * kept_duration)
+    temp_size = 0
+    output_size = 0
+    commethod = settings.file.commethod
+    if commethod == 'remove':
+        # segment files, joined file and the encoded output
+        temp_size = source_size + kept_size
+        output_size = kept_size
+    if commethod == 'chapters':
+        output_size = source_size
+    if commethod == 'only-cut':
+        temp_size = source_size
+        output_size = kept_size
+    return temp_size, output_size
+
+
+class SpaceReservation:
+    """
+    Track disk space reserved by concurrently running jobs. Reservations
+    are stored in a json file shared by all jobs on this host, entries for
+    processes that no longer exist are discarded. Outputs queued for retry
+    keep their space reserved until they are transferred
+    """
+    # key prefix of reservations held by outputs queued for retry
+    retry_prefix = 'retry:'
+    # Space left free on every volume in bytes
+    margin = 256 * 1024 * 1024
+
+    def __init__(self, reservation_file):
+        self.reservation_file = reservation_file
+        self.key = str(os.getpid())
+
+    def _locked(self, update=None):
+        """Load reservations under lock, optionally applying update"""
+        import fcntl
+        with open('{}.lock'.format(self.reservation_file), 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            reservations = {}
+            if os.path.isfile(self.reservation_file):
+                try:
+                    with open(self.reservation_file, 'r') as rf:
+                        reservations = json.load(rf)
+                except ValueError:
+                    reservations = {}
+            queued = None
+            for pid in list(reservations.keys()):
+                if pid.startswith(self.retry_prefix):
+                    if queued is None:
+                        queued = RetryQueue().sources()
+                    if pid[len(self.retry_prefix):] not in queued:
+                        reservations.pop(pid)
+                    continue
+                try:
+                    os.kill(int(pid), 0)
+                except OSError:
+                    reservations.pop(pid)
+            if update:
+                result = update(reservations)
+                temp_file = '{}.tmp'.format(self.reservation_file)
+                with open(temp_file, 'w') as wf:
+                    wf.write(u'{}'.format(json.dumps(reservations)))
+                os.rename(temp_file, self.reservation_file)
+                return result
+            return reservations
+
+    def reserved(self, path):
+        """Bytes reserved by other jobs on the volume containing path"""
+        device = os.stat(path).st_dev
+        total = 0
+        for pid, items in self._locked().items():
+            if pid == self.key:
+                continue
+            for item in items:
+                if item['device'] == device:
+                    total = total + item['size']
+        return total
+
+    def available(self, path):
+        """Free bytes on the volume containing path not reserved by others"""
+        free = int(get_free_space(path) * 1024)
+        return free - self.reserved(path) - self.margin
+
+    def reserve(self, requests):
+        """
+        Atomically reserve a list of (path, size) requests, returning False
+        without reserving anything if any volume lacks space
+        """
+        devices = {}
+        for path, size in requests:
+            device = os.stat(path).st_dev
+            devices[device] = devices.get(device, 0) + size
+        free = {}
+        for path, size in requests:
+            free[os.stat(path).st_dev] = int(get_free_space(path) * 1024)
+
+        def update(reservations):
+            for device, size in devices.items():
+                used = 0
+                for pid, items in reservations.items():
+                    if pid == self.key:
+                        continue
+                    used = used + sum(item['size'] for item in items
+                                      if item['device'] == device)
+                if free[device] - used - self.margin < size:
+                    return False
+            reservations[self.key] = [{'device': device, 'size': size}
+                                      for device, size in devices.items()
+                                      ]
+            return True
+        return self._locked(update)
+
+    def running(self):
+        """Number of other running jobs holding reservations"""
+        return len([pid for pid in self._locked()
+                    if pid != self.key
+                    and not pid.startswith(self.retry_prefix)])
+
+    @staticmethod
+    def capacity(path):
+        """Total bytes of the volume containing path"""
+        st = os.statvfs(path)
+        return st.f_blocks * st.f_frsize
+
+    def hold_queued(self, directory):
+        """
+        Keep the space of files in directory queued for retry reserved
+        after this job ends, until the retry worker transfers them
+        """
+        sources = [source for source in RetryQueue().sources()
+                   if source.startswith(directory)
+                   and os.path.isfile(source)]
+
+        def update(reservations):
+            for source in sources:
+                reservations['{}{}'.format(self.retry_prefix, source)] = [
+                    {'device': os.stat(source).st_dev,
+                     'size': os.path.getsize(source)}]
+        try:
+            self._locked(update)
+        except (IOError, OSError) as e:
+            logging.error('Unable to reserve queued exports: {}'.format(e))
+
+    def release(self):
+        """Remove all reservations held by this job"""
+        def update(reservations):
+            reservations.pop(self.key, None)
+        try:
+            self._locked(update)
+        except (IOError, OSError) as e:
+            logging.error('Unable to release disk reservation: {}'.format(e))
+
+
+def io_load(paths, interval=0.5):
+    """
+    Return a dict of path: fraction of time the underlying block device
+    was busy over interval seconds, using /proc/diskstats. Paths on
+    devices that cannot be identified report 0
+    """
+    def io_ticks():
+        ticks = {}
+        try:
+            with open('/proc/diskstats', 'r') as stats:
+                for line in stats:
+                    fields = line.split()
+                    if len(fields) >= 13:
+                        ticks[(int(fields[0]), int(fields[1]))] = (
+                            int(fields[12]))
+        except IOError:
+            pass
+        return ticks
+
+    devices = {}
+    for path in paths:
+        device = os.stat(path).st_dev
+        devices[path] = (os.major(device), os.minor(device))
+    first = io_ticks()
+    time.sleep(interval)
+    second = io_ticks()
+    load = {}
+    for path, device in devices.items():
+        if device in first and device in second:
+            load[path] = (second[device] - first[device]) / (interval * 1000)
+        else:
+            load[path] = 0
+    return load
+
+
+def plan_placement(candidates, temp_size, output_size, reservation):
+    """
+    Choose the directory from candidates with room for temp_size plus
+    output_size and the least I/O load, reserving the space.
+    returns the chosen directory or None if no candidate has room
+    """
+    required = temp_size + output_size
+    usable = [path for path in candidates
+              if os.path.isdir(path) and write_check(path)
+              and reservation.available(path) >= required
+              ]
+    if not usable:
+        return None
+    load = io_load(usable)
+    for path in sorted(usable, key=lambda item: load[item]):
+        if reservation.reserve([(path, required)]):
+            logging.info('Placement: {} selected, {:.0f}% busy'
+                         .format(path, load[path] * 100)
+                         )
+            return path
+    return None
+
+
+def placement_candidates(rec, settings):
+    """List of directories that may hold temporary and output files"""
+    candidates = [settings.file.fallbackdir]
+    if settings.file.tempplacement == 'auto':
+        try:
+            for sg in app.db.getStorageGroup(groupname=rec.storagegroup):
+                if sg.local:
+                    work_dir = os.path.join(sg.dirname, '.transcode/')
+                    if not os.path.isdir(work_dir):
+                        os.makedirs(work_dir)
+                    candidates.append(work_dir)
+        except Exception as e:
+            logging.error('Unable to list storage groups: {}'.format(e))
+    return candidates
+
+
 class FileSetup:
     """
     Configure filename and directory structure to self.filename
@@ -386,95 +2500,490 @@ class FileSetup:
                 self.filename = '{}{}{}'.format(title, sep, date)
 
 
-def export_file(input_file, output_dir):
+def source_fingerprint(path, samples=16, sample_size=64 * 1024):
+    """
+    Sampled content fingerprint of path: sha1 of its size and sample_size
+    bytes at samples evenly spaced offsets. Identifies copies of the same
+    recording without reading the whole file
+    """
+    import hashlib
+    size = os.path.getsize(path)
+    sha1 = hashlib.sha1(str(size).encode('UTF-8'))
+    with open(path, 'rb') as f:
+        for sample in range(samples):
+            f.seek(max(size - sample_size, 0) * sample // max(samples - 1, 1))
+            sha1.update(f.read(sample_size))
+    return sha1.hexdigest()
+
+
+def output_quality(av_info, settings):
+    """Output characteristics used to compare exports of one program"""
+    hd = av_info.video.height >= 720 and av_info.video.width >= 1280
+    definition = 'hd' if hd else 'sd'
+    if settings.file.commethod == 'only-cut':
+        return {'commethod': 'only-cut', 'fileformat': 'ts',
+                'codec': 'copy', 'crf': 0, 'height': av_info.video.height
+                }
+    return {'commethod': settings.file.commethod,
+            'fileformat': settings.file.fileformat,
+            'codec': settings.video['codec{}'.format(definition)],
+            'crf': settings.video['crf{}'.format(definition)],
+            'height': av_info.video.height
+            }
+
+
+class ExportIndex:
+    """
+    SQLite index of exported files keyed by program identity and source
+    fingerprint, used to find an existing export of a repeat recording
+    """
+    def __init__(self, index_file=None):
+        import sqlite3
+        if not index_file:
+            index_file = export_index_file
+        self.connection = sqlite3.connect(index_file, timeout=30)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS exports (path TEXT PRIMARY KEY, '
+            'size INTEGER, fingerprint TEXT, title TEXT, subtitle TEXT, '
+            'programid TEXT, season INTEGER, episode INTEGER, year INTEGER, '
+            'commethod TEXT, fileformat TEXT, codec TEXT, crf INTEGER, '
+            'height INTEGER, exported REAL)'
+        )
+        self.connection.commit()
+
+    def add(self, path, fingerprint, metadata, quality):
+        """Record path as an export of metadata's program"""
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO exports VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (path, os.path.getsize(path), fingerprint,
+                 metadata.title, metadata.subtitle, metadata.programid,
+                 metadata.season, metadata.episode, metadata.year,
+                 quality['commethod'], quality['fileformat'],
+                 quality['codec'], quality['crf'], quality['height'],
+                 time.time())
+            )
+
+    @staticmethod
+    def unique_programid(programid):
+        """
+        True if programid identifies a single episode or movie. Series ids
+        (SH) and episode ids ending in 0000 are shared by every airing of
+        news, talk and daily shows
+        """
+        if not programid or programid in (u'EP', u'MV', u'UNKNOWN'):
+            return False
+        if programid.startswith(u'MV'):
+            return True
+        return not (programid.startswith(u'SH')
+                    or programid.endswith(u'0000'))
+
+    @classmethod
+    def same_program(cls, row, metadata):
+        """True if an index row and metadata describe the same program"""
+        programid = metadata.programid or u''
+        if cls.unique_programid(programid):
+            if row['programid'] == programid:
+                return True
+        if metadata.season and metadata.episode:
+            return (row['season'] == metadata.season
+                    and row['episode'] == metadata.episode)
+        # every airing of a generic program id is a different program
+        #  unless the source or the season and episode match
+        if programid and not cls.unique_programid(programid) and (
+                programid not in (u'EP', u'MV', u'UNKNOWN')):
+            return False
+        if metadata.subtitle and row['subtitle']:
+            return row['subtitle'].lower() == metadata.subtitle.lower()
+        if programid.startswith(u'MV') and metadata.year:
+            return ((row['programid'] or u'').startswith(u'MV')
+                    and row['year'] == metadata.year)
+        return False
+
+    def find(self, metadata, fingerprint, quality):
+        """
+        Return the path of an existing export of the same source or
+        program at equal or better quality, None if there is none.
+        Entries whose file was removed or replaced are dropped
+        """
+        import sqlite3
+        self.connection.row_factory = sqlite3.Row
+        rows = self.connection.execute(
+            'SELECT * FROM exports WHERE (fingerprint = ? OR '
+            'lower(title) = lower(?)) AND commethod = ? AND fileformat = ? '
+            'ORDER BY height DESC, crf ASC',
+            (fingerprint, metadata.title, quality['commethod'],
+             quality['fileformat'])
+        ).fetchall()
+        for row in rows:
+            if not (row['fingerprint'] == fingerprint
+                    or self.same_program(row, metadata)):
+                continue
+            if not (os.path.isfile(row['path'])
+                    and os.path.getsize(row['path']) == row['size']):
+                with self.connection:
+                    self.connection.execute(
+                        'DELETE FROM exports WHERE path = ?', (row['path'],))
+                continue
+            if row['height'] < quality['height']:
+                continue
+            if row['codec'] == quality['codec'] and row['crf'] > quality['crf']:
+                continue
+            return row['path']
+        return None
+
+
+def destination_root(path):
+    """Mount point containing path, the unit of destination health"""
+    path = os.path.abspath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+class RetryQueue:
+    """
+    Durable queue of failed exports retried by a background worker.
+    Transfers are retried with exponential backoff and destinations that
+    keep failing are skipped until their own backoff expires. All state
+    changes are single SQLite transactions
+    """
+    # first retry delay and maximum delay in seconds
+    backoff = 60
+    max_backoff = 6 * 60 * 60
+
+    def __init__(self, queue_file=None):
+        import sqlite3
+        if not queue_file:
+            queue_file = retry_queue_file
+        self.queue_file = queue_file
+        self.connection = sqlite3.connect(queue_file, timeout=30)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS transfers (source TEXT PRIMARY '
+                'KEY, destination TEXT, root TEXT, attempts INTEGER, '
+                'next_attempt REAL, last_error TEXT, added REAL)'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS destinations (root TEXT PRIMARY '
+                'KEY, failures INTEGER, healthy_after REAL)'
+            )
+
+    def delay(self, failures):
+        """Seconds to wait after failures consecutive failures"""
+        return min(self.backoff * 2 ** max(failures - 1, 0),
+                   self.max_backoff)
+
+    def add(self, source, destination, error):
+        """Queue source for transfer to destination"""
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, 0, ?, ?, ?)',
+                (source, destination, destination_root(destination),
+                 time.time() + self.backoff, u'{}'.format(error), time.time())
+            )
+        logging.warning('Export of {} queued for retry: {}'
+                        .format(destination, error))
+
+    def sources(self):
+        """Set of files waiting to be transferred"""
+        return set(row[0] for row in self.connection.execute(
+            'SELECT source FROM transfers'))
+
+    def queued(self, path):
+        """True if a transfer to path, with any extension, is queued"""
+        stem = os.path.splitext(path)[0]
+        return any(os.path.splitext(row[0])[0] == stem
+                   for row in self.connection.execute(
+                       'SELECT destination FROM transfers'))
+
+    def pending(self):
+        """Number of queued transfers"""
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM transfers').fetchone()[0]
+
+    def due(self, limit):
+        """Up to limit transfers due for retry to healthy destinations"""
+        now = time.time()
+        return self.connection.execute(
+            'SELECT source, destination, attempts FROM transfers '
+            'LEFT JOIN destinations USING (root) WHERE next_attempt <= ? '
+            'AND (healthy_after IS NULL OR healthy_after <= ?) '
+            'ORDER BY next_attempt LIMIT ?', (now, now, limit)
+        ).fetchall()
+
+    def next_due(self):
+        """Time the next transfer becomes due, None if the queue is empty"""
+        return self.connection.execute(
+            'SELECT MIN(MAX(next_attempt, IFNULL(healthy_after, 0))) FROM '
+            'transfers LEFT JOIN destinations USING (root)').fetchone()[0]
+
+    def succeeded(self, source, destination):
+        """Remove a transferred entry and mark its destination healthy"""
+        with self.connection:
+            self.connection.execute('DELETE FROM transfers WHERE source = ?',
+                                    (source,))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO destinations VALUES (?, 0, 0)',
+                (destination_root(destination),))
+
+    def failed(self, source, destination, attempts, error, max_attempts=0):
+        """
+        Reschedule a failed entry and back off from its destination. The
+        entry is dropped once it has failed max_attempts times, 0 retries
+        forever. Returns True if the entry was dropped
+        """
+        root = destination_root(destination)
+        now = time.time()
+        dropped = bool(max_attempts) and attempts + 1 >= max_attempts
+        with self.connection:
+            row = self.connection.execute(
+                'SELECT failures FROM destinations WHERE root = ?',
+                (root,)).fetchone()
+            failures = (row[0] if row else 0) + 1
+            self.connection.execute(
+                'INSERT OR REPLACE INTO destinations VALUES (?, ?, ?)',
+                (root, failures, now + self.delay(failures)))
+            if dropped:
+                self.connection.execute(
+                    'DELETE FROM transfers WHERE source = ?', (source,))
+            else:
+                self.connection.execute(
+                    'UPDATE transfers SET attempts = ?, next_attempt = ?, '
+                    'last_error = ? WHERE source = ?',
+                    (attempts + 1, now + self.delay(attempts + 1),
+                     u'{}'.format(error), source))
+        if dropped:
+            logging.error('Export of {} dropped after {} attempts, the '
+                          'output is left in {}: {}'
+                          .format(destination, attempts + 1, source, error))
+        return dropped
+
+
+def transfer_file(source, destination, cache_policy):
+    """
+    Copy source to destination verifying the copy by hash, replacing
+    destination atomically and removing source when successful.
+    raises IOError if the transfer fails
+    """
+    output_dir = os.path.dirname(destination)
+    if not os.path.isdir(output_dir):
+        logging.info('Creating export directory')
+        os.makedirs(output_dir)
+    logging.info('Copying file to destination directory')
+    # Copy under a temporary name and rename over any existing file so
+    #  the destination is replaced atomically once verified and a
+    #  hardlinked .old backup keeps the original contents
+    partial = '{}.part'.format(destination)
+    copy_hash = cache_policy.copy(source, partial)
+    logging.info('Start hash verification')
+    if cache_policy.sha1(partial) != copy_hash:
+        os.remove(partial)
+        raise IOError('Hash verification failed for: {}'.format(destination))
+    logging.info('Hash verification sucessfull')
+    os.rename(partial, destination)
+    os.remove(source)
+
+
+def export_file(input_file, output_dir, cache_policy=None):
     """
     Transfer file to output_dir, preforming hash verification to confirm
-    successful transfer. If verification fails a fallback.log file will be
-    created in the input_files directory. If the fallback.log file exists
-    any files listed within will be transferred
+    successful transfer. If the transfer fails the file is left in place
+    and queued in the RetryQueue for the background retry worker.
+    cache_policy is a CachePolicy used for the copy and hash.
+    returns True if the file was transferred
     """
     input_name = input_file.split('/')[-1]
     input_dir = '{}/'.format(os.path.dirname(input_file))
     fallback_log = '{}fallback.log'.format(input_dir)
     output_file = '{}{}'.format(output_dir, input_name)
 
-    def comp_hash(input_one, input_two, buffer_size=None):
-        """compare the hash value of two files"""
-        def sha1_hash(file_path, buf_size=None):
-            """generate sha1 hash from input"""
-            import hashlib
-            if not buf_size:
-                buf_size = 65536
-            else:
-                buf_size = buf_size
-            sha1 = hashlib.sha1()
-            with open(file_path, 'rb') as f:
-                while True:
-                    data = f.read(buf_size)
-                    if not data:
-                        break
-                    sha1.update(data)
-            return sha1.hexdigest()
-        hash_one = sha1_hash(input_one, buf_size=buffer_size)
-        hash_two = sha1_hash(input_two, buf_size=buffer_size)
-        if hash_one == hash_two:
-            return True
-        else:
-            return False
-    # Check for fallback log and process any entries
-    fallback_list = []
+    if not cache_policy:
+        cache_policy = CachePolicy(enabled=False)
+    retry_queue = RetryQueue()
+    # Move entries of a fallback.log from earlier versions to the queue
     if os.path.isfile(fallback_log):
-        logging.info("Fallback log detected processing entry's")
+        logging.info('Fallback log detected queuing entries for retry')
         with open(fallback_log, 'r') as input_files:
-            files = input_files.readlines()
-            for old_file in files:
-                old_file = old_file.rstrip('\n')
-                old_name = old_file.split('/')[-1]
-                old_dir = old_file.rstrip(old_name)
-                fallback_file = '{}{}'.format(input_dir, old_name)
-                if not os.path.isdir(old_dir):
-                    os.makedirs(old_dir)
-                if os.path.isdir(old_dir):
-                    if write_check(old_dir):
-                        if not os.path.isfile(old_file):
-                            if os.path.isfile(fallback_file):
-                                shutil.copyfile(fallback_file, old_file)
-                                successful_transfer = comp_hash(fallback_file,
-                                                                old_file
-                                                                )
-                                if not successful_transfer:
-                                    # hash check failed add to fallback list
-                                    logging.error('Hash verification failed'
-                                                  ' for: {}'.format(old_file)
-                                                  )
-                                    fallback_list.append(old_file)
-                                    # Should log reason?
-                                if successful_transfer:
-                                    logging.info('Hash verification sucessful'
-                                                 ' for: {}'.format(old_file)
-                                                 )
-                                    os.remove(fallback_file)
-    if not os.path.isdir(output_dir):
-        logging.info('Creating export directory')
-        os.makedirs(output_dir)
-    if os.path.isdir(output_dir):
-        logging.info('Copying file to destination directory')
-        shutil.copyfile(input_file, output_file)
-        logging.info('Start hash verification')
-        successful_transfer = comp_hash(input_file, output_file)
-        if not successful_transfer:
-            logging.error('Hash verification failed')
-            fallback_list.append(output_file)
-        if successful_transfer:
-            logging.info('Hash verification sucessfull')
-            os.remove(input_file)
-
-    if fallback_list:
-        with open(fallback_log, 'w') as write_fallback:
-            for item in fallback_list:
-                write_fallback.write(u'{}\n'.format(item))
-    if not fallback_list and os.path.isfile(fallback_log):
+            for old_file in input_files.read().splitlines():
+                fallback_file = '{}{}'.format(input_dir,
+                                              os.path.basename(old_file))
+                if old_file and os.path.isfile(fallback_file):
+                    retry_queue.add(fallback_file, old_file,
+                                    'from fallback.log')
         os.remove(fallback_log)
+    try:
+        transfer_file(input_file, output_file, cache_policy)
+    except (IOError, OSError) as e:
+        logging.error('Export failed: {}'.format(e))
+        retry_queue.add(input_file, output_file, e)
+        return False
+    return True
+
+
+class TierBacklog:
+    """
+    SQLite list of exports still on the fast first tier awaiting the
+    archival re-encode, with the recording each was made from
+    """
+    # attempts before an item is left on the first tier
+    max_attempts = 3
+
+    def __init__(self, backlog_file=None):
+        import sqlite3
+        if not backlog_file:
+            backlog_file = tier_backlog_file
+        self.connection = sqlite3.connect(backlog_file, timeout=30)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS items (path TEXT PRIMARY KEY, '
+                'chanid TEXT, starttime TEXT, exported REAL, '
+                'attempts INTEGER, last_error TEXT)'
+            )
+
+    def add(self, path, chanid, starttime):
+        """Record path as a first tier export of the recording"""
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, 0, NULL)',
+                (path, str(chanid), str(starttime), time.time()))
+
+    def find(self, chanid, starttime):
+        """Path of the first tier export of a recording or None"""
+        row = self.connection.execute(
+            'SELECT path FROM items WHERE chanid = ? AND starttime = ?',
+            (str(chanid), str(starttime))).fetchone()
+        return row[0] if row else None
+
+    def remove(self, path):
+        with self.connection:
+            self.connection.execute('DELETE FROM items WHERE path = ?',
+                                    (path,))
+
+    def failed(self, path, error):
+        with self.connection:
+            self.connection.execute(
+                'UPDATE items SET attempts = attempts + 1, last_error = ? '
+                'WHERE path = ?', (u'{}'.format(error), path))
+
+    def pending(self):
+        """List of (path, chanid, starttime) to re-encode, oldest first"""
+        return self.connection.execute(
+            'SELECT path, chanid, starttime FROM items WHERE attempts < ? '
+            'ORDER BY exported', (self.max_attempts,)).fetchall()
+
+
+def in_window(window, now=None):
+    """True if the hour of now is within [start, end) hours, may wrap"""
+    if not now:
+        now = datetime.now()
+    start, end = window
+    if start <= end:
+        return start <= now.hour < end
+    return now.hour >= start or now.hour < end
+
+
+def recording_starttime(rec):
+    """UTC start time of rec as used in its file name"""
+    return os.path.basename(rec.basename).split('_')[1].split('.')[0]
+
+
+def drain_tiers(settings, daemon=False):
+    """
+    Re-encode first tier exports with the archival profile during the
+    tierwindow idle hours, one at a time at the lowest cpu priority and,
+    with autopause, not while the backend is recording or playing. A
+    re-encode still running when the window closes pauses until it opens
+    again. Returns when the backlog is empty or the window closes unless
+    daemon
+    """
+    import fcntl
+    lock = open('{}.lock'.format(tier_backlog_file), 'a')
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        logging.debug('Tier worker already running')
+        return
+    backlog = TierBacklog()
+    retry_queue = RetryQueue()
+    job_control = JobControl(db=app.db, auto_pause=settings.file.autopause)
+    while True:
+        # an archive waiting for its export transfer is already encoded
+        pending = [item for item in backlog.pending()
+                   if not retry_queue.queued(item[0])]
+        if not pending or not in_window(settings.file.tierwindow):
+            if not daemon:
+                break
+            time.sleep(600)
+            continue
+        if job_control.backend_busy():
+            time.sleep(300)
+            continue
+        path, chanid, starttime = pending[0]
+        logging.info('Archival re-encode of {}'.format(path))
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--chanid', chanid,
+             '--starttime', starttime, '--tier', '2'],
+            preexec_fn=lambda: os.nice(19)
+        )
+        if process.wait() != 0:
+            backlog.failed(path, 'exit status {}'.format(process.returncode))
+
+
+def retry_exports(parallel=2, daemon=False, max_attempts=0):
+    """
+    Background worker retrying queued exports, up to parallel transfers at
+    a time, dropping exports that failed max_attempts times. Only one
+    worker runs per host. Returns when the queue is empty unless daemon
+    """
+    import fcntl
+    lock = open('{}.lock'.format(retry_queue_file), 'a')
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        logging.debug('Retry worker already running')
+        return
+    retry_queue = RetryQueue()
+    while True:
+        entries = retry_queue.due(parallel)
+        if entries:
+            tasks = [(entry, BackgroundTask(transfer_file, entry[0], entry[1],
+                                            CachePolicy(app.settings.file
+                                                        .dropcache)))
+                     for entry in entries]
+            for (source, destination, attempts), task in tasks:
+                try:
+                    task.result()
+                    logging.info('Retried export of {} succeeded'
+                                 .format(destination))
+                    retry_queue.succeeded(source, destination)
+                except (IOError, OSError) as e:
+                    logging.error('Retried export of {} failed: {}'
+                                  .format(destination, e))
+                    retry_queue.failed(source, destination, attempts, e,
+                                       max_attempts=max_attempts)
+            continue
+        next_due = retry_queue.next_due()
+        if next_due is None and not daemon:
+            break
+        if next_due is None:
+            next_due = time.time() + 60
+        time.sleep(min(max(next_due - time.time(), 1), 60))
+
+
+def start_retry_worker():
+    """Start a detached retry worker if exports are queued"""
+    if not RetryQueue().pending():
+        return
+    with open(os.devnull, 'w') as devnull:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                          '--retry-exports'], stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid
+                         )
 
 
 def frames_to_time(cut_frames, frame_rate, frame_offset=0):
@@ -605,6 +3114,7 @@ def get_episode(series_title, episode_title=None, season_number=None,
     part_separator: character(s) used to separate episode subtitle from
      episode part number. may need for non-english use?
     """
+    from MythTV.ttvdb import tvdb_api, tvdb_exceptions
     t = tvdb_api.Tvdb()
     numerals = {'I': 1, 'II': 2, 'III': 3, 'IV': 4, 'V': 5, 'VI': 6, 'VII': 7,
                 'VIII': 8, 'IX': 7, 'X': 10
@@ -714,6 +3224,7 @@ def get_episode(series_title, episode_title=None, season_number=None,
 
 def get_movie(title, year=None):
     """Use MythTV video grabber to retrieve movie metadata."""
+    from MythTV import VideoGrabber
     movie_grabber = VideoGrabber('movie')
     movie_search = list(movie_grabber.search(title))
     movie_result = []
@@ -735,6 +3246,9 @@ def get_movie(title, year=None):
 
 
 def find_rec(chanid, starttime):
+    from MythTV import Recorded
+    db = app.db
+
     def local_time_offset(t=None):
         if t is None:
             t = time.time()
@@ -801,9 +3315,12 @@ class RecordingToMetadata:
         self.year = None
         self.previouslyshown = None
         self.cutlists = {}
+        # metadata of each episode of a multi-episode recording
+        self.episodes = []
         cut_lists = {u'cut_list': None, u'uncut_list': None, u'skip_list': None,
                      u'unskip_list': None}
 
+        from MythTV import Program
         program = Program.fromRecorded(recorded)
         for k, v in recorded.items():
             if k in self.__dict__.keys():
@@ -857,7 +3374,14 @@ class RecordingToMetadata:
                                 self.description = (u'{}'
                                                     .format(v.decode('UTF-8'))
                                                     )
-                # multi-episode recording setup would go here
+                if len(episode_data) > 1:
+                    logging.info('Multi-episode recording of {} episodes'
+                                 .format(len(episode_data)))
+                    self.programid = u'EP'
+                    self.episodes = [episode_metadata(self, item)
+                                     for item in episode_data]
+                    self.season = self.episodes[0].season
+                    self.episode = self.episodes[0].episode
                 if self.subtitle == u''\
                         and not any([self.season, self.episode]):
                     if self.year != self.starttime.year:
@@ -884,6 +3408,51 @@ class RecordingToMetadata:
             self.programid = u'UNKNOWN'
 
 
+def episode_metadata(metadata, item):
+    """
+    Return a copy of RecordingToMetadata metadata describing the episode
+    item found by get_episode
+    """
+    import copy
+    episode = copy.copy(metadata)
+    episode.episodes = []
+    for k, v in item.items():
+        if k in ('season', 'airedSeason'):
+            episode.season = int(v)
+        if k in ('episode', 'airedEpisodeNumber'):
+            episode.episode = int(v)
+        if k == 'originalairdate':
+            episode.originalairdate = v
+            episode.year = v.year
+        if k == 'firstAired':
+            episode.originalairdate = datetime.strptime(v, '%Y-%m-%d')
+            episode.year = episode.originalairdate.year
+        if k in ('subtitle', 'episodename'):
+            episode.subtitle = u'{}'.format(v)
+        if k == 'description':
+            episode.description = u'{}'.format(v)
+    return episode
+
+
+def episode_boundaries(breaks, duration, count):
+    """
+    Choose the times, from the output times of commercial breaks, that
+    split a recording of duration seconds into count episodes: the break
+    nearest each even division. returns None if breaks can not separate
+    count episodes
+    """
+    boundaries = []
+    for number in range(1, count):
+        target = duration * number / count
+        candidates = [point for point in breaks
+                      if not boundaries or point > boundaries[-1]]
+        if not candidates:
+            return None
+        boundaries.append(min(candidates,
+                              key=lambda point: abs(point - target)))
+    return boundaries
+
+
 def update_recorded(rec, input_file, output_file):
     """
     Update MythTV database entry. clearing out old markup data and removing
@@ -956,16 +3525,394 @@ def update_recorded(rec, input_file, output_file):
         pass
 
 
+def read_filter_metadata(path):
+    """
+    Parse a file written by FFmpeg's metadata/ametadata print mode into a
+    list of (pts_time, {key: value}) for each frame
+    """
+    frames = []
+    if not os.path.isfile(path):
+        return frames
+    with open(path, 'r') as mf:
+        for line in mf:
+            line = line.strip()
+            if line.startswith('frame:'):
+                pts_time = line.rsplit('pts_time:', 1)[-1]
+                frames.append((float(pts_time), {}))
+            elif '=' in line and frames:
+                k, v = line.split('=', 1)
+                frames[-1][1][k] = v
+    return frames
+
+
+def metadata_periods(frames, start_key, end_key):
+    """List of (start, end) seconds from start and end metadata keys"""
+    periods = []
+    start = None
+    for pts_time, values in frames:
+        if start_key in values:
+            start = float(values[start_key])
+        if end_key in values and start is not None:
+            periods.append((start, float(values[end_key])))
+            start = None
+    return periods
+
+
+def detect_commercials(black, silence, scenes, logo, duration,
+                       min_break=30, max_segment=65):
+    """
+    Find commercial breaks from black frame and silence periods, scene
+    change times and logo area edge levels (time, level) in seconds.
+    Break points are black frames or scene changes during silence.
+    Consecutive segments between break points of at most max_segment
+    seconds, without the station logo where logo levels are known, are
+    joined into breaks of at least min_break seconds.
+    returns a list of (start, end) seconds
+    """
+    def in_silence(point):
+        return any(start - 0.5 <= point <= end + 0.5
+                   for start, end in silence)
+
+    points = set()
+    for start, end in black:
+        if in_silence((start + end) / 2):
+            points.add(round((start + end) / 2, 2))
+    for point in scenes:
+        if in_silence(point):
+            points.add(round(point, 2))
+    points = sorted([0] + [point for point in points
+                           if 0 < point < duration] + [duration])
+    # programme logo level: median over the recording
+    levels = sorted(level for time_, level in logo)
+    logo_level = levels[len(levels) // 2] if levels else None
+
+    def without_logo(start, end):
+        values = [level for time_, level in logo if start <= time_ < end]
+        if logo_level is None or not values:
+            return True
+        return sum(values) / len(values) < logo_level * 0.6
+
+    breaks = []
+    block = None
+    for start, end in zip(points[:-1], points[1:]):
+        if end - start <= max_segment and without_logo(start, end):
+            block = (block[0], end) if block else (start, end)
+            continue
+        if block and block[1] - block[0] >= min_break:
+            breaks.append(block)
+        block = None
+    if block and block[1] - block[0] >= min_break:
+        breaks.append(block)
+    return breaks
+
+
+def parse_ebur128(log_file):
+    """
+    Return (integrated loudness LUFS, true peak dBTP) from the summary
+    FFmpeg's ebur128 filter wrote to log_file or None if there is none
+    """
+    if not os.path.isfile(log_file):
+        return None
+    with open(log_file, 'r') as lf:
+        summary = lf.read().rsplit('Summary:', 1)
+    if len(summary) < 2:
+        return None
+    loudness = re.search(r'I:\s+(-?[\d.]+) LUFS', summary[1])
+    peak = re.search(r'Peak:\s+(-?[\d.]+|-inf) dBFS', summary[1])
+    if not loudness or not peak:
+        return None
+    return float(loudness.group(1)), float(peak.group(1))
+
+
+def write_skip_list(rec, skip_list):
+    """Set the commercial skip list of rec to skip_list frames"""
+    starttime = (datetime.utcfromtimestamp(rec.starttime.timestamp())
+                 .strftime('%Y%m%d%H%M%S')
+                 )
+    skip_string = ','.join('{}-{}'.format(start, end)
+                           for start, end in skip_list)
+    logging.info('Setting skip-list: {}'.format(skip_string))
+    try:
+        subprocess.call(['mythutil', '--chanid', str(rec.chanid),
+                         '--starttime', starttime, '--setskiplist',
+                         skip_string
+                         ]
+                        )
+    except Exception as e:
+        logging.error('Mythutil exception setting skip-list: {}'.format(e))
+
+
+def pick_poster(images):
+    """
+    Return the poster frame from the candidate images, the most detailed
+    (largest JPEG) ignoring the first and last tenth of the recording
+    where titles, credits and fades are
+    """
+    skip = len(images) // 10
+    candidates = images[skip:len(images) - skip] or images
+    return max(candidates, key=os.path.getsize)
+
+
+def write_bif(images, bif_file, interval):
+    """
+    Write the JPEG images, taken every interval seconds, to bif_file in
+    the BIF trickplay format read by Roku, Emby and Jellyfin
+    """
+    import struct
+    header = b'\x89BIF\r\n\x1a\n'
+    header += struct.pack('<III', 0, len(images), int(interval * 1000))
+    header += b'\x00' * (64 - len(header))
+    offset = 64 + 8 * (len(images) + 1)
+    index = b''
+    for number, image in enumerate(images):
+        index += struct.pack('<II', number, offset)
+        offset += os.path.getsize(image)
+    index += struct.pack('<II', 0xffffffff, offset)
+    with open(bif_file, 'wb') as bf:
+        bf.write(header)
+        bf.write(index)
+        for image in images:
+            with open(image, 'rb') as jf:
+                bf.write(jf.read())
+
+
+def export_previews(previews, destination, settings, cache_policy=None):
+    """
+    Transfer the preview images of Encoder.previews next to the exported
+    file destination, named for the export type. Without export the
+    preview is saved as the MythTV preview image of recording destination
+    """
+    if not cache_policy:
+        cache_policy = CachePolicy(enabled=False)
+    base = destination.rsplit('.', 1)[0]
+    if not settings.file.export:
+        items = [('preview', '{}.png'.format(destination))]
+    else:
+        if settings.file.exporttype == 'plex':
+            items = [('poster', '{}.jpg'.format(base))]
+        else:
+            items = [('poster', '{}-thumb.jpg'.format(base))]
+        items.append(('bif', '{}-{}-{}.bif'
+                      .format(base, settings.file.previewwidth,
+                              settings.file.previewinterval)))
+    for name, target in items:
+        if name not in previews:
+            continue
+        if not os.path.isfile(previews[name]):
+            logging.warning('Missing {} image {}'.format(name,
+                                                         previews[name]))
+            continue
+        try:
+            transfer_file(previews[name], target, cache_policy)
+        except (IOError, OSError) as e:
+            logging.error('Unable to export {} image: {}'.format(name, e))
+
+
+# seconds of audio per chromaprint sub-fingerprint
+fingerprint_item = 4096 / 3 / 11025
+
+
+def audio_fingerprint(input_file, stream_index=None):
+    """
+    Return the chromaprint sub-fingerprints of an audio stream of
+    input_file, one 32 bit value per fingerprint_item seconds, decoding
+    only the audio
+    """
+    import struct
+    stream = '0:{}'.format(stream_index) if stream_index else '0:a:0'
+    raw = subprocess.check_output([app.ffmpeg, '-v', 'error', '-i',
+                                   input_file, '-map', stream, '-ac', '1',
+                                   '-f', 'chromaprint', '-fp_format', 'raw',
+                                   '-'])
+    return list(struct.unpack('<{}I'.format(len(raw) // 4),
+                              raw[:len(raw) // 4 * 4]))
+
+
+class AdIndex:
+    """
+    Inverted index of audio sub-fingerprints of confirmed commercial
+    breaks. Recordings are matched by runs of sub-fingerprints aligned
+    with a stored break at a constant offset, so single ads are found in
+    any order. The index holds at most size breaks, evicting the least
+    recently matched
+    """
+    # minimum matched run in seconds and allowed gap inside a run
+    min_match = 8
+    max_gap = 2
+    # query values repeated more often than this (silence) are ignored
+    max_repeats = 20
+
+    def __init__(self, index_file=None, size=5000):
+        import sqlite3
+        if not index_file:
+            index_file = ad_index_file
+        self.size = size
+        self.connection = sqlite3.connect(index_file, timeout=30)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS ads (id INTEGER PRIMARY KEY, '
+                'source TEXT, duration REAL, added REAL, last_seen REAL, '
+                'hits INTEGER)'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS hashes (hash INTEGER, '
+                'ad INTEGER, offset INTEGER)'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS hashes_hash ON hashes (hash)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS hashes_ad ON hashes (ad)')
+
+    def add(self, fingerprint, ranges, source):
+        """
+        Store the parts of fingerprint within ranges of (start, end)
+        seconds as commercial breaks of source, replacing breaks
+        previously stored for source
+        """
+        now = time.time()
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM hashes WHERE ad IN (SELECT id FROM ads '
+                'WHERE source = ?)', (source,))
+            self.connection.execute('DELETE FROM ads WHERE source = ?',
+                                    (source,))
+            for start, end in ranges:
+                # trim the edges which may hold programme audio
+                first = int((start + 1) / fingerprint_item)
+                last = min(int((end - 1) / fingerprint_item), len(fingerprint))
+                if (last - first) * fingerprint_item < self.min_match:
+                    continue
+                ad = self.connection.execute(
+                    'INSERT INTO ads (source, duration, added, last_seen, '
+                    'hits) VALUES (?, ?, ?, ?, 0)',
+                    (source, (last - first) * fingerprint_item, now, now)
+                ).lastrowid
+                self.connection.executemany(
+                    'INSERT INTO hashes VALUES (?, ?, ?)',
+                    [(fingerprint[offset], ad, offset - first)
+                     for offset in range(first, last)
+                     if fingerprint[offset]])
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently matched breaks beyond self.size"""
+        stale = [row[0] for row in self.connection.execute(
+            'SELECT id FROM ads ORDER BY last_seen DESC LIMIT -1 OFFSET ?',
+            (self.size,))]
+        for ad in stale:
+            self.connection.execute('DELETE FROM hashes WHERE ad = ?', (ad,))
+            self.connection.execute('DELETE FROM ads WHERE id = ?', (ad,))
+        if stale:
+            logging.info('Evicted {} commercials from the index'
+                         .format(len(stale)))
+
+    def match(self, fingerprint):
+        """
+        Return (start, end) seconds of fingerprint matching stored
+        commercials, merged where they are less than max_gap apart
+        """
+        counts = {}
+        for value in fingerprint:
+            counts[value] = counts.get(value, 0) + 1
+        with self.connection:
+            self.connection.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS query (hash INTEGER, '
+                'offset INTEGER)')
+            self.connection.execute('DELETE FROM query')
+            self.connection.executemany(
+                'INSERT INTO query VALUES (?, ?)',
+                [(value, offset) for offset, value in enumerate(fingerprint)
+                 if value and counts[value] <= self.max_repeats])
+            rows = self.connection.execute(
+                'SELECT query.offset, hashes.ad, hashes.offset FROM query '
+                'JOIN hashes ON hashes.hash = query.hash').fetchall()
+        # group hits by stored break and alignment
+        alignments = {}
+        for offset, ad, ad_offset in rows:
+            alignments.setdefault((ad, offset - ad_offset), []).append(offset)
+        max_gap = int(self.max_gap / fingerprint_item)
+        min_items = int(self.min_match / fingerprint_item)
+        matched = []
+        ads = set()
+        for (ad, delta), offsets in alignments.items():
+            if len(offsets) < min_items / 4:
+                continue
+            offsets.sort()
+            start = previous = offsets[0]
+            for offset in offsets[1:] + [None]:
+                if offset is not None and offset - previous <= max_gap:
+                    previous = offset
+                    continue
+                if previous - start >= min_items:
+                    matched.append((start * fingerprint_item,
+                                    (previous + 1) * fingerprint_item))
+                    ads.add(ad)
+                if offset is not None:
+                    start = previous = offset
+        if ads:
+            with self.connection:
+                self.connection.executemany(
+                    'UPDATE ads SET last_seen = ?, hits = hits + 1 '
+                    'WHERE id = ?', [(time.time(), ad) for ad in ads])
+        breaks = []
+        for start, end in sorted(matched):
+            if breaks and start - breaks[-1][1] <= self.max_gap:
+                breaks[-1] = (breaks[-1][0], max(end, breaks[-1][1]))
+            else:
+                breaks.append((start, end))
+        return breaks
+
+
+def learn_commercials(input_file, ranges, source, size):
+    """Add the (start, end) seconds ranges of input_file to the AdIndex"""
+    fingerprint = audio_fingerprint(input_file)
+    duration = len(fingerprint) * fingerprint_item
+    ranges = [(start, min(end, duration)) for start, end in ranges
+              if start < duration]
+    AdIndex(size=size).add(fingerprint, ranges, source)
+    logging.info('Indexed {} commercial breaks'.format(len(ranges)))
+
+
+def check_directories(settings):
+    """Exit if the fallback or enabled export directory is not writable"""
+    if not write_check(settings.file.fallbackdir):
+        logging.error('Fallback directory is not writable')
+        if job:
+            job.update({'status': job.ERRORED,
+                        'comment': 'Fallback directory is not writable'
+                        }
+                       )
+        sys.exit(1)
+    if not write_check(settings.file.exportdir):
+        if settings.file.export:
+            logging.error('Export directory is not writable')
+            if job:
+                job.update({'status': job.ERRORED,
+                            'comment': 'Export directory is not writable'
+                            }
+                           )
+            sys.exit(1)
+        else:
+            logging.warning('Export directory is not writable')
+
+
 class Encoder:
-    """Configure and run FFmpeg encoding"""
-    ffmpeg = program_check('ffmpeg', 'mythffmpeg')
+    """
+    Configure and run FFmpeg encoding. With remux_uncut the only-cut
+    method remuxes a recording without a cut list instead of failing
+    """
 
-    def __init__(self, input_file, output_file, settings=None, metadata=None):
+    def __init__(self, input_file, output_file, settings=None, metadata=None,
+                 work_dir=None, av_info=None, metrics=None, eta=None,
+                 keep_temp=False, remux_uncut=False, window=None):
         self.input_file = input_file
         self.output_file = output_file
         self.settings = settings
+        self.ffmpeg = app.ffmpeg
+        if not work_dir:
+            work_dir = self.settings.file.fallbackdir
         self.temp_dir = ('{}{}/'
-                         .format(self.settings.file.fallbackdir,
+                         .format(work_dir,
                                  os.path.basename(input_file).rsplit('.')[0]
                                  )
                          )
@@ -974,7 +3921,19 @@ class Encoder:
                                   os.path.basename(input_file).rsplit('.')[0]
                                   )
                           )
-        self.av_info = AVInfo(input_file)
+        if metrics:
+            self.metrics = metrics
+        else:
+            self.metrics = JobMetrics()
+        if eta:
+            self.eta = eta
+        else:
+            self.eta = JobEta({}, self.metrics)
+        if av_info:
+            self.av_info = av_info
+        else:
+            with self.metrics.phase('probe'):
+                self.av_info = AVInfo(input_file)
         self.metadata = metadata
         self.metadata_file = None
         self.hd = False
@@ -984,33 +3943,64 @@ class Encoder:
         self.subtitle_metadata = None
         self.video_config = []
         self.audio_config = []
+        self.video_filter = None
+        self.rendition_config = []
+        self.expected_fps = None
+        self.crf = None
+        # Detect commercials in the encode when there is no list to use
+        self.detect = (self.settings.file.commdetect
+                       and self.settings.file.commethod == 'chapters'
+                       and not self.metadata.cutlists.cut_list
+                       and not self.metadata.cutlists.skip_list)
+        self.detected_skip_list = None
+        # Take preview images from the frames decoded for the encode
+        self.thumbnail = (self.settings.file.previews
+                          and self.settings.file.commethod != 'only-cut')
+        self.thumbnail_config = []
+        self.previews = {}
+        # Measure loudness in the join of the kept ranges to normalise
+        #  the audio in the encode
+        self.loudness = (self.settings.file.loudnorm
+                         and self.settings.file.commethod == 'remove')
+        self.loudness_config = []
+        # Split a multi-episode recording into a file per episode at key
+        #  frames forced at the episode boundaries
+        self.split = (self.settings.file.splitepisodes
+                      and len(self.metadata.episodes) > 1
+                      and self.settings.file.commethod != 'only-cut'
+                      and self.settings.file.export
+                      and not self.settings.file.tiered)
+        self.episode_times = []
+        self.episode_outputs = []
+        # checkpoint stages producing the output and the renditions
+        self.final_stage = 'encoding'
+        self.rendition_stage = 'encoding'
+        self.remux = (remux_uncut
+                      and self.settings.file.commethod == 'only-cut'
+                      and not cut_list_selection(metadata, settings))
+        self.cache_policy = CachePolicy(self.settings.file.dropcache)
+        self.job_control = JobControl(job=job,
+                                      auto_pause=self.settings.file.autopause,
+                                      temp_dir=self.temp_dir, window=window
+                                      )
 
         if (self.av_info.video.height >= 720
                 and self.av_info.video.width >= 1280):
                     self.hd = True
         else:
             self.hd = False
-        # Check directory access
-        if not write_check(self.settings.file.fallbackdir):
-            logging.error('Fallback directory is not writable')
-            if job:
-                job.upadate({'status': job.ERRORED,
-                             'comment': 'Fallback directory is not writable'
-                             }
-                            )
-            sys.exit(1)
-        if not write_check(self.settings.file.exportdir):
-            if self.settings.file.export:
-                logging.error('Export directory is not writable')
-                if job:
-                    job.upadate({'status': job.ERRORED,
-                                 'comment': 'Export directory is not writable'
-                                 }
-                                )
-                sys.exit(1)
-            else:
-                logging.warning('Export directory is not writable')
-        temp_check(self.temp_dir)
+        check_directories(self.settings)
+        # Reuse a temporary directory checkpointed by an interrupted run
+        #  of the same job, otherwise start clean
+        self.checkpoint = Checkpoint(self.temp_dir,
+                                     checkpoint_key(input_file, settings,
+                                                    metadata)
+                                     )
+        if self.checkpoint.resumable:
+            logging.info('Resuming from checkpoint in {}'
+                         .format(self.temp_dir))
+        else:
+            temp_check(self.temp_dir)
 
         def deinterlacer():
             if self.hd:
@@ -1026,6 +4016,42 @@ class Encoder:
                 if deinterlace_method is not 'none':
                     self.deinterlacer = '{}=0:-1:1'.format(deinterlace_method)
 
+        def crf_setup():
+            """
+            Set self.crf from the settings or, with crfsearch, by sampling
+            the kept parts of the recording. The result is kept in the
+            temporary directory for resumed jobs
+            """
+            definition = 'hd' if self.hd else 'sd'
+            self.crf = self.settings.video['crf{}'.format(definition)]
+            if (not self.settings.file.crfsearch
+                    or self.settings.file.commethod == 'only-cut'):
+                return
+            crf_file = '{}crfsearch.json'.format(self.temp_dir)
+            if os.path.isfile(crf_file):
+                with open(crf_file, 'r') as cf:
+                    self.crf = json.load(cf)['crf']
+                return
+            if job:
+                job.update({'status': job.RUNNING,
+                            'comment': 'Searching CRF'
+                            })
+            with self.metrics.phase('crf search'):
+                crf = crf_search(
+                    self.input_file, self.av_info,
+                    get_kept_ranges(self.av_info, self.metadata,
+                                    self.settings),
+                    self.settings,
+                    self.settings.video['codec{}'.format(definition)],
+                    self.settings.video['preset{}'.format(definition)],
+                    deinterlacer=self.deinterlacer, temp_dir=self.temp_dir
+                )
+            if crf is not None:
+                logging.info('CRF search chose crf {}'.format(crf))
+                self.crf = crf
+                with open(crf_file, 'w') as cf:
+                    cf.write(u'{}'.format(json.dumps({'crf': crf})))
+
         def video_setup():
             """Create self.video_config list for use by ffmpeg"""
             self.video_config = ['-map', '0:0']
@@ -1040,7 +4066,7 @@ class Encoder:
                                           '-preset:v',
                                           self.settings.video.presethd,
                                           '-crf:v',
-                                          str(self.settings.video.crfhd)
+                                          str(self.crf)
                                           )
                                          )
                 # if max_HD != 0:
@@ -1055,9 +4081,9 @@ class Encoder:
             elif not self.hd:
                 self.video_config.extend((self.settings.video.codecsd,
                                           '-preset:v',
-                                          self.settings.video.presethd,
+                                          self.settings.video.presetsd,
                                           '-crf:v',
-                                          str(self.settings.video.crfsd)
+                                          str(self.crf)
                                           )
                                          )
                 # if max_SD != 0:
@@ -1069,9 +4095,12 @@ class Encoder:
                 #     min_SD = min_SD * 1000
                 #     Vparam.extend(('-minrate:v', str(min_SD)))
 
-        def audio_setup():
-            """Create self.audio_config list for use by ffmpeg"""
-            self.audio_config = []
+        def audio_options(codec, bitrate_per_channel):
+            """
+            Return ffmpeg audio options encoding the selected audio streams
+            with codec at bitrate_per_channel kbit/s per channel
+            """
+            audio_config = []
 #            if self.settings.audio.language == 'all':
             audio_map_list = []
             audio_map = []
@@ -1083,30 +4112,17 @@ class Encoder:
                                   ]
                                  )
                 audio_map.append('-c:a')
-                if self.hd:
-                    if self.settings.audio.codechd == 'copy':
-                        audio_map.append('copy')
-                    elif self.settings.audio.codechd != 'copy':
-                        audio_map.extend([self.settings.audio.codechd,
-                                          '-b:a',
-                                          str((self.settings.audio.bpchd * 1000)
-                                              * self.av_info.audio[select]
-                                              .channels
-                                              )
-                                          ]
-                                         )
-                if not self.hd:
-                    if self.settings.audio.codecsd == 'copy':
-                        audio_map.append('copy')
-                    elif self.settings.audio.codecsd != 'ac3':
-                        audio_map.extend([self.settings.audio.codecsd,
-                                          '-b:a',
-                                          str((self.settings.audio.bpcsd * 1000)
-                                              * self.av_info.audio[select]
-                                              .channels
-                                              )
-                                          ]
-                                         )
+                if codec == 'copy':
+                    audio_map.append('copy')
+                else:
+                    audio_map.extend([codec,
+                                      '-b:a',
+                                      str((bitrate_per_channel * 1000)
+                                          * self.av_info.audio[select]
+                                          .channels
+                                          )
+                                      ]
+                                     )
                 audio_map.extend(('-metadata:s:0:{}'
                                   .format(self.av_info.audio[select]
                                           .stream_index),
@@ -1122,104 +4138,254 @@ class Encoder:
                 for audio_select in audio_map_list:
                     if ('language={}'.format(self.settings.audio.language)
                             in audio_select):
-                            self.audio_config.extend(audio_select)
-                if len(self.audio_config) < 1:
+                            audio_config.extend(audio_select)
+                if len(audio_config) < 1:
                     raise ValueError('No audio streams match selected language')
             else:
-                self.audio_config.extend(audio_map_list)
+                for audio_select in audio_map_list:
+                    audio_config.extend(audio_select)
+            return audio_config
+
+        def audio_setup():
+            """Create self.audio_config list for use by ffmpeg"""
+            if self.hd:
+                self.audio_config = audio_options(self.settings.audio.codechd,
+                                                  self.settings.audio.bpchd
+                                                  )
+            else:
+                self.audio_config = audio_options(self.settings.audio.codecsd,
+                                                  self.settings.audio.bpcsd
+                                                  )
+
+        def loudness_stream():
+            """
+            Return the position among the audio streams of the cut file of
+            the first stream of the selected language
+            """
+            audio = sorted((stream for stream in self.av_info.audio.values()
+                            if str(stream.channels) != '0'),
+                           key=lambda stream: int(stream.stream_index))
+            for position, stream in enumerate(audio):
+                if self.settings.audio.language in ('all', stream.language):
+                    return position
+            return 0
+
+        def loudness_setup(loudness_log):
+            """
+            Create self.loudness_config, the volume filter taking the
+            measured integrated loudness to settings.file.loudnesstarget
+            without the true peak exceeding settings.file.truepeak
+            """
+            measurement = parse_ebur128(loudness_log)
+            if not measurement:
+                logging.warning('No loudness measurement, not normalising')
+                return
+            loudness, peak = measurement
+            gain = self.settings.file.loudnesstarget - loudness
+            if peak + gain > self.settings.file.truepeak:
+                gain = self.settings.file.truepeak - peak
+                logging.info('Normalisation limited by true peak')
+            logging.info('Loudness {:.1f} LUFS peak {:.1f} dBTP gain '
+                         '{:.1f} dB'.format(loudness, peak, gain))
+            self.loudness_config = ['-af', 'volume={:.2f}dB'.format(gain)]
+
+        def filter_setup():
+            """
+            Create self.rendition_config, a list of (rendition, ffmpeg
+            output options, output file) for each configured rendition, and
+            self.video_filter, the filter graph decoding and deinterlacing
+            once and splitting the video between the outputs and, with
+            self.detect, the commercial detection filters. Detection
+            results are written to files in the temporary directory, as
+            are the preview images with self.thumbnail
+            """
+            self.rendition_config = []
+            self.video_filter = None
+            renditions = self.settings.file.renditions
+            if not renditions and not self.detect and not self.thumbnail:
+                return
+            only_cut = self.settings.file.commethod == 'only-cut'
+            # the only-cut output is a stream copy, the graph then only
+            #  feeds the renditions encoded from it
+            outputs = [] if only_cut else ['[v0]']
+            graph = []
+            for index, rendition in enumerate(renditions, 1):
+                fileformat = rendition.get('fileformat',
+                                           self.settings.file.fileformat)
+                height = rendition.get('height')
+                if height and height < self.av_info.video.height:
+                    graph.append('[s{0}]scale=-2:{1}[v{0}]'
+                                 .format(index, height))
+                    outputs.append('[s{}]'.format(index))
+                else:
+                    outputs.append('[v{}]'.format(index))
+                options = ['-map', '[v{}]'.format(index), '-c:v',
+                           rendition.get('codec', 'libx264'), '-preset:v',
+                           rendition.get('preset', 'medium'), '-crf:v',
+                           str(rendition.get('crf', 23))
+                           ]
+                if fileformat == 'mp4':
+                    options.extend(['-movflags', 'faststart'])
+                options.extend(audio_options(rendition.get('audiocodec', 'aac'),
+                                             rendition.get('bpc', 64)
+                                             ))
+                if self.metadata_file:
+                    options.extend(['-map_metadata', '1'])
+                # each rendition is named like the main output in its own
+                #  directory of the work directory
+                rendition_dir = '{}/{}/'.format(
+                    os.path.dirname(self.output_file), rendition['name'])
+                if not os.path.isdir(rendition_dir):
+                    os.makedirs(rendition_dir)
+                output = '{}{}.{}'.format(rendition_dir,
+                                          os.path.basename(self.output_file),
+                                          fileformat
+                                          )
+                self.rendition_config.append((rendition, options, output))
+            if self.detect:
+                outputs.append('[det]')
+                graph.extend([
+                    '[det]split=3[black][scene][logo]',
+                    '[black]blackdetect=d=0.1:pix_th=0.10,'
+                    'metadata=mode=print:file=black.txt,nullsink',
+                    "[scene]select='gt(scene,0.4)',"
+                    'metadata=mode=print:file=scene.txt,nullsink',
+                    '[logo]fps=1,crop={},edgedetect,signalstats,'
+                    'metadata=mode=print:key=lavfi.signalstats.YAVG:'
+                    'file=logo.txt,nullsink'
+                    .format(self.settings.file.logoarea)
+                ])
+                audio = sorted(self.av_info.audio.values(),
+                               key=lambda stream: int(stream.stream_index))
+                if audio:
+                    graph.append('[0:{}]silencedetect=n=-50dB:d=0.1,'
+                                 'ametadata=mode=print:file=silence.txt,'
+                                 'anullsink'.format(audio[0].stream_index))
+            if self.thumbnail:
+                # low frame rate branches for the trickplay images and the
+                #  poster frame candidates, written to the temporary directory
+                outputs.extend(['[thumbs]', '[poster]'])
+                graph.extend([
+                    '[thumbs]fps=1/{},scale={}:-2[thumbout]'
+                    .format(self.settings.file.previewinterval,
+                            self.settings.file.previewwidth),
+                    '[poster]fps=1/60,scale=-2:{}[posterout]'
+                    .format(min(720, int(self.av_info.video.height)))
+                ])
+                self.thumbnail_config = [
+                    '-map', '[thumbout]', '-q:v', '5', '-f', 'image2',
+                    '{}thumb%05d.jpg'.format(self.temp_dir),
+                    '-map', '[posterout]', '-q:v', '2', '-f', 'image2',
+                    '{}poster%03d.jpg'.format(self.temp_dir)
+                ]
+            source = '[0:{}]'.format(self.av_info.video.stream_index)
+            if only_cut:
+                source = '[0:v:0]'
+            if self.deinterlacer:
+                source = '{}{},'.format(source, self.deinterlacer)
+            self.video_filter = ';'.join(
+                ['{}split={}{}'.format(source, len(outputs), ''.join(outputs))]
+                + graph)
 
-        def metadata_setup():
+        def metadata_setup(metadata=None, metadata_file=None, rebuild=False):
             """Create FFMetadata text file for embedding meta-data with FFmpeg
-            file will be located in settings.temp_dir
+            file will be located in settings.temp_dir. Given the metadata of
+            an episode it is written to metadata_file, without chapters.
+            rebuild rewrites the file of an earlier setup, e.g. with new
+            chapters, leaving the input maps as they are
             """
-            metadata_file = '{}metadata.txt'.format(self.temp_dir)
-            if self.metadata.programid is not u'UNKNOWN':
+            episode = metadata is not None
+            if not episode:
+                metadata = self.metadata
+                metadata_file = '{}metadata.txt'.format(self.temp_dir)
+            if metadata.programid is not u'UNKNOWN':
                 with open(metadata_file, 'w') as mf:
                     mf.write(u';FFMETADATA1\n')
                     if self.settings.file.fileformat == 'mp4':
-                        if (self.metadata.programid.startswith(u'EP') or any(
-                                (self.metadata.season, self.metadata.episode))):
+                        if (metadata.programid.startswith(u'EP') or any(
+                                (metadata.season, metadata.episode))):
                             mf.write(u'show={}\ntitle={}\n'
                                      u'season_number={:02d}\n'
                                      u'episode_sort={:02d}\n'
-                                     .format(self.metadata.title,
-                                             self.metadata.subtitle,
-                                             self.metadata.season,
-                                             self.metadata.episode
+                                     .format(metadata.title,
+                                             metadata.subtitle,
+                                             metadata.season,
+                                             metadata.episode
                                              )
                                      )
-                            if self.metadata.description != '':
+                            if metadata.description != '':
                                 mf.write(u'description={}\n'
-                                         .format(self.metadata.description)
+                                         .format(metadata.description)
                                          )
-                            if (not self.metadata.previouslyshown and
-                                    self.metadata.originalairdate is None):
+                            if (not metadata.previouslyshown and
+                                    metadata.originalairdate is None):
                                 mf.write(u'date={}\n'
-                                         .format(self.metadata.starttime.date())
+                                         .format(metadata.starttime.date())
                                          )
-                            if (self.metadata.previouslyshown and
-                                    self.metadata.originalairdate is not None):
+                            if (metadata.previouslyshown and
+                                    metadata.originalairdate is not None):
                                 mf.write(u'date={}\n'
-                                         .format(self.metadata.originalairdate)
+                                         .format(metadata.originalairdate)
                                          )
-                        if self.metadata.programid.startswith(u'MV'):
-                            mf.write(u'title={}\n'.format(self.metadata.title))
-                            if self.metadata.description != '':
+                        if metadata.programid.startswith(u'MV'):
+                            mf.write(u'title={}\n'.format(metadata.title))
+                            if metadata.description != '':
                                 mf.write(u'description={}\n'
-                                         .format(self.metadata.description)
+                                         .format(metadata.description)
                                          )
                     if self.settings.file.fileformat == 'mkv':
-                        if (self.metadata.programid.startswith(u'EP') or
-                                any((self.metadata.season,
-                                     self.metadata.episode
+                        if (metadata.programid.startswith(u'EP') or
+                                any((metadata.season,
+                                     metadata.episode
                                      )
                                     )):
                             mf.write(u'TITLE={}\nSUBTITLE={}\nSEASON={:02d}\n'
                                      u'EPISODE={:02d}\n'
-                                     .format(self.metadata.title,
-                                             self.metadata.subtitle,
-                                             self.metadata.season,
-                                             self.metadata.episode
+                                     .format(metadata.title,
+                                             metadata.subtitle,
+                                             metadata.season,
+                                             metadata.episode
                                              )
                                      )
-                            if self.metadata.description != '':
+                            if metadata.description != '':
                                 mf.write(u'DESCRIPTION={}\n'
-                                         .format(self.metadata.description)
+                                         .format(metadata.description)
                                          )
-                            if (not self.metadata.previouslyshown and
-                                    self.metadata.originalairdate is None):
+                            if (not metadata.previouslyshown and
+                                    metadata.originalairdate is None):
                                 mf.write(u'DATE_RELEASED={}\n'
-                                         .format(self.metadata.starttime.date())
+                                         .format(metadata.starttime.date())
                                          )
-                            if (self.metadata.previouslyshown and
-                                    self.metadata.originalairdate is not None):
+                            if (metadata.previouslyshown and
+                                    metadata.originalairdate is not None):
                                 mf.write(u'DATE_RELEASED={}\n'
-                                         .format(self.metadata.originalairdate)
+                                         .format(metadata.originalairdate)
                                          )
-                        if self.metadata.programid.startswith(u'MV'):
-                            mf.write(u'TITLE={}'.format(self.metadata.title))
-                            if self.metadata.description != u'':
+                        if metadata.programid.startswith(u'MV'):
+                            mf.write(u'TITLE={}'.format(metadata.title))
+                            if metadata.description != u'':
                                 mf.write(u'DESCRIPTION={}\n'
-                                         .format(self.metadata.description)
+                                         .format(metadata.description)
                                          )
-                            if (self.metadata.year !=
-                                    self.metadata.starttime.year):
+                            if (metadata.year !=
+                                    metadata.starttime.year):
                                 mf.write(u'DATE_RELEASED={}\n'
-                                         .format(self.metadata.year)
+                                         .format(metadata.year)
                                          )
                                 # Need to build grabber for inet metadata
 
-                    if self.settings.file.commethod == 'chapters':
+                    if (self.settings.file.commethod == 'chapters'
+                            and not episode):
                         chapter_list = []
-                        if self.metadata.cutlists.cut_list:
+                        if metadata.cutlists.cut_list:
                             chapter_list = [i for v in
-                                            self.metadata.cutlists.cut_list
+                                            metadata.cutlists.cut_list
                                             for i in v
                                             ]
-                        if not self.metadata.cutlists.cut_list:
-                            if self.metadata.cutlists.skip_list:
+                        if not metadata.cutlists.cut_list:
+                            if metadata.cutlists.skip_list:
                                 chapter_list = [i for v in
-                                                self.metadata.cutlists.skip_list
+                                                metadata.cutlists.skip_list
                                                 for i in v
                                                 ]
                         if chapter_list:
@@ -1236,6 +4402,8 @@ class Encoder:
                                                  )
                                          )
                                 chapter_list.remove(chapter_list[0])
+            if episode or rebuild:
+                return
             if os.path.isfile(metadata_file):
                     self.metadata_file = metadata_file
                     self.map_count = self.map_count + 1
@@ -1254,17 +4422,19 @@ class Encoder:
             # Character used to pad progress bar
             pad = ' '
 
-            cc_extractor = program_check('mythccextractor', 'ccextractor')
+            cc_extractor = app.program('mythccextractor', 'ccextractor')
             command = [cc_extractor, '-i', input_file, '-d', output_dir]
             print(subprocess.list2cmdline(command))
             with tempfile.TemporaryFile() as output:
+                self.metrics.start_child('Extracting Closed Captions')
                 process = subprocess.Popen(command, stdout=output,
                                            stderr=output,
                                            universal_newlines=True
                                            )
 
                 while True:
-                    if process.poll() is not None:
+                    if poll_child(process, self.metrics,
+                                  'Extracting Closed Captions') is not None:
                         if process.poll() != 0:
                             output.seek(0)
                             logging.error((output.read().decode('UTF-8')))
@@ -1273,6 +4443,9 @@ class Encoder:
                         if process.poll() == 0:
                             print('\rFinished{}'.format(pad * (statlen + 3)))
                             break
+                    self.job_control.check(process,
+                                           prefix='Extracting Closed Captions'
+                                           )
                     where = output.tell()
                     lines = output.read().decode('UTF-8')
                     if not lines:
@@ -1305,6 +4478,21 @@ class Encoder:
                         # Replace with flush=True in print function for python 3
                         sys.stdout.flush()
 
+        def closed_captions():
+            """Extract closed captions unless checkpointed"""
+            if self.checkpoint.done('closed captions'):
+                return
+            self.checkpoint.start('closed captions')
+            for subtitle_file in glob('{}*.srt'.format(self.temp_dir)):
+                os.remove(subtitle_file)
+            logging.info('Start extracting Closed Captions')
+            with self.metrics.phase('closed captions'):
+                extract_closed_captions(self.temp_file, self.temp_dir)
+            logging.info('Finished extracting Closed Captions')
+            self.checkpoint.complete('closed captions',
+                                     glob('{}*.srt'.format(self.temp_dir))
+                                     )
+
         def subtitle_setup():
             """Configure subtitle encoding input and metadata lists"""
             # move args to self.arg | add self.map_count to encoder
@@ -1341,8 +4529,15 @@ class Encoder:
                     elif fileformat == 'mp4':
                         self.subtitle_input.extend(['-c:s', 'mov_text'])
 
-        def run_encode(command, avinfo, prefix='Encoding'):
-            """ Run ffmpeg command with status output"""
+        def run_encode(command, avinfo, prefix='Encoding', sources=None,
+                       outputs=None, expected_fps=None, cwd=None,
+                       log_file=None):
+            """ Run ffmpeg command with status output. Cached pages of
+            sources and outputs are dropped behind the encode. expected_fps
+            is used for the ETA until the encode reports progress. cwd is
+            the working directory of ffmpeg. The output of a successful
+            command is saved to log_file
+            """
             # Length of progress bar
             statlen = 9 + len(prefix)
             # Character used for progress bar
@@ -1354,16 +4549,28 @@ class Encoder:
             frame_rate = avinfo.video.frame_rate
             duration = float(avinfo.duration)
             total_frames = duration * frame_rate
+            # metrics phase of each command for the job ETA
+            phases = {'Segmenting': 'segmenting',
+                      'Joining segments': 'joining',
+                      'Encoding': 'encoding',
+                      'Remuxing': 'remuxing'
+                      }
 
             with tempfile.TemporaryFile() as output:
+                self.metrics.start_child(prefix)
                 process = subprocess.Popen(command, stdout=output,
                                            stderr=output,
-                                           universal_newlines=True
+                                           universal_newlines=True, cwd=cwd
                                            )
+                drop_behind = DropBehind(self.cache_policy, sources=sources,
+                                         outputs=outputs
+                                         )
                 framenum = 0
+                start_time = time.time()
+                paused_before = self.job_control.paused_time
 
                 while True:
-                    if process.poll() is not None:
+                    if poll_child(process, self.metrics, prefix) is not None:
                         if process.poll() != 0:
                             output.seek(0)
                             logging.error((output.read().decode('UTF-8')))
@@ -1371,7 +4578,18 @@ class Encoder:
                             sys.exit(1)
                         if process.poll() == 0:
                             print('\rFinished{}'.format(pad * (statlen + 3)))
+                            active_time = (time.time() - start_time
+                                           - self.job_control.paused_time
+                                           + paused_before)
+                            self.metrics.set_frames(prefix, framenum,
+                                                    active_time)
+                            drop_behind.finish()
+                            if log_file:
+                                output.seek(0)
+                                with open(log_file, 'w') as lf:
+                                    lf.write(output.read().decode('UTF-8'))
                             break
+                    self.job_control.check(process, prefix=prefix)
                     where = output.tell()
                     lines = output.read().decode('UTF-8')
                     if not lines:
@@ -1383,9 +4601,14 @@ class Encoder:
                         for item in ln:
                             if item.startswith('frame='):
                                 framenum = int(item.replace('frame=', ''))
-                                # get fps
-                                if item.startswith('fps='):
-                                    fps = float(item.replace('fps=', ''))
+                    # ffmpeg's fps includes time spent stopped so use
+                    #  the active encoding time instead
+                    paused_time = self.job_control.paused_time - paused_before
+                    active_time = time.time() - start_time - paused_time
+                    if framenum > 0 and active_time > 0:
+                        fps = framenum / active_time
+                    elif expected_fps:
+                        fps = expected_fps
                     else:
                         fps = 0
 
@@ -1395,6 +4618,7 @@ class Encoder:
                         pcomp = int(100 * (float(framenum)
                                            / float(total_frames))
                                     )
+                        drop_behind.update(min(framenum / total_frames, 1))
                     if fps > 0:
                         eta = ((float(total_frames) - framenum)
                                / fps
@@ -1406,11 +4630,26 @@ class Encoder:
 
                     else:
                         eta_string = 'Unknown'
+                    if paused_time > 0:
+                        eta_string = ('{} Paused: {}'
+                                      .format(eta_string,
+                                              time.strftime('%H:%M:%S',
+                                                            time.gmtime(
+                                                                paused_time)
+                                                            )
+                                              )
+                                      )
+
+                    if fps > 0:
+                        job_eta = self.eta.string(phases.get(prefix), eta)
+                    else:
+                        job_eta = self.eta.string(phases.get(prefix))
 
                     if job:
-                        progress_string = ('{}: {}% complete ETA: {}'
+                        progress_string = ('{}: {}% complete ETA: {} '
+                                           'Job ETA: {}'
                                            .format(prefix, pcomp,
-                                                   eta_string
+                                                   eta_string, job_eta
                                                    )
                                            )
                         job.update({'status': job.RUNNING,
@@ -1432,14 +4671,31 @@ class Encoder:
 
         def standard_transcode(input_file=self.input_file,
                                output_file=self.output_file):
-            """Run transcode with optional metadata and subtitles"""
+            """
+            Run transcode with optional metadata and subtitles. With
+            renditions the video is decoded and deinterlaced once and split
+            between the main output and each rendition's encoder
+            """
             base_command = [self.ffmpeg, '-y', '-i', input_file]
             if self.metadata_file:
                 base_command.extend(['-i', self.metadata_file])
             if self.settings.file.includesub and self.subtitle_input:
                 base_command.extend(self.subtitle_input)
-            base_command.extend(self.video_config)
+            if self.video_filter:
+                base_command.extend(['-filter_complex', self.video_filter,
+                                     '-map', '[v0]'])
+                video_config = self.video_config[2:]
+                if self.deinterlacer:
+                    video_config = video_config[2:]
+                base_command.extend(video_config)
+            else:
+                base_command.extend(self.video_config)
+            if self.episode_times:
+                base_command.extend(['-force_key_frames', ','.join(
+                    '{:.3f}'.format(point) for point in self.episode_times)])
             base_command.extend(self.audio_config)
+            if 'copy' not in self.audio_config:
+                base_command.extend(self.loudness_config)
             base_command.extend(['-map_metadata', '1'])
             if self.settings.file.includesub and self.subtitle_metadata:
                 base_command.extend(self.subtitle_metadata)
@@ -1447,7 +4703,221 @@ class Encoder:
                                                self.settings.file.fileformat
                                                )
                                 )
-            run_encode(base_command, self.av_info)
+            outputs = [base_command[-1]]
+            for rendition, options, rendition_file in self.rendition_config:
+                base_command.extend(options)
+                if 'copy' not in options:
+                    base_command.extend(self.loudness_config)
+                base_command.append(rendition_file)
+                outputs.append(rendition_file)
+            base_command.extend(self.thumbnail_config)
+            if self.checkpoint.done('encoding'):
+                # the output already has the chapters of the detection
+                skip_list = self.checkpoint.data('encoding').get('skip_list')
+                if skip_list:
+                    skip_list = [tuple(mark) for mark in skip_list]
+                    self.detected_skip_list = skip_list
+                    self.metadata.cutlists['skip_list'] = skip_list
+                    self.metadata.cutlists.skip_list = skip_list
+                return
+            self.checkpoint.start('encoding')
+            # pages are only dropped behind reads of the recording, an
+            #  intermediate joined file is not read again anyway
+            sources = [input_file] if input_file == self.input_file else []
+            with self.metrics.phase('encoding'):
+                run_encode(base_command, self.av_info, sources=sources,
+                           outputs=outputs, expected_fps=self.expected_fps,
+                           cwd=self.temp_dir
+                           )
+            if self.detect:
+                with self.metrics.phase('commercial detection'):
+                    apply_detection(outputs[0])
+            self.checkpoint.complete('encoding', outputs,
+                                     {'skip_list': self.detected_skip_list})
+
+        def apply_detection(output):
+            """
+            Build self.detected_skip_list from the detection filter results
+            and remux output with chapters at the detected breaks
+            """
+            frame_rate = self.av_info.video.frame_rate
+            breaks = detect_commercials(
+                metadata_periods(read_filter_metadata(
+                    '{}black.txt'.format(self.temp_dir)),
+                    'lavfi.black_start', 'lavfi.black_end'),
+                metadata_periods(read_filter_metadata(
+                    '{}silence.txt'.format(self.temp_dir)),
+                    'lavfi.silence_start', 'lavfi.silence_end'),
+                [pts_time for pts_time, values in read_filter_metadata(
+                    '{}scene.txt'.format(self.temp_dir))],
+                [(pts_time, float(values['lavfi.signalstats.YAVG']))
+                 for pts_time, values in read_filter_metadata(
+                    '{}logo.txt'.format(self.temp_dir))
+                 if 'lavfi.signalstats.YAVG' in values],
+                float(self.av_info.duration)
+            )
+            logging.info('Detected {} commercial breaks'.format(len(breaks)))
+            if not breaks:
+                return
+            self.detected_skip_list = [(int(start * frame_rate),
+                                        int(end * frame_rate))
+                                       for start, end in breaks]
+            self.metadata.cutlists['skip_list'] = self.detected_skip_list
+            self.metadata.cutlists.skip_list = self.detected_skip_list
+            metadata_setup(rebuild=True)
+            if not self.metadata_file:
+                return
+            fileformat = self.settings.file.fileformat
+            chapter_file = '{}.chapters.{}'.format(output.rsplit('.', 1)[0],
+                                                   fileformat)
+            command = [self.ffmpeg, '-y', '-v', 'error', '-i', output, '-i',
+                       self.metadata_file, '-map', '0', '-map_metadata', '1',
+                       '-map_chapters', '1', '-c', 'copy'
+                       ]
+            if fileformat == 'mp4':
+                command.extend(['-movflags', 'faststart'])
+            command.append(chapter_file)
+            subprocess.check_call(command)
+            os.rename(chapter_file, output)
+
+        def preview_setup():
+            """
+            Build self.previews from the images written by the encode: the
+            poster frame, the MythTV preview image and a trickplay BIF
+            """
+            thumbs = sorted(glob('{}thumb*.jpg'.format(self.temp_dir)))
+            posters = sorted(glob('{}poster*.jpg'.format(self.temp_dir)))
+            if posters:
+                self.previews['poster'] = pick_poster(posters)
+                preview = '{}preview.png'.format(self.temp_dir)
+                subprocess.check_call([self.ffmpeg, '-y', '-v', 'error', '-i',
+                                       self.previews['poster'], '-vf',
+                                       'scale=320:-2', preview
+                                       ])
+                self.previews['preview'] = preview
+            if thumbs:
+                self.previews['bif'] = '{}trickplay.bif'.format(self.temp_dir)
+                write_bif(thumbs, self.previews['bif'],
+                          self.settings.file.previewinterval)
+            logging.info('Created {} preview images'
+                         .format(len(thumbs) + len(posters)))
+
+        def episode_setup():
+            """
+            Set self.episode_times, the output times separating the
+            episodes, from the commercial breaks of the cut-list or
+            skip-list
+            """
+            frame_rate = self.av_info.video.frame_rate
+            if self.settings.file.commethod == 'remove':
+                kept = get_kept_ranges(self.av_info, self.metadata,
+                                       self.settings)
+                breaks = []
+                position = 0
+                for start, end in kept:
+                    position += end - start
+                    breaks.append(position)
+                duration = breaks.pop()
+            else:
+                cut_list = (self.metadata.cutlists.cut_list
+                            or self.metadata.cutlists.skip_list or [])
+                duration = float(self.av_info.duration)
+                breaks = [start for start, end
+                          in frames_to_time(cut_list, frame_rate)
+                          if 0 < start < duration]
+            self.episode_times = episode_boundaries(
+                sorted(breaks), duration, len(self.metadata.episodes)) or []
+            if not self.episode_times:
+                logging.warning('Commercial breaks do not separate the {} '
+                                'episodes, not splitting'
+                                .format(len(self.metadata.episodes)))
+            logging.debug('Episode boundaries: {}'
+                          .format(self.episode_times))
+
+        def split_episodes(output):
+            """
+            Copy the episodes of output, starting at the key frames forced
+            at self.episode_times, to separate files with their own
+            metadata. The copies run concurrently. Sets
+            self.episode_outputs to a list of (episode metadata, file)
+            """
+            fileformat = self.settings.file.fileformat
+            episode_dir = '{}/episodes/'.format(os.path.dirname(output))
+            if not os.path.isdir(episode_dir):
+                os.makedirs(episode_dir)
+            times = [0] + self.episode_times + [None]
+            processes = []
+            self.episode_outputs = []
+            for number, episode in enumerate(self.metadata.episodes):
+                metadata_file = '{}metadata{}.txt'.format(self.temp_dir,
+                                                          number)
+                metadata_setup(episode, metadata_file)
+                episode_file = '{}{}.{}'.format(
+                    episode_dir, FileSetup(self.settings, episode).filename,
+                    fileformat)
+                command = [self.ffmpeg, '-y', '-v', 'error', '-ss',
+                           '{:.3f}'.format(times[number])]
+                if times[number + 1] is not None:
+                    command.extend(['-t', '{:.3f}'.format(
+                        times[number + 1] - times[number])])
+                command.extend(['-i', output])
+                if os.path.isfile(metadata_file):
+                    command.extend(['-i', metadata_file, '-map_metadata', '1'])
+                command.extend(['-map', '0', '-map_chapters', '-1', '-c',
+                                'copy'])
+                if fileformat == 'mp4':
+                    command.extend(['-movflags', 'faststart'])
+                command.append(episode_file)
+                processes.append(subprocess.Popen(command))
+                self.episode_outputs.append((episode, episode_file))
+            if any([process.wait() for process in processes]):
+                logging.error('Splitting episodes failed')
+                sys.exit(1)
+            logging.info('Split into {} episodes'
+                         .format(len(self.episode_outputs)))
+
+        def rendition_transcode(input_file):
+            """
+            Encode the renditions from the only-cut output input_file,
+            decoding and deinterlacing it once for all of them
+            """
+            command = [self.ffmpeg, '-y', '-i', input_file]
+            if self.metadata_file:
+                command.extend(['-i', self.metadata_file])
+            command.extend(['-filter_complex', self.video_filter])
+            outputs = []
+            for rendition, options, rendition_file in self.rendition_config:
+                command.extend(options)
+                command.append(rendition_file)
+                outputs.append(rendition_file)
+            if self.checkpoint.done('renditions'):
+                return
+            self.checkpoint.start('renditions')
+            with self.metrics.phase('encoding'):
+                run_encode(command, AVInfo(input_file), outputs=outputs,
+                           expected_fps=self.expected_fps
+                           )
+            self.checkpoint.complete('renditions', outputs)
+
+        def remux(output_file=self.output_file):
+            """Stream copy the whole recording to MPEG-TS"""
+            command = [self.ffmpeg, '-ignore_unknown', '-y', '-i',
+                       self.input_file, '-c', 'copy', '-map', '0'
+                       ]
+            for streams, stream in self.av_info.audio.items():
+                if stream.channels == '0':
+                    command.extend(['-map', '-0:{}'.format(stream.index)])
+            command.extend(['-f', 'mpegts', '{}.ts'.format(output_file)])
+            if self.checkpoint.done('remuxing'):
+                return
+            self.checkpoint.start('remuxing')
+            # the renditions are encoded from the output next
+            outputs = [] if self.rendition_config else [command[-1]]
+            with self.metrics.phase('remuxing'):
+                run_encode(command, self.av_info, prefix='Remuxing',
+                           sources=[self.input_file], outputs=outputs
+                           )
+            self.checkpoint.complete('remuxing', [command[-1]])
 
         def no_transcode_cut(output_file=self.output_file):
             """Cut commercials without transcoding using FFmpeg -segment"""
@@ -1482,26 +4952,41 @@ class Encoder:
                                 '{}cut%03d.ts'.format(self.temp_dir)
                                 ]
                                )
-            run_encode(cut_command, self.av_info, prefix='Segmenting')
+            if not self.checkpoint.done('segmenting'):
+                self.checkpoint.start('segmenting')
+                for segment in glob('{}cut*.ts'.format(self.temp_dir)):
+                    os.remove(segment)
+                with self.metrics.phase('segmenting'):
+                    # the segments are read again by the join, keep them
+                    #  cached
+                    run_encode(cut_command, self.av_info, prefix='Segmenting',
+                               sources=[self.input_file]
+                               )
+                self.checkpoint.complete('segmenting',
+                                         glob('{}cut*.ts'
+                                              .format(self.temp_dir))
+                                         )
             logging.info('segmenting video finished')
             # Join segment files in temp_dir.
             #  using cut_start to determine start/step of the files to be joined
-            file_list = []
-            # Get list of segment files
-            for root, dirs, files in os.walk(self.temp_dir):
-                for File in files:
-                    if (File.endswith('.ts') and
-                            File.startswith('cut')):
-                        if os.path.isfile(os.path.join(root, File)):
-                            file_list.append(os.path.join(root, File))
+            # Get list of segment files in segment order
+            file_list = self.checkpoint.outputs('segmenting')
             # Set list of files to be joined
             join_list = file_list[cut_start::2]
             concat_string = ','.join(join_list).replace(',', '|')
+            joined_file = '{}.{}'.format(output_file, 'ts')
             join_command = [self.ffmpeg, '-y', '-i',
                             'concat:{}'.format(concat_string),
                             '-map', '0', '-c', 'copy', '-f', 'mpegts',
-                            '{}.{}'.format(output_file, 'ts')
+                            joined_file
                             ]
+            loudness_log = '{}loudness.log'.format(self.temp_dir)
+            if self.loudness:
+                # The join reads only the kept ranges, measure their
+                #  loudness there decoding just the audio
+                join_command.extend(['-map', '0:a:{}'.format(
+                    loudness_stream()), '-af', 'ebur128=peak=true',
+                    '-f', 'null', '-'])
             duration_list = []
             frame_rate_list = []
             video_codec_list = []
@@ -1536,27 +5021,56 @@ class Encoder:
                     self.video = DictToNamespace({'frame_rate': frame_rate})
 
             join_info = AVJoin(duration, frame_rate_list[0])
-            run_encode(join_command, join_info, prefix='Joining segments')
+            # only drop the joined file when it is the final output, the
+            #  encode or the renditions read it next otherwise
+            join_outputs = []
+            if output_file == self.output_file and not self.rendition_config:
+                join_outputs = [joined_file]
+            if not self.checkpoint.done('joining'):
+                self.checkpoint.start('joining')
+                with self.metrics.phase('joining'):
+                    run_encode(join_command, join_info,
+                               prefix='Joining segments',
+                               outputs=join_outputs, log_file=loudness_log
+                               )
+                self.checkpoint.complete('joining', [joined_file])
             logging.info('Finished joining segments')
+            if self.loudness:
+                loudness_setup(loudness_log)
             # print(subprocess.list2cmdline(join_command))
 
         # Setup encoding parameters and create metadata file
         deinterlacer()
+        crf_setup()
         video_setup()
         audio_setup()
         metadata_setup()
+        filter_setup()
+        if self.split:
+            episode_setup()
+        definition = 'hd' if self.hd else 'sd'
+        calibration = calibrated_speed(
+            load_host_profile(),
+            self.settings.video['codec{}'.format(definition)],
+            self.settings.video['preset{}'.format(definition)],
+            self.crf, definition, interlaced=bool(self.deinterlacer)
+        )
+        if calibration:
+            self.expected_fps = calibration[0]
 
         if self.settings.file.commethod == 'chapters':
             if self.settings.file.includesub:
-                logging.info('Start extracting Closed Captions')
-                extract_closed_captions(self.temp_file, self.temp_dir)
-                logging.info('Finished extracting Closed Captions')
+                closed_captions()
                 subtitle_setup()
             logging.info('Start encoding')
             standard_transcode()
+            if self.thumbnail:
+                preview_setup()
             self.output_file = '{}.{}'.format(self.output_file,
                                               self.settings.file.fileformat
                                               )
+            if self.episode_times:
+                split_episodes(self.output_file)
             logging.info('Finished encoding')
             logging.debug('Output file: {}'.format(self.output_file))
         if self.settings.file.commethod == 'remove':
@@ -1566,31 +5080,138 @@ class Encoder:
             self.temp_file = '{}.ts'.format(self.temp_file)
             logging.debug('Output file: {}'.format(self.output_file))
             if self.settings.file.includesub:
-                logging.info('Start extracting Closed Captions')
-                extract_closed_captions(self.temp_file, self.temp_dir)
-                logging.info('Finished extracting Closed Captions')
+                closed_captions()
                 subtitle_setup()
             logging.info('Start encoding')
             standard_transcode(input_file=self.temp_file)
+            if self.thumbnail:
+                preview_setup()
             self.output_file = '{}.{}'.format(self.output_file,
                                               self.settings.file.fileformat
                                               )
+            if self.episode_times:
+                split_episodes(self.output_file)
             logging.info('Finished encoding')
             logging.debug('Output file: {}'.format(self.output_file))
-        if self.settings.file.commethod == 'only-cut':
+        if self.settings.file.commethod == 'only-cut' and self.remux:
+            logging.info('No cut-list, remuxing')
+            self.settings.file.fileformat = '.ts'
+            self.final_stage = 'remuxing'
+            remux(self.output_file)
+            self.output_file = '{}.ts'.format(self.output_file)
+            logging.debug('Output file: {}'.format(self.output_file))
+        elif self.settings.file.commethod == 'only-cut':
             logging.info('Start commercial removal')
             self.settings.file.fileformat = '.ts'
+            self.final_stage = 'joining'
             no_transcode_cut(self.output_file)
             self.output_file = '{}.ts'.format(self.output_file)
             logging.info('Finished commercial removal')
             logging.debug('Output file: {}'.format(self.output_file))
+        if self.settings.file.commethod == 'only-cut' and self.rendition_config:
+            logging.info('Start encoding renditions')
+            self.rendition_stage = 'renditions'
+            rendition_transcode(self.output_file)
+            logging.info('Finished encoding renditions')
+
+        # With keep_temp the caller removes the temporary directory once
+        #  the output is exported so the checkpoint covers the export
+        if not keep_temp:
+            remove_temp(self.temp_dir)
 
-        # Cleanup here?
-        remove_temp(self.temp_dir)
+
+class BackgroundTask:
+    """
+    Run function(*args, **kwargs) in a thread. result() waits for it and
+    returns its value or raises its exception, including SystemExit, in
+    the calling thread
+    """
+    def __init__(self, function, *args, **kwargs):
+        import threading
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run,
+                                       args=(function, args, kwargs)
+                                       )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, function, args, kwargs):
+        try:
+            self.value = function(*args, **kwargs)
+        except BaseException:
+            self.error = sys.exc_info()
+
+    def result(self):
+        self.thread.join()
+        if self.error:
+            if sys.version_info[0] < 3:
+                exec('raise self.error[0], self.error[1], self.error[2]')
+            raise self.error[1].with_traceback(self.error[2])
+        return self.value
+
+
+def prepare_metadata(rec, settings, metrics):
+    """
+    Read metadata and cut lists of rec, searching online if enabled, and
+    configure output naming. The only database user while it runs
+    """
+    with metrics.phase('metadata lookup'):
+        rec_meta = RecordingToMetadata(rec,
+                                       allow_search=settings.file.allowsearch
+                                       )
+        file_items = FileSetup(settings, metadata=rec_meta)
+    return rec_meta, file_items
+
+
+def probe(input_file, metrics):
+    """AVInfo of input_file recorded as the probe phase"""
+    with metrics.phase('probe'):
+        return AVInfo(input_file)
+
+
+def backup(input_file, metrics):
+    """
+    Keep a .old copy of input_file recorded as the backup phase. copied
+    under a temporary name so an interrupted job leaves no partial .old
+    """
+    logging.info('Copying file to {}.old'.format(input_file))
+    with metrics.phase('backup'):
+        partial = '{}.old.part'.format(input_file)
+        if os.path.isfile(partial):
+            os.remove(partial)
+        method = clone_file(input_file, partial)
+        os.rename(partial, '{}.old'.format(input_file))
+    logging.info('Finished copying file using {}'.format(method))
 
 
-def run(jobid=None, chanid=None, starttime=None):
+def run(jobid=None, chanid=None, starttime=None, tier=None):
+    from MythTV import findfile
+    settings = app.settings
     logging.info('Started')
+    # Stop FFmpeg and clean up when the job is terminated
+    signal.signal(signal.SIGTERM, JobControl.terminated)
+    # Tiered exports are first encoded quickly, the configured profile is
+    #  used by the tier 2 archival re-encode
+    if settings.file.tiered and settings.file.export and tier != 2:
+        tier = 1
+        if settings.file.tierpreset == 'remux':
+            settings.file.commethod = 'only-cut'
+            settings.file['commethod'] = 'only-cut'
+        else:
+            for key, value in (('codechd', settings.file.tiercodec),
+                               ('codecsd', settings.file.tiercodec),
+                               ('presethd', settings.file.tierpreset),
+                               ('presetsd', settings.file.tierpreset)):
+                setattr(settings.video, key, value)
+                settings.video[key] = value
+    problems = validate_profile(settings, app.capabilities())
+    if problems:
+        for problem in problems:
+            logging.error(problem)
+        if job:
+            job.update({'status': job.ERRORED, 'comment': problems[0]})
+        sys.exit(1)
     # Configure chanid and starttime from userjob input
     if jobid:
         logging.debug('Jobid: {}'.format(jobid))
@@ -1601,33 +5222,264 @@ def run(jobid=None, chanid=None, starttime=None):
         chanid = chanid
         starttime = starttime
         logging.debug('chanid={} starttime={}'.format(chanid, starttime))
+    metrics = JobMetrics(jobid=jobid, chanid=chanid, starttime=starttime)
+    if settings.file.metrics:
+        atexit.register(metrics.write,
+                        '{}/metrics.jsonl'.format(settings.file.logdir),
+                        textfile=settings.file.promfile
+                        )
     # Get database recording entry
-    rec = find_rec(chanid, starttime)
-    logging.debug('DB recording entry={}'.format(rec))
-    # Find and format full input file path
-    sg = findfile('/{}'.format(rec.basename), rec.storagegroup, db=db)
-    input_file = os.path.join(sg.dirname, rec.basename)
+    with metrics.phase('database lookup'):
+        rec = find_rec(chanid, starttime)
+        logging.debug('DB recording entry={}'.format(rec))
+        # Find and format full input file path
+        sg = findfile('/{}'.format(rec.basename), rec.storagegroup,
+                      db=app.db
+                      )
+        input_file = os.path.join(sg.dirname, rec.basename)
 
+    # Preparation stages only depend on the recording entry, run the
+    #  probe, metadata and cut list lookup (with online search) and backup
+    #  concurrently. The backup only has to finish before the export.
+    #  The database is only used by the metadata task until it finishes
+    backup_task = None
     if settings.file.saveold and not settings.file.export:
         if not os.path.isfile('{}.old'.format(input_file)):
-            logging.info('Copying file to {}.old'.format(input_file))
-            shutil.copyfile(input_file, '{}.old'.format(input_file))
-            logging.info('Finished copying file')
+            backup_task = BackgroundTask(backup, input_file, metrics)
         else:
             logging.info('.old copy of file exists skiping file copy')
-
-    rec_meta = RecordingToMetadata(rec, allow_search=settings.file.allowsearch)
-    file_items = FileSetup(settings, metadata=rec_meta)
+    check_directories(settings)
+    metadata_task = BackgroundTask(prepare_metadata, rec, settings, metrics)
+    probe_task = BackgroundTask(probe, input_file, metrics)
+    av_info = probe_task.result()
+    rec_meta, file_items = metadata_task.result()
+    # Skip the encode if an equivalent or better export of this source or
+    #  program exists, linking it to this recording's export name
+    if settings.file.dedupe and settings.file.export:
+        with metrics.phase('dedupe'):
+            export_index = ExportIndex()
+            fingerprint = source_fingerprint(input_file)
+            quality = output_quality(av_info, settings)
+            existing = None
+            # the archival re-encode replaces the first tier export
+            if tier != 2:
+                existing = export_index.find(rec_meta, fingerprint, quality)
+        if existing:
+            destination = '{}{}{}.{}'.format(settings.file.exportdir,
+                                             file_items.directory,
+                                             file_items.filename,
+                                             quality['fileformat']
+                                             )
+            logging.info('Existing export found: {}'.format(existing))
+            if os.path.realpath(existing) != os.path.realpath(destination):
+                if not os.path.isdir(os.path.dirname(destination)):
+                    os.makedirs(os.path.dirname(destination))
+                if os.path.isfile(destination):
+                    os.remove(destination)
+                method = clone_file(existing, destination)
+                logging.info('Linked {} using {}'.format(destination, method))
+                export_index.add(destination, fingerprint, rec_meta, quality)
+            if job:
+                job.update({'status': job.FINISHED,
+                            'comment': 'Duplicate of {}'.format(existing)
+                            }
+                           )
+            metrics.record['status'] = 'duplicate'
+            logging.info('Finished')
+            sys.exit()
+    # Learn the commercials of a confirmed cut-list while the job runs, or
+    #  find known commercials in a recording without cut or skip list
+    learn_task = None
+    if settings.file.adindex:
+        if rec_meta.cutlists.cut_list:
+            learn_task = BackgroundTask(
+                learn_commercials, input_file,
+                frames_to_time(rec_meta.cutlists.cut_list,
+                               av_info.video.frame_rate),
+                input_file, settings.file.adindexsize
+            )
+        elif not rec_meta.cutlists.skip_list:
+            with metrics.phase('commercial index'):
+                breaks = AdIndex(size=settings.file.adindexsize).match(
+                    audio_fingerprint(input_file))
+            logging.info('Found {} known commercial breaks'
+                         .format(len(breaks)))
+            if breaks:
+                frame_rate = av_info.video.frame_rate
+                skip_list = [(int(start * frame_rate), int(end * frame_rate))
+                             for start, end in breaks]
+                rec_meta.cutlists['skip_list'] = skip_list
+                rec_meta.cutlists.skip_list = skip_list
+                write_skip_list(rec, skip_list)
+    # Reserve space for temporary and output files, waiting for running
+    #  jobs to finish if no volume has room
+    temp_size, output_size = estimate_space(input_file, av_info, rec_meta,
+                                            settings
+                                            )
+    logging.info('Estimated space required: temp {:.2f}GB output {:.2f}GB'
+                 .format(temp_size / 1024 ** 3, output_size / 1024 ** 3)
+                 )
+    reservation = SpaceReservation('{}.reservations.json'
+                                   .format(settings.file.fallbackdir)
+                                   )
+    atexit.register(reservation.release)
+    candidates = placement_candidates(rec, settings)
+    job_control = JobControl(job=job)
+    # Resume in the directory of an interrupted run of this job
+    work_dir = find_checkpoint(candidates, input_file,
+                               max_age=settings.file.checkpointdays * 86400)
+    if work_dir:
+        logging.info('Found checkpoint in {}'.format(work_dir))
+        if not reservation.reserve([(work_dir, temp_size + output_size)]):
+            logging.warning('Resuming without space reservation')
+    while not work_dir:
+        with metrics.phase('placement'):
+            work_dir = plan_placement(candidates, temp_size, output_size,
+                                      reservation
+                                      )
+        if work_dir:
+            break
+        # waiting only helps if running jobs will release enough space
+        required = temp_size + output_size
+        capacity = max(SpaceReservation.capacity(path) for path in candidates
+                       if os.path.isdir(path))
+        if (required > capacity - SpaceReservation.margin
+                or not reservation.running()):
+            logging.error('Insufficient disk space: {:.2f}GB required'
+                          .format(required / 1024 ** 3))
+            if job:
+                job.update({'status': job.ERRORED,
+                            'comment': 'Insufficient disk space: {:.2f}GB '
+                                       'required'.format(required / 1024 ** 3)
+                            })
+            sys.exit(1)
+        logging.warning('Insufficient disk space waiting for running jobs')
+        if job:
+            job.update({'status': job.PAUSED,
+                        'comment': 'Waiting for disk space: {:.2f}GB required'
+                                   .format((temp_size + output_size)
+                                           / 1024 ** 3)
+                        }
+                       )
+        time.sleep(60)
+        job_control.renew_lease()
+        if job_control.job_command() & job_control.JOB_STOP:
+            job_control.stop(None)
+    # Predict the job duration from similar finished jobs, or for the
+    #  encode alone from the host calibration
+    history = JobHistory()
+    profile = job_profile(av_info, rec_meta, settings)
+    prediction = history.predict(profile)
+    if not prediction and settings.file.commethod != 'only-cut':
+        calibration = calibrated_speed(load_host_profile(), profile['codec'],
+                                       profile['preset'], profile['crf'],
+                                       profile['definition']
+                                       )
+        if calibration:
+            prediction = {'encoding': (profile['kept_duration']
+                                       * profile['frame_rate']
+                                       / calibration[0])
+                          }
+    eta = JobEta(prediction, metrics)
+    if job:
+        job.update({'status': job.RUNNING,
+                    'comment': 'Starting Job ETA: {}'.format(eta.string())
+                    })
     if settings.file.export:
-        out_file = '{}{}'.format(settings.file.fallbackdir, file_items.filename)
+        out_file = '{}{}'.format(work_dir, file_items.filename)
     if not settings.file.export:
-        out_file = '{}{}'.format(settings.file.fallbackdir,
+        out_file = '{}{}'.format(work_dir,
                                  os.path.basename(input_file.rsplit('.', 1)[0])
                                  )
     logging.debug('Fallback file: {}'.format(out_file))
     encoder = Encoder(input_file, out_file, settings=settings,
-                      metadata=rec_meta
+                      metadata=rec_meta, work_dir=work_dir, av_info=av_info,
+                      metrics=metrics, eta=eta, keep_temp=True,
+                      remux_uncut=(tier == 1
+                                   and settings.file.tierpreset == 'remux'),
+                      window=(settings.file.tierwindow if tier == 2
+                              else None)
                       )
+    output_size = os.path.getsize(encoder.output_file)
+    # Record the crf actually used, which crfsearch may have changed, so
+    #  history, predictions and the export index match the output
+    if (encoder.crf is not None and settings.file.commethod != 'only-cut'
+            and not encoder.remux):
+        profile['crf'] = encoder.crf
+        metrics.record['crf'] = encoder.crf
+        if settings.file.dedupe and settings.file.export:
+            quality['crf'] = encoder.crf
+    # Verify the output and renditions before they can replace anything
+    if settings.file.verify:
+        kept_ranges = get_kept_ranges(av_info, rec_meta, settings)
+        if settings.file.commethod == 'only-cut':
+            # a stream copy, compared with the source as it is
+            checks = [(encoder.output_file,
+                       len([stream for stream in av_info.audio.values()
+                            if stream.channels != '0']),
+                       None, encoder.final_stage)]
+        else:
+            checks = [(encoder.output_file,
+                       encoder.audio_config.count('-map'),
+                       encoder.deinterlacer, encoder.final_stage)]
+        for rendition, options, rendition_file in encoder.rendition_config:
+            # the first map is the rendition's video
+            checks.append((rendition_file, options.count('-map') - 1,
+                           encoder.deinterlacer, encoder.rendition_stage))
+        for output, audio_streams, deinterlacer, stage in checks:
+            with metrics.phase('verify'):
+                problems = verify_output(output, input_file, kept_ranges,
+                                         audio_streams, settings,
+                                         deinterlacer=deinterlacer
+                                         )
+            if not problems:
+                continue
+            for problem in problems:
+                logging.error('Verification of {} failed: {}'
+                              .format(output, problem))
+            # discard the stage that made the output so a rerun redoes it
+            encoder.checkpoint.start(stage)
+            os.remove(output)
+            if job:
+                job.update({'status': job.ERRORED,
+                            'comment': 'Verification failed: {}'
+                                       .format(problems[0])
+                            })
+            sys.exit(1)
+        logging.info('Output verified')
+    if tier == 2:
+        tier_backlog = TierBacklog()
+        tier_file = tier_backlog.find(rec.chanid, recording_starttime(rec))
+        # Verify the archival encode against the first tier export when
+        #  both removed the same commercials, otherwise against the kept
+        #  parts of the recording. A remuxed first tier is only cut
+        cut_methods = ('remove', 'only-cut')
+        tier_commethod = ('only-cut' if settings.file.tierpreset == 'remux'
+                          else settings.file.commethod)
+        if (tier_file and os.path.isfile(tier_file)
+                and (tier_commethod in cut_methods)
+                == (settings.file.commethod in cut_methods)):
+            expected_duration = float(AVInfo(tier_file).duration)
+            expected = 'first tier'
+        else:
+            expected_duration = sum(
+                end - start for start, end
+                in get_kept_ranges(av_info, rec_meta, settings))
+            expected = 'kept recording'
+        archive_duration = float(AVInfo(encoder.output_file).duration)
+        if abs(expected_duration - archive_duration) > max(
+                2, expected_duration / 100):
+            logging.error('Archival encode duration {:.1f}s does not '
+                          'match {} {:.1f}s'
+                          .format(archive_duration, expected,
+                                  expected_duration))
+            os.remove(encoder.output_file)
+            if job:
+                job.update({'status': job.ERRORED,
+                            'comment': 'Archival encode duration does not '
+                                       'match {}'.format(expected)
+                            })
+            sys.exit(1)
     # copy file from fallback to export
     if settings.file.export:
         export_dir = '{}{}'.format(settings.file.exportdir,
@@ -1647,16 +5499,107 @@ def run(jobid=None, chanid=None, starttime=None):
         logging.debug('{}'.format(encoder.output_file))
         logging.debug('{}'.format(export_item))
 
-    export_file(encoder.output_file, export_item)
+    if backup_task:
+        backup_task.result()
+    if learn_task:
+        try:
+            learn_task.result()
+        except Exception as e:
+            logging.error('Unable to index commercials: {}'.format(e))
+    cache_policy = CachePolicy(settings.file.dropcache)
+    job_control.renew_lease()
+    with metrics.phase('export'):
+        if encoder.episode_outputs:
+            # Each episode is exported under its own name in place of the
+            #  whole recording
+            exported = True
+            for episode, episode_file in encoder.episode_outputs:
+                if not export_file(episode_file, '{}{}'.format(
+                        settings.file.exportdir,
+                        FileSetup(settings, episode).directory),
+                        cache_policy=cache_policy):
+                    exported = False
+            os.remove(encoder.output_file)
+            if not os.listdir(os.path.dirname(episode_file)):
+                os.rmdir(os.path.dirname(episode_file))
+        else:
+            exported = export_file(encoder.output_file, export_item,
+                                   cache_policy=cache_policy
+                                   )
+        # Each rendition goes to the same directory structure in its own
+        #  export tree
+        for rendition, options, rendition_file in encoder.rendition_config:
+            rendition_dir = rendition.get('exportdir',
+                                          '{}{}/'.format(
+                                              settings.file.exportdir,
+                                              rendition['name']))
+            if not export_file(rendition_file,
+                               '{}{}'.format(rendition_dir,
+                                             file_items.directory),
+                               cache_policy=cache_policy
+                               ):
+                exported = False
+            if not os.listdir(os.path.dirname(rendition_file)):
+                os.rmdir(os.path.dirname(rendition_file))
+        if (encoder.previews and settings.file.export
+                and not encoder.episode_outputs):
+            export_previews(encoder.previews,
+                            '{}{}'.format(export_item, os.path.basename(
+                                encoder.output_file)),
+                            settings, cache_policy=cache_policy
+                            )
+    # the outputs queued for retry keep their space after this job ends
+    if not exported:
+        reservation.hold_queued(work_dir)
+    metrics.add_io(cache_policy.bytes_read, cache_policy.bytes_written)
+    destination = '{}{}'.format(export_item,
+                                os.path.basename(encoder.output_file))
+    if (settings.file.dedupe and settings.file.export
+            and not encoder.episode_outputs):
+        if os.path.isfile(destination):
+            export_index.add(destination, fingerprint, rec_meta, quality)
+    if tier == 1 and exported:
+        TierBacklog().add(destination, rec.chanid, recording_starttime(rec))
+    if tier == 2 and tier_file:
+        if exported:
+            # the export replaced the first tier file unless the name
+            #  differs, as with a remuxed first tier
+            if tier_file != destination and os.path.isfile(tier_file):
+                os.remove(tier_file)
+            tier_backlog.remove(tier_file)
+        else:
+            # the archive is done, only its transfer is left to the retry
+            #  worker. The first tier file is kept in case it is dropped
+            logging.info('Archival export queued for retry, {} is no longer '
+                         'in the tier backlog'.format(tier_file))
+            tier_backlog.remove(tier_file)
 
     if not settings.file.export:
-        update_recorded(rec, input_file, input_file)
+        with metrics.phase('update recorded'):
+            update_recorded(rec, input_file, input_file)
+        # after update_recorded removed the old preview images
+        if encoder.previews:
+            export_previews(encoder.previews, input_file, settings,
+                            cache_policy=cache_policy)
+    # the previews are in the temporary directory until exported
+    remove_temp(encoder.temp_dir)
+    # Store detected commercials for the frontend and later cuts
+    if encoder.detected_skip_list:
+        write_skip_list(rec, encoder.detected_skip_list)
 
+    # Retry earlier failed exports in the background
+    start_retry_worker()
     if job:
         job.update({'status': job.FINISHED,
-                    'comment': 'FINISHED'
+                    'comment': ('FINISHED' if exported else
+                                'FINISHED export queued for retry')
                     }
                    )
+    metrics.record['status'] = 'finished'
+    history.add(profile, metrics, source_size=os.path.getsize(input_file),
+                output_size=output_size,
+                interlaced=int(bool(encoder.deinterlacer))
+                )
     logging.info('Finished')
     sys.exit()
 
@@ -1674,17 +5617,106 @@ def main():
     parser.add_argument('--jobid', action='store', type=int, dest='jobid',
                         help='Database jobid'
                         )
+    parser.add_argument('--calibrate', action='store_true', dest='calibrate',
+                        help='Measure encoding speed of each preset on this '
+                             'host'
+                        )
+    parser.add_argument('--presets', action='store', type=str,
+                        dest='presets',
+                        help='Comma separated presets to calibrate'
+                        )
+    parser.add_argument('--crf', action='store', type=str, dest='crf',
+                        help='Comma separated crf values to calibrate'
+                        )
+    parser.add_argument('--sample', action='store', type=str, dest='sample',
+                        help='Recording to cut calibration samples from'
+                        )
+    parser.add_argument('--report', action='store_true', dest='report',
+                        help='Report predicted encoding backlog of queued '
+                             'jobs'
+                        )
+    parser.add_argument('--window', action='store', type=float,
+                        dest='window', default=8,
+                        help='Nightly encoding window in hours for --report'
+                        )
+    parser.add_argument('--batch', action='store_true', dest='batch',
+                        help='Run queued jobs in queue policy order until '
+                             'the queue is empty'
+                        )
+    parser.add_argument('--daemon', action='store_true', dest='daemon',
+                        help='Run queued jobs in queue policy order '
+                             'continuously'
+                        )
+    parser.add_argument('--parallel', action='store', type=int,
+                        dest='parallel', default=1,
+                        help='Number of jobs run at once by --batch or '
+                             '--daemon'
+                        )
+    parser.add_argument('--tier', action='store', type=int, dest='tier',
+                        help='Encode tier, 2 runs the archival re-encode of '
+                             'a tiered export'
+                        )
+    parser.add_argument('--archive', action='store_true', dest='archive',
+                        help='Re-encode first tier exports during the '
+                             'tierwindow hours, continuously with --daemon'
+                        )
+    parser.add_argument('--retry-exports', action='store_true',
+                        dest='retry_exports',
+                        help='Retry queued failed exports until the queue is '
+                             'empty, continuously with --daemon'
+                        )
+    parser.add_argument('--drop-leases', action='store_true',
+                        dest='drop_leases',
+                        help='Remove the cluster lease table from the MythTV '
+                             'database after disabling cluster on every host'
+                        )
     args = parser.parse_args()
+    if args.drop_leases:
+        app.setup_logging()
+        JobLeases.drop_table()
+        logging.info('Removed the transcode_lease table')
+        sys.exit(0)
+    if args.retry_exports:
+        app.setup_logging()
+        retry_exports(parallel=app.settings.file.retryparallel,
+                      daemon=args.daemon,
+                      max_attempts=app.settings.file.retrymax)
+        sys.exit(0)
+    if args.archive:
+        app.setup_logging()
+        drain_tiers(app.settings, daemon=args.daemon)
+        sys.exit(0)
+    if args.batch or args.daemon:
+        app.setup_logging()
+        run_queue(app.settings, parallel=args.parallel, daemon=args.daemon)
+        sys.exit(0)
+    if args.report:
+        capacity_report(JobHistory(), window=args.window)
+        sys.exit(0)
+    app.setup_logging()
+    if args.calibrate:
+        presets_list = None
+        crf_list = None
+        if args.presets:
+            presets_list = args.presets.split(',')
+        if args.crf:
+            crf_list = [int(crf) for crf in args.crf.split(',')]
+        calibrate(app.settings, presets_list=presets_list, crf_list=crf_list,
+                  source=args.sample
+                  )
+        sys.exit(0)
     if args.jobid:
+        from MythTV import Job
         global job
-        job = Job(args.jobid, db=db)
+        job = Job(args.jobid, db=app.db)
         run(jobid=args.jobid)
         sys.exit(0)
     if args.chanid and args.starttime:
-        run(chanid=args.chanid, starttime=args.starttime)
+        run(chanid=args.chanid, starttime=args.starttime, tier=args.tier)
         sys.exit(0)
     else:
         print('chanid and starttime or jobid required')
 
 
-main()
+if __name__ == '__main__':
+    main()
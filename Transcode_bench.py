@@ -0,0 +1,538 @@
+#!/usr/bin/env python2
+# -*- coding: UTF-8 -*-
+"""
+End to end benchmark for Transcode.py.
+
+Synthetic MPEG-TS recordings are generated with FFmpeg lavfi sources and
+every commercial method and export path is run against them using an in
+memory stand-in for the MythTV python bindings. Results are written as
+json and can be compared against a previous run to catch regressions.
+"""
+from __future__ import print_function, division
+import argparse
+import calendar
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime
+from io import open
+
+script_path = os.path.dirname(os.path.abspath(__file__))
+
+# size, interlaced, audio languages, commercial breaks
+scenarios = {'sd-interlaced': {'size': (720, 480), 'interlaced': True,
+                               'audio': ['eng'], 'breaks': 3
+                               },
+             'sd-progressive': {'size': (720, 480), 'interlaced': False,
+                                'audio': ['eng'], 'breaks': 3
+                                },
+             'hd-interlaced': {'size': (1920, 1080), 'interlaced': True,
+                               'audio': ['eng', 'spa'], 'breaks': 4
+                               },
+             'hd-progressive': {'size': (1280, 720), 'interlaced': False,
+                                'audio': ['eng', 'spa'], 'breaks': 4
+                                },
+             'captions': {'size': (720, 480), 'interlaced': True,
+                          'audio': ['eng'], 'breaks': 3, 'captions': True
+                          }
+             }
+commethods = ['remove', 'chapters', 'only-cut']
+frame_rate = 30000 / 1001
+
+
+def program_check(program, alt_program=None):
+    """
+    Check if program or  optional alternate program is installed. returning
+    the path to the programs executable
+    """
+    from distutils import spawn
+    if spawn.find_executable(program):
+        return spawn.find_executable(program)
+    if alt_program:
+        if spawn.find_executable(alt_program):
+            return spawn.find_executable(alt_program)
+    if alt_program:
+        raise LookupError('Unable to find {} or {}'.format(program,
+                                                           alt_program
+                                                           )
+                          )
+    raise LookupError('Unable to find {}'.format(program))
+
+
+def generate_recording(ffmpeg, path, scenario, duration, caption_source=None):
+    """
+    Create a synthetic MPEG-2/AC-3 transport stream at path. With
+    caption_source, a clip containing embedded 608 captions is looped
+    instead, as FFmpeg cannot author closed captions
+    """
+    if scenario.get('captions'):
+        if not caption_source:
+            return False
+        command = [ffmpeg, '-y', '-v', 'error', '-stream_loop', '-1', '-i',
+                   caption_source, '-t', str(duration), '-map', '0', '-c',
+                   'copy', '-f', 'mpegts', path
+                   ]
+        subprocess.check_call(command)
+        return True
+    width, height = scenario['size']
+    if scenario['interlaced']:
+        source_rate = '60000/1001'
+    else:
+        source_rate = '30000/1001'
+    command = [ffmpeg, '-y', '-v', 'error', '-f', 'lavfi', '-i',
+               'testsrc2=size={}x{}:rate={}'.format(width, height, source_rate)
+               ]
+    for index, language in enumerate(scenario['audio']):
+        command.extend(['-f', 'lavfi', '-i',
+                        'sine=frequency={}:sample_rate=48000'
+                        .format(440 * (index + 1))
+                        ])
+    command.extend(['-t', str(duration), '-map', '0:v'])
+    if scenario['interlaced']:
+        command.extend(['-vf', 'tinterlace=interleave_top,setfield=tff',
+                        '-flags', '+ilme+ildct', '-top', '1'
+                        ])
+    if height >= 720:
+        bitrate = '12M'
+    else:
+        bitrate = '4M'
+    command.extend(['-c:v', 'mpeg2video', '-b:v', bitrate, '-maxrate',
+                    bitrate, '-bufsize', '2M', '-g', '15'
+                    ])
+    for index, language in enumerate(scenario['audio']):
+        if index == 0:
+            channels = '6'
+        else:
+            channels = '2'
+        command.extend(['-map', '{}:a'.format(index + 1),
+                        '-c:a:{}'.format(index), 'ac3',
+                        '-ac:a:{}'.format(index), channels,
+                        '-metadata:s:a:{}'.format(index),
+                        'language={}'.format(language)
+                        ])
+    command.extend(['-f', 'mpegts', path])
+    subprocess.check_call(command)
+    return True
+
+
+def commercial_breaks(duration, breaks):
+    """Return a cut-list of (start, end) frames for evenly spaced breaks"""
+    total = int(duration * frame_rate)
+    length = int(min(duration * 0.05, 120) * frame_rate)
+    cut_list = []
+    for count in range(breaks):
+        middle = int(total * (count + 1) / (breaks + 1))
+        cut_list.append((middle - length // 2, middle + length // 2))
+    return cut_list
+
+
+def install_fake_mythtv(recording):
+    """
+    Register in memory replacements for the MythTV python bindings holding
+    a single recording described by the recording dict
+    """
+    class BenchDateTime(datetime):
+        """datetime with the timestamp() method of MythTV's datetime"""
+        def timestamp(self):
+            return calendar.timegm(self.utctimetuple())
+
+    class Markup(list):
+        """Recording markup with cut and skip list accessors"""
+        MARK_COMM_START = 4
+        MARK_COMM_END = 5
+
+        def __init__(self, cut_list):
+            super(Markup, self).__init__()
+            self.cut_list = [tuple(cut) for cut in cut_list]
+
+        def getcutlist(self):
+            return self.cut_list
+
+        def getuncutlist(self):
+            return []
+
+        def getskiplist(self):
+            return self.cut_list
+
+        def getunskiplist(self):
+            return []
+
+        def commit(self):
+            pass
+
+    class Seek(object):
+        def clean(self):
+            pass
+
+    class Recorded(object):
+        """Stand-in for MythTV.Recorded"""
+        def __init__(self, data=None, db=None):
+            start = datetime.strptime(recording['starttime'], '%Y%m%d%H%M%S')
+            self.data = {'chanid': recording['chanid'],
+                         'starttime': BenchDateTime(*start.timetuple()[:6]),
+                         'basename': recording['basename'],
+                         'storagegroup': 'Default',
+                         'title': recording['title'],
+                         'subtitle': recording['subtitle'],
+                         'description': u'Synthetic benchmark recording',
+                         'season': recording['season'],
+                         'episode': recording['episode'],
+                         'programid': recording['programid'],
+                         'originalairdate': None, 'airdate': None,
+                         'year': start.year, 'previouslyshown': 0,
+                         'cutlist': 1, 'commflagged': 1, 'transcoded': 0
+                         }
+            self.markup = Markup(recording['cut_list'])
+            self.seek = Seek()
+
+        def __getattr__(self, name):
+            try:
+                return self.__dict__['data'][name]
+            except KeyError:
+                raise AttributeError(name)
+
+        def __setattr__(self, name, value):
+            if name in ('data', 'markup', 'seek'):
+                object.__setattr__(self, name, value)
+            else:
+                self.data[name] = value
+
+        def items(self):
+            return self.data.items()
+
+        def update(self):
+            pass
+
+    class Program(object):
+        @staticmethod
+        def fromRecorded(recorded):
+            return {}
+
+    class Cursor(object):
+        def execute(self, query, args=None):
+            pass
+
+        def fetchone(self):
+            return (0,)
+
+    class StorageGroup(object):
+        def __init__(self, dirname):
+            self.dirname = dirname
+            self.local = True
+
+    class MythDB(object):
+        """Stand-in for MythTV.MythDB"""
+        def __enter__(self):
+            return Cursor()
+
+        def __exit__(self, *args):
+            return False
+
+        def searchRecorded(self, **kwargs):
+            if kwargs.get('basename') == recording['basename']:
+                return [Recorded()]
+            return []
+
+        def getStorageGroup(self, groupname=None, hostname=None):
+            return [StorageGroup(recording['dirname'])]
+
+        def gethostname(self):
+            return platform.node()
+
+    class Job(object):
+        """Stand-in for MythTV.Job"""
+        RUNNING = 4
+        PAUSED = 6
+        FINISHED = 272
+        ABORTED = 288
+        ERRORED = 304
+
+        def __init__(self, jobid=None, db=None):
+            self.id = jobid
+            self.chanid = recording['chanid']
+            self.starttime = recording['starttime']
+
+        def update(self, data):
+            pass
+
+    def findfile(filename, sgroup, db=None):
+        return StorageGroup(recording['dirname'])
+
+    class VideoGrabber(object):
+        def __init__(self, mode):
+            pass
+
+        def search(self, title):
+            return []
+
+    mythtv = types.ModuleType('MythTV')
+    mythtv.Recorded = Recorded
+    mythtv.Program = Program
+    mythtv.MythDB = MythDB
+    mythtv.VideoGrabber = VideoGrabber
+    mythtv.Job = Job
+    mythtv.findfile = findfile
+    ttvdb = types.ModuleType('MythTV.ttvdb')
+    ttvdb.tvdb_api = types.ModuleType('MythTV.ttvdb.tvdb_api')
+    ttvdb.tvdb_exceptions = types.ModuleType('MythTV.ttvdb.tvdb_exceptions')
+    for name in ('tvdb_shownotfound', 'tvdb_seasonnotfound',
+                 'tvdb_episodenotfound'):
+        setattr(ttvdb.tvdb_exceptions, name, type(name, (Exception,), {}))
+    mythtv.ttvdb = ttvdb
+    sys.modules['MythTV'] = mythtv
+    sys.modules['MythTV.ttvdb'] = ttvdb
+    sys.modules['MythTV.ttvdb.tvdb_api'] = ttvdb.tvdb_api
+    sys.modules['MythTV.ttvdb.tvdb_exceptions'] = ttvdb.tvdb_exceptions
+
+
+def worker(spec_file):
+    """Run a single transcode described by spec_file in this process"""
+    with open(spec_file, 'r') as sf:
+        spec = json.load(sf)
+    install_fake_mythtv(spec['recording'])
+    os.environ['TRANSCODE_CONFIG'] = spec['config']
+    # keep the job history, export index and queues of the benchmark
+    #  jobs out of the user's
+    os.environ['TRANSCODE_STATE_DIR'] = os.path.dirname(spec['config'])
+    sys.path.insert(0, script_path)
+    import Transcode
+    Transcode.app.setup_logging()
+    Transcode.run(chanid=spec['recording']['chanid'],
+                  starttime=spec['recording']['starttime']
+                  )
+
+
+def write_config(path, work_dir, commethod, export, includesub, preset):
+    """Write a conf.json for a benchmark run"""
+    config = {'file': {'fileformat': 'mp4',
+                       'logdir': os.path.join(work_dir, 'log'),
+                       'exportdir': os.path.join(work_dir, 'export/'),
+                       'fallbackdir': os.path.join(work_dir, 'fallback/'),
+                       'saveold': 1, 'usecommflag': 0,
+                       'tvdirstruct': 'folders', 'mvdirstruct': 'none',
+                       'commethod': commethod, 'includesub': includesub,
+                       'export': export, 'exporttype': 'kodi',
+                       'episodetitle': 1, 'allowsearch': 0, 'previews': 1
+                       },
+              'video': {'codechd': 'libx264', 'codecsd': 'libx264',
+                        'presethd': preset, 'presetsd': preset,
+                        'crfhd': 20, 'crfsd': 18, 'minratehd': 0,
+                        'minratesd': 0, 'maxratehd': 0, 'maxratesd': 0,
+                        'deinterlacehd': 'yadif', 'deinterlacesd': 'yadif'
+                        },
+              'audio': {'codechd': 'aac', 'codecsd': 'aac', 'bpchd': 64,
+                        'bpcsd': 64, 'language': 'all'
+                        }
+              }
+    for directory in ('log', 'export', 'fallback'):
+        if not os.path.isdir(os.path.join(work_dir, directory)):
+            os.makedirs(os.path.join(work_dir, directory))
+    with open(path, 'w') as cf:
+        cf.write(u'{}'.format(json.dumps(config)))
+
+
+def directory_size(path):
+    """Total size of all files below path"""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total = total + os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def run_case(name, scenario, source, commethod, export, args):
+    """Run one benchmark case in a worker process returning its result"""
+    work_dir = tempfile.mkdtemp(prefix='{}-{}-'.format(name, commethod),
+                                dir=args.workdir
+                                )
+    recording_dir = os.path.join(work_dir, 'recordings')
+    os.makedirs(recording_dir)
+    basename = os.path.basename(source)
+    shutil.copyfile(source, os.path.join(recording_dir, basename))
+    config_file = os.path.join(work_dir, 'conf.json')
+    write_config(config_file, work_dir, commethod, export,
+                 int(bool(scenario.get('captions'))), args.preset
+                 )
+    chanid, starttime = basename.split('.')[0].split('_')
+    spec = {'config': config_file,
+            'recording': {'chanid': chanid, 'starttime': starttime,
+                          'basename': basename, 'dirname': recording_dir,
+                          'title': u'Benchmark {}'.format(name),
+                          'subtitle': u'{} {}'.format(commethod, export),
+                          'season': 1, 'episode': 1,
+                          'programid': u'EP000000000001',
+                          'cut_list': commercial_breaks(args.duration,
+                                                        scenario['breaks'])
+                          }
+            }
+    spec_file = os.path.join(work_dir, 'spec.json')
+    with open(spec_file, 'w') as sf:
+        sf.write(u'{}'.format(json.dumps(spec)))
+    command = [sys.executable, os.path.abspath(__file__), '--worker',
+               spec_file
+               ]
+    start = time.time()
+    with open(os.path.join(work_dir, 'worker.log'), 'wb') as log:
+        returncode = subprocess.call(command, stdout=log, stderr=log)
+    wall_time = time.time() - start
+    phases = {}
+    metrics_file = os.path.join(work_dir, 'log', 'metrics.jsonl')
+    if os.path.isfile(metrics_file):
+        with open(metrics_file, 'r') as mf:
+            lines = mf.readlines()
+        if lines:
+            record = json.loads(lines[-1])
+            phases = record['phases']
+    if export:
+        output_size = directory_size(os.path.join(work_dir, 'export'))
+    else:
+        # only-cut replaces the recording, other methods add a new file
+        output_size = 0
+        for output in os.listdir(recording_dir):
+            if output == '{}.old'.format(basename):
+                continue
+            if output == basename and commethod != 'only-cut':
+                continue
+            output_size = (output_size
+                           + os.path.getsize(os.path.join(recording_dir,
+                                                          output)))
+    # checks of the job's results that failed
+    failed = []
+    if returncode == 0 and not export and commethod != 'only-cut':
+        if not os.path.isfile(os.path.join(recording_dir,
+                                           '{}.png'.format(basename))):
+            failed.append('MythTV preview image missing')
+    result = {'scenario': name, 'commethod': commethod, 'export': export,
+              'returncode': returncode, 'wall_time': wall_time,
+              'phases': phases, 'output_size': output_size,
+              'failed': failed
+              }
+    if returncode == 0 and not failed and not args.keep:
+        shutil.rmtree(work_dir)
+    return result
+
+
+def compare(results, baseline_file, threshold):
+    """Return a list of cases slower than the baseline by threshold"""
+    with open(baseline_file, 'r') as bf:
+        baseline = json.load(bf)
+    previous = {}
+    for result in baseline['results']:
+        previous[(result['scenario'], result['commethod'],
+                  result['export'])] = result
+    regressions = []
+    for result in results:
+        key = (result['scenario'], result['commethod'], result['export'])
+        if key not in previous or previous[key]['returncode'] != 0:
+            continue
+        limit = previous[key]['wall_time'] * (1 + threshold)
+        if result['returncode'] != 0 or result['wall_time'] > limit:
+            regressions.append({'case': '/'.join(str(k) for k in key),
+                                'baseline': previous[key]['wall_time'],
+                                'current': result['wall_time'],
+                                'returncode': result['returncode']
+                                })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='End to end benchmark for Transcode.py')
+    parser.add_argument('--output', action='store', dest='output',
+                        default='bench_results.json',
+                        help='Results json file'
+                        )
+    parser.add_argument('--baseline', action='store', dest='baseline',
+                        help='Previous results to compare against'
+                        )
+    parser.add_argument('--threshold', action='store', type=float,
+                        dest='threshold', default=0.1,
+                        help='Allowed slowdown against the baseline'
+                        )
+    parser.add_argument('--scenario', action='append', dest='scenarios',
+                        choices=sorted(scenarios.keys()),
+                        help='Scenario to run, may be repeated'
+                        )
+    parser.add_argument('--duration', action='store', type=int,
+                        dest='duration', default=120,
+                        help='Length of synthetic recordings in seconds'
+                        )
+    parser.add_argument('--preset', action='store', dest='preset',
+                        default='medium', help='x264 preset used'
+                        )
+    parser.add_argument('--caption-source', action='store',
+                        dest='caption_source',
+                        help='Clip with embedded 608 captions for the '
+                             'captions scenario'
+                        )
+    parser.add_argument('--workdir', action='store', dest='workdir',
+                        help='Directory for temporary files'
+                        )
+    parser.add_argument('--keep', action='store_true', dest='keep',
+                        help='Keep work directories'
+                        )
+    parser.add_argument('--worker', action='store', dest='worker',
+                        help=argparse.SUPPRESS
+                        )
+    args = parser.parse_args()
+    if args.worker:
+        worker(args.worker)
+        return
+
+    ffmpeg = program_check('ffmpeg', 'mythffmpeg')
+    version = subprocess.check_output([ffmpeg, '-version'])
+    source_dir = tempfile.mkdtemp(prefix='sources-', dir=args.workdir)
+    selected = args.scenarios or sorted(scenarios.keys())
+    results = []
+    for count, name in enumerate(selected):
+        scenario = scenarios[name]
+        source = os.path.join(source_dir, '1001_2026010100{:02d}00.ts'
+                              .format(count))
+        print('Generating {}'.format(name))
+        if not generate_recording(ffmpeg, source, scenario, args.duration,
+                                  caption_source=args.caption_source):
+            print('Skipping {}: --caption-source required'.format(name))
+            continue
+        for commethod in commethods:
+            for export in (0, 1):
+                print('Running {} {} export={}'.format(name, commethod,
+                                                       export))
+                result = run_case(name, scenario, source, commethod,
+                                  export, args)
+                print('  {:.1f}s returncode {}'.format(result['wall_time'],
+                                                       result['returncode']))
+                for check in result['failed']:
+                    print('  Failed: {}'.format(check))
+                results.append(result)
+    shutil.rmtree(source_dir)
+    report = {'host': platform.node(), 'timestamp': time.time(),
+              'python': platform.python_version(),
+              'ffmpeg': version.decode('UTF-8').split('\n')[0],
+              'duration': args.duration, 'preset': args.preset,
+              'results': results
+              }
+    with open(args.output, 'w') as rf:
+        rf.write(u'{}'.format(json.dumps(report, indent=2, sort_keys=True)))
+    print('Results written to {}'.format(args.output))
+    failed = [result for result in results if result['failed']]
+    if failed:
+        print('{} cases failed checks'.format(len(failed)))
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.threshold)
+        for regression in regressions:
+            print('Regression {case}: {baseline:.1f}s -> {current:.1f}s '
+                  'returncode {returncode}'.format(**regression))
+        if regressions:
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,9 +4,10 @@ from __future__ import print_function
 import json
 import os
 from io import open
-import subprocess
 import Tkinter as Tk
 import ttk
+from Transcode import (app, ffmpeg_capabilities, load_host_profile,
+                       calibrated_speed)
 
 
 class DictToNamespace(dict):
@@ -28,27 +29,6 @@ class DictToNamespace(dict):
                 self.__setattr__(str(k), v)
 
 
-def program_check(program, alt_program=None):
-    """
-    Check if program or  optional alternate program is installed. returning
-    the path to the programs executable
-    """
-    from distutils import spawn
-    if spawn.find_executable(program):
-        return spawn.find_executable(program)
-    if alt_program:
-        if spawn.find_executable(alt_program):
-            return spawn.find_executable(alt_program)
-    else:
-        if alt_program:
-            raise LookupError('Unable to find {} or {}'.format(program,
-                                                               alt_program
-                                                               )
-                              )
-        if not alt_program:
-            raise LookupError('Unable to find {}'.format(program))
-
-
 def write_check(path):
     """Check if a directory is writeable if not return False."""
     import errno
@@ -69,35 +49,25 @@ def write_check(path):
 
 def codec_check(ffmpeg):
     """Check for list of encoders enabled in ffmpeg"""
-    # Checks ffmpag available encoders
-    command = [ffmpeg, '-encoders']
-    run = subprocess.check_output(command)
-    available_video = []
-    available_audio = ['copy']
+    encoders = ffmpeg_capabilities(ffmpeg)['encoders']
     video_list = ['libx264', 'libx265']
     audio_list = ['aac', 'libfdk_aac', 'ac3']
-
-    for line in run.rsplit('\n'):
-        for video_codec in video_list:
-            if video_codec in line and video_codec not in available_video:
-                available_video.append(video_codec)
-        for audio_codec in audio_list:
-            if audio_codec in line and audio_codec not in available_audio:
-                available_audio.append(audio_codec)
-
+    available_video = [codec for codec in video_list if codec in encoders]
+    available_audio = ['copy']
+    available_audio.extend([codec for codec in audio_list
+                            if codec in encoders
+                            ])
     return available_video, available_audio
 
 
 def deinterlace_check(ffmpeg):
     """Check for list of deinterlacers enabled in ffmpeg"""
-    command = [ffmpeg, '-filters']
-    run = subprocess.check_output(command)
+    filters = ffmpeg_capabilities(ffmpeg)['filters']
     deinterlacers = ['yadif', 'bwdif']
     deinterlacer_list = ['none']
-    for line in run.rsplit('\n'):
-        for deint_filter in deinterlacers:
-            if deint_filter in line:
-                deinterlacer_list.append(deint_filter)
+    deinterlacer_list.extend([deint_filter for deint_filter in deinterlacers
+                              if deint_filter in filters
+                              ])
     return deinterlacer_list
 
 
@@ -115,7 +85,27 @@ class ConfigSetup:
                          'usecommflag': 0, 'tvdirstruct': 'folders',
                          'mvdirstruct': 'none', 'commethod': 'remove',
                          'includesub': 0, 'export': 1, 'exporttype': 'kodi',
-                         'episodetitle': 1, 'allowsearch': 0
+                         'episodetitle': 1, 'allowsearch': 0,
+                         'autopause': 0, 'tempplacement': 'fallback',
+                         'dropcache': 1, 'metrics': 1, 'promfile': '',
+                         'jobtype': 256, 'queuepolicy': 'sjf',
+                         'queueaging': 1, 'priorityrules': [],
+                         'dedupe': 1, 'retryparallel': 2, 'retrymax': 20,
+                         'renditions': [], 'tiered': 0,
+                         'tiercodec': 'libx264', 'tierpreset': 'veryfast',
+                         'tierwindow': [1, 6], 'crfsearch': 0,
+                         'crftarget': 'ssim', 'ssimfloor': 0.97,
+                         'bppbudget': 0.08,
+                         'crfcandidates': [18, 20, 22, 24, 26, 28],
+                         'crfsamples': 4, 'crfsamplelength': 4,
+                         'verify': 1, 'verifysamples': 4, 'verifyssim': 0.6,
+                         'commdetect': 0, 'logoarea': 'iw/4:ih/4:iw*3/4:0',
+                         'adindex': 0, 'adindexsize': 5000, 'previews': 0,
+                         'previewinterval': 10, 'previewwidth': 320,
+                         'loudnorm': 0, 'loudnesstarget': -23,
+                         'truepeak': -1, 'splitepisodes': 0,
+                         'cluster': 0, 'leasetime': 300,
+                         'clusteraffinity': 600, 'checkpointdays': 7
                          },
                 'video': {'codechd': 'libx264', 'codecsd': 'libx264',
                           'presethd': 'medium', 'presetsd': 'medium',
@@ -142,6 +132,13 @@ class ConfigSetup:
         # Set config dict to values in config file
         with open(self.config_file, 'rb') as conf_read:
             config.update(json.load(conf_read))
+        # Add entries missing from older configuration files
+        for section, items in self.defaults.items():
+            if section not in config:
+                config[section] = {}
+            for k, v in items.items():
+                if k not in config[section]:
+                    config[section][k] = v
 
         if config.keys() == self.defaults.keys():
             for section, items in config.items():
@@ -152,7 +149,7 @@ class ConfigSetup:
                             if not v.endswith('/'):
                                 v = '{}/'.format(v)
                         k = str(k)
-                        if not isinstance(v, (int, float)):
+                        if not isinstance(v, (int, float, list, dict)):
                             v = str(v)
                             items.update({str(k): str(v)})
                             config_out[str(section)].update({str(k): str(v)})
@@ -198,11 +195,12 @@ class ConfigSetup:
 
 
 settings = ConfigSetup()
-ffmpeg = program_check('ffmpeg', 'mythffmpeg')
+ffmpeg = app.ffmpeg
 
 # Lists of named parameters
 video_codecs, audio_codecs = codec_check(ffmpeg)
 deinterlacers = deinterlace_check(ffmpeg)
+host_profile = load_host_profile()
 fileformat = ['mp4', 'mkv']
 dirformat = ['none', 'folders']
 presets = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium',
@@ -210,6 +208,7 @@ presets = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium',
            ]
 comrem = ['remove', 'chapters', 'only-cut']
 exporttype = ['plex', 'kodi']
+tempplacement = ['fallback', 'auto']
 audiolanguage = ['eng', 'fre', 'ger', 'ita', 'spa', 'all']
 
 root = Tk.Tk()
@@ -293,6 +292,24 @@ def file_options(frame, insert_row):
                                                  onvalue=1, offvalue=0
                                                  )
     frame.file_frame.includesub.grid(row=5, column=0, columnspan=4)
+    # Auto pause items
+    frame.file_frame.autopause_var = Tk.BooleanVar()
+    frame.file_frame.autopause_var.set(settings.file['autopause'])
+    frame.file_frame.autopause = Tk.Checkbutton(frame.file_frame,
+                                                text='Pause while recording or playing',
+                                                variable=frame.file_frame.autopause_var,
+                                                onvalue=1, offvalue=0
+                                                )
+    frame.file_frame.autopause.grid(row=6, column=0, columnspan=4)
+    # Drop cache items
+    frame.file_frame.dropcache_var = Tk.BooleanVar()
+    frame.file_frame.dropcache_var.set(settings.file['dropcache'])
+    frame.file_frame.dropcache = Tk.Checkbutton(frame.file_frame,
+                                                text='Limit page cache use',
+                                                variable=frame.file_frame.dropcache_var,
+                                                onvalue=1, offvalue=0
+                                                )
+    frame.file_frame.dropcache.grid(row=7, column=0, columnspan=4)
 
 
     frame.file_frame.grid(row=insert_row, column=0, columnspan=4, stick='we')
@@ -394,6 +411,18 @@ def export_options(frame, insert_row):
                                                     onvalue=1, offvalue=0
                                                     )
     frame.export_frame.allowsearch.grid(row=9, column=0, columnspan=4)
+    # temporary file placement items
+    frame.export_frame.placement_label = Tk.Label(frame.export_frame,
+                                                  text='Temporary file placement'
+                                                  )
+    frame.export_frame.placement_var = Tk.StringVar()
+    frame.export_frame.placement = ttk.Combobox(frame.export_frame,
+                                                textvariable=frame.export_frame.placement_var,
+                                                values=tempplacement, width=8
+                                                )
+    frame.export_frame.placement_var.set(settings.file['tempplacement'])
+    frame.export_frame.placement_label.grid(row=10, column=0)
+    frame.export_frame.placement.grid(row=10, column=1, stick='e')
 
 
     frame.export_frame.grid(row=insert_row, column=0, columnspan=4, stick='we')
@@ -429,6 +458,29 @@ def av_opts(frame, deff):
     frame.crf_label.grid(row=3, column=0)
     frame.crf.grid(row=3, column=1, stick='e')
     frame.crf_var.set(settings.video['crf{}'.format(deff)])
+    # calibrated speed items
+    frame.estimate_var = Tk.StringVar()
+    frame.estimate_label = Tk.Label(frame, textvariable=frame.estimate_var)
+    frame.estimate_label.grid(row=4, column=0, columnspan=2)
+
+    def update_estimate(*args):
+        """Show calibrated speed of the selected codec, preset and crf"""
+        try:
+            crf = int(frame.crf_var.get())
+        except ValueError:
+            return
+        speed = calibrated_speed(host_profile, frame.video_codec_var.get(),
+                                 frame.preset_var.get(), crf, deff
+                                 )
+        if speed:
+            frame.estimate_var.set('Calibrated: {:.1f} fps {:.3f} bits/pixel'
+                                   .format(*speed))
+        else:
+            frame.estimate_var.set('Not calibrated: run Transcode.py '
+                                   '--calibrate')
+    for variable in (frame.video_codec_var, frame.preset_var, frame.crf_var):
+        variable.trace('w', update_estimate)
+    update_estimate()
     # min/max bitrate still needs to be implemented
     # max bitrate items
     #frame.max_rate_label = Tk.Label(frame, text='video maximum bitrate')
@@ -499,10 +551,13 @@ def config_update():
     settings.file['tvdirstruct'] = frame0.export_frame.tvdir_var.get()
     settings.file['episodetitle'] = frame0.export_frame.episodetitle_var.get()
     settings.file['allowsearch'] = frame0.export_frame.allowsearch_var.get()
+    settings.file['tempplacement'] = frame0.export_frame.placement_var.get()
     settings.file['saveold'] = bool(frame0.file_frame.save_old_var.get())
     settings.file['usecommflag'] = bool(frame0.file_frame.use_commflag_var.get())
     settings.file['commethod'] = frame0.file_frame.com_var.get()
     settings.file['includesub'] = bool(frame0.file_frame.includesub_var.get())
+    settings.file['autopause'] = bool(frame0.file_frame.autopause_var.get())
+    settings.file['dropcache'] = bool(frame0.file_frame.dropcache_var.get())
     settings.video['codechd'] = frame1.video_codec_var.get()
     settings.video['codecsd'] = frame2.video_codec_var.get()
     settings.video['presethd'] = frame1.preset_var.get()